@@ -16,6 +16,9 @@
  * along with this program. If not, see <http://www.gnu.org/licenses/>.
  */
 
+/* Milliseconds between checks on the status of a queued update. */
+var UPDATE_POLL_INTERVAL = 1000;
+
 $('#track-player').click(function(evt) {
     var player = document.location.pathname.substring(8);
 
@@ -29,24 +32,58 @@ $('#track-player').click(function(evt) {
         data: {
             player: player
         },
-        success: function(data) {
-            if (data == '-1') {
-                $('#track-player-result').html('This player was updated less'
-                    + ' than 30s ago. Please wait.');
-            } else if (data == '-2') {
-                $('#track-player-result').html('Player ' + player
-                    + ' not found on Hiscores.');
-            } else if (data == '-3') {
-                $('#track-player-result').html('Could not reach the OSRS'
-                    + ' Hiscores API. Please try again.');
-            } else if (data == '-4') {
-                $('#track-player-result').html('Invalid username.');
-            } else {
-                document.location.reload(true);
-            }
+        dataType: 'json',
+        success: function(job) {
+            $('#track-player-result').html('Looking up ' + player + '...');
+            waitForUpdate(job, function(data) {
+                if (data == '-1') {
+                    $('#track-player-result').html('This player was updated'
+                        + ' less than 30s ago. Please wait.');
+                } else if (data == '-2') {
+                    $('#track-player-result').html('Player ' + player
+                        + ' not found on Hiscores.');
+                } else if (data == '-3') {
+                    $('#track-player-result').html('Could not reach the OSRS'
+                        + ' Hiscores API. Please try again.');
+                } else if (data == '-4') {
+                    $('#track-player-result').html('Invalid username.');
+                } else if (data != 'OK') {
+                    $('#track-player-result').html('Update failed.');
+                } else {
+                    document.location.reload(true);
+                }
+            });
         },
         failure: function(data) {
             $('#track-player-result').html('Update failed.');
         }
     });
 });
+
+/*
+ * Follow an update job, as returned by /tracker/updateplayer, until it
+ * finishes, then call done with its result code.
+ */
+var waitForUpdate = function(job, done) {
+    if (job.status == 'D' || job.status == 'F') {
+        done(job.result);
+        return;
+    }
+
+    setTimeout(function() {
+        $.ajax({
+            type: 'GET',
+            url: '/tracker/updatestatus',
+            data: {
+                job: job.job
+            },
+            dataType: 'json',
+            success: function(data) {
+                waitForUpdate(data, done);
+            },
+            error: function(data) {
+                done('-5');
+            }
+        });
+    }, UPDATE_POLL_INTERVAL);
+}
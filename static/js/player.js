@@ -19,6 +19,9 @@
 /* ID of the skill currently displayed in records table. */
 var recordSkillId = 0;
 
+/* Milliseconds between checks on the status of a queued update. */
+var UPDATE_POLL_INTERVAL = 1000;
+
 $('#player-update').click(function(evt) {
     var player = document.location.pathname.substring(8);
 
@@ -32,26 +35,32 @@ $('#player-update').click(function(evt) {
         data: {
             player: player
         },
-        success: function(data) {
-            if (data == '-1') {
-                $('#player-update-result').html('This player was updated less'
-                    + ' than 30s ago.<br>Please wait.');
-            } else if (data == '-2') {
-                $('#player-update-result').html('Player ' + player
-                    + ' not found on Hiscores.');
-            } else if (data == '-3') {
-                $('#player-update-result').html('Could not reach the OSRS'
-                    + ' Hiscores API. Please try again.');
-            } else {
-                $('#player-update-result').html('Player ' + player
-                    + ' has been updated.');
-                updateRecords(recordSkillId);
-                updateSkillTable();
-                fetchUpdateTime();
-                setTimeout(function() {
-                    $('#player-update-result').html('');
-                }, 5000);
-            }
+        dataType: 'json',
+        success: function(job) {
+            $('#player-update-result').html('Updating ' + player + '...');
+            waitForUpdate(job, function(data) {
+                if (data == '-1') {
+                    $('#player-update-result').html('This player was updated'
+                        + ' less than 30s ago.<br>Please wait.');
+                } else if (data == '-2') {
+                    $('#player-update-result').html('Player ' + player
+                        + ' not found on Hiscores.');
+                } else if (data == '-3') {
+                    $('#player-update-result').html('Could not reach the OSRS'
+                        + ' Hiscores API. Please try again.');
+                } else if (data != 'OK') {
+                    $('#player-update-result').html('Update failed.');
+                } else {
+                    $('#player-update-result').html('Player ' + player
+                        + ' has been updated.');
+                    updateRecords(recordSkillId);
+                    updateSkillTable();
+                    fetchUpdateTime();
+                    setTimeout(function() {
+                        $('#player-update-result').html('');
+                    }, 5000);
+                }
+            });
         },
         failure: function(data) {
             $('#player-update-result').html('Update failed.');
@@ -59,6 +68,34 @@ $('#player-update').click(function(evt) {
     });
 });
 
+/*
+ * Follow an update job, as returned by /tracker/updateplayer, until it
+ * finishes, then call done with its result code.
+ */
+var waitForUpdate = function(job, done) {
+    if (job.status == 'D' || job.status == 'F') {
+        done(job.result);
+        return;
+    }
+
+    setTimeout(function() {
+        $.ajax({
+            type: 'GET',
+            url: '/tracker/updatestatus',
+            data: {
+                job: job.job
+            },
+            dataType: 'json',
+            success: function(data) {
+                waitForUpdate(data, done);
+            },
+            error: function(data) {
+                done('-5');
+            }
+        });
+    }, UPDATE_POLL_INTERVAL);
+}
+
 $(document).ready(function(evt) {
     $('[data-toggle="tooltip"]').tooltip();
 });
@@ -1,5 +1,24 @@
 from django.apps import AppConfig
+from django.db import DatabaseError
+from django.db.models.signals import post_migrate
 
 
 class TrackerConfig(AppConfig):
     name = 'tracker'
+
+    def ready(self):
+        # Connect cache invalidation signal handlers.
+        import tracker.modules.ranks
+        import tracker.modules.skillrates
+        import tracker.modules.skillregistry
+
+        # Skills are loaded once at startup, unless the database has not
+        # been set up yet, in which case they are loaded on first use.
+        try:
+            tracker.modules.skillregistry.registry()
+        except DatabaseError:
+            pass
+
+        # Create the indexes which are not declared on the models.
+        from tracker.modules.indexes import create_indexes
+        post_migrate.connect(create_indexes, sender=self)
@@ -0,0 +1,84 @@
+#
+# tracker/management/commands/autotrack.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+import time
+from django.core.management.base import BaseCommand
+
+from tracker.models import TrackSchedule
+from tracker.modules import scheduler
+
+
+class Command(BaseCommand):
+    help = ('Queue automatic updates of tracked accounts as they fall due. '
+            'Accounts which gain experience are updated more often, down to '
+            'hourly; inactive ones less often, up to weekly. The queued '
+            'updates are processed by updateworker.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, metavar='SECONDS',
+                            help='keep running, scheduling every SECONDS')
+        parser.add_argument('--budget', type=int, default=600,
+                            help='automatic updates queued per hour')
+        parser.add_argument('--max-pending', type=int, default=500,
+                            help='queue no updates while this many jobs are '
+                                 'waiting')
+        parser.add_argument('--simulate', action='store_true',
+                            dest='simulate',
+                            help='compare adaptive and daily updates of '
+                                 'simulated accounts instead')
+        parser.add_argument('--accounts', type=int, default=1000,
+                            help='with --simulate, number of accounts')
+        parser.add_argument('--days', type=int, default=28,
+                            help='with --simulate, days simulated')
+
+    def handle(self, *args, **options):
+        if options['simulate']:
+            return self.simulate(options['accounts'], options['days'])
+
+        n = scheduler.seed_schedules()
+        if n:
+            self.stdout.write('Scheduled %d new accounts.' % n)
+
+        interval = options['loop'] or 3600
+        limit = max(options['budget'] * interval // 3600, 1)
+
+        while True:
+            start = time.time()
+            n = scheduler.schedule(limit, max_pending=options['max_pending'])
+            self.stdout.write('Queued %d automatic updates.' % n)
+
+            if not options['loop']:
+                break
+            time.sleep(max(options['loop'] - (time.time() - start), 0))
+
+    def simulate(self, accounts, days):
+        # A few very active accounts, some casual and many idle ones.
+        rng = random.Random(0)
+        profiles = [rng.choice([0.5, 0.1, 0.1, 0.01, 0.01, 0.001, 0.001,
+                                0.001, 0, 0])
+                    for _ in range(accounts)]
+
+        for name, kwargs in [
+                ('daily', {'interval': TrackSchedule.DEFAULT_INTERVAL}),
+                ('adaptive', {})]:
+            result = scheduler.simulate(profiles, hours=days * 24, **kwargs)
+            self.stdout.write('%s: %d requests (%d found no gain), '
+                              'gains recorded after %.1f hours on average'
+                              % (name, result['requests'],
+                                 result['unchanged'], result['staleness']))
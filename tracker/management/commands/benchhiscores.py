@@ -0,0 +1,51 @@
+#
+# tracker/management/commands/benchhiscores.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from django.core.management.base import BaseCommand
+
+from tracker.modules import osrsapi
+
+
+class Command(BaseCommand):
+    help = ('Measure hiscores lookup throughput. Point --url at a local stub '
+            'server rather than the real hiscores.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', required=True,
+                            help='base URL of the hiscores API to query')
+        parser.add_argument('--count', type=int, default=500,
+                            help='number of lookups to perform')
+        parser.add_argument('--workers', type=int, default=10,
+                            help='number of concurrent lookups')
+        parser.add_argument('--timeout', type=float, default=10)
+
+    def handle(self, *args, **options):
+        client = osrsapi.HiscoresClient(base_url=options['url'],
+                                        timeout=options['timeout'],
+                                        pool_size=options['workers'])
+        names = ['bench%d' % i for i in range(options['count'])]
+
+        start = time.time()
+        results = client.lookup_many(names, workers=options['workers'])
+        elapsed = time.time() - start
+
+        failed = sum(1 for r in results.values() if isinstance(r, Exception))
+        self.stdout.write('%d lookups (%d failed) in %.2fs: %.1f lookups/s'
+                          % (len(names), failed, elapsed,
+                             len(names) / elapsed))
@@ -0,0 +1,128 @@
+#
+# tracker/management/commands/benchlevels.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from tracker.models import *
+from tracker.modules import levelstorage
+
+
+class Command(BaseCommand):
+    help = ('Compare the cost of writing and reading skill level history '
+            'stored as SkillLevel rows and as packed arrays. Benchmark data '
+            'is written in a transaction which is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=20,
+                            help='number of benchmark accounts')
+        parser.add_argument('--points', type=int, default=500,
+                            help='datapoints per account')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='datapoints written per insert')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            accounts = [RSAccount(username='bench%d' % i, total_exp=0)
+                        for i in range(options['accounts'])]
+            RSAccount.objects.bulk_create(accounts)
+            points = [DataPoint(rsaccount=acc) for acc in accounts
+                      for _ in range(options['points'])]
+            DataPoint.objects.bulk_create(points)
+            levels = bench_levels(points)
+
+            for storage in [levelstorage.ROWS, levelstorage.COLUMNS]:
+                self.bench(storage, accounts, points, levels,
+                           options['batch_size'])
+
+            transaction.set_rollback(True)
+
+    def bench(self, storage, accounts, points, levels, batch_size):
+        """
+        Write the benchmark levels in a storage mode and read back the full
+        history of each account, reporting the time taken and space used.
+        """
+
+        step = batch_size * levelstorage.NUM_SKILLS
+        start = time.time()
+        for i in range(0, len(levels), step):
+            levelstorage.save(levels[i:i + step], storage=storage)
+        insert = time.time() - start
+
+        dp_ids = [dp.id for dp in points]
+        table = levelstorage.table(storage=storage)
+
+        with connection.cursor() as cursor:
+            start = time.time()
+            for acc in accounts:
+                cursor.execute('SELECT d.id, d.time, s.skill_id, \
+                                s.experience, s.rank, s.current_hours \
+                                FROM tracker_datapoint d \
+                                JOIN %s s ON s.datapoint_id = d.id \
+                                WHERE d.rsaccount_id = %%s \
+                                ORDER BY d.time, d.id, s.skill_id' % table,
+                               [acc.id])
+                cursor.fetchall()
+            read = time.time() - start
+
+            if storage == levelstorage.COLUMNS:
+                cursor.execute('SELECT sum(pg_column_size(p.*)) \
+                                FROM tracker_packedlevels p \
+                                WHERE p.datapoint_id = ANY(%s)', [dp_ids])
+            else:
+                cursor.execute('SELECT sum(pg_column_size(s.*)) \
+                                FROM tracker_skilllevel s \
+                                WHERE s.datapoint_id = ANY(%s)', [dp_ids])
+            size = cursor.fetchone()[0] or 0
+
+        self.stdout.write('%s: inserted %d datapoints in %.2fs (%.0f/s), '
+                          'read %d histories in %.2fs (%.1f ms each), '
+                          '%.1f bytes of row data per datapoint'
+                          % (storage, len(points), insert,
+                             len(points) / max(insert, 0.001), len(accounts),
+                             read, 1000 * read / max(len(accounts), 1),
+                             size / max(len(points), 1)))
+
+
+def bench_levels(points):
+    """
+    Build random, increasing skill levels for a list of datapoints, in order
+    of datapoint and skill ID.
+    """
+
+    levels = []
+    exp = {}
+
+    for dp in points:
+        acc_exp = exp.setdefault(dp.rsaccount_id,
+                                 [0] * levelstorage.NUM_SKILLS)
+        for skill_id in range(1, levelstorage.NUM_SKILLS):
+            acc_exp[skill_id] += random.randint(0, 20000)
+        acc_exp[0] = sum(acc_exp[1:])
+
+        for skill_id, e in enumerate(acc_exp):
+            hours = e / 50000.0
+            levels.append(SkillLevel(skill_id=skill_id, datapoint=dp,
+                                     experience=e,
+                                     rank=random.randint(1, 1000000),
+                                     current_hours=hours,
+                                     original_hours=hours))
+
+    return levels
@@ -0,0 +1,87 @@
+#
+# tracker/management/commands/benchparser.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import glob
+import os
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+
+from tracker.modules import osrsapi
+
+# Sample hiscores responses, with and without activity and boss lines.
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', '..', 'testdata',
+                        'hiscores')
+
+
+def split_lines(body):
+    """
+    Parse a response the way lookups did before `osrsapi.parse_hiscores`:
+    decode it, split it into lines and convert each line's fields in turn.
+    """
+
+    skills = []
+    for line in body.decode().split('\n')[:24]:
+        fields = line.split(',')
+        skills.append((int(fields[0]), int(fields[1]), int(fields[2])))
+    return skills
+
+
+class Command(BaseCommand):
+    help = ('Measure the time and memory taken to parse hiscores responses, '
+            'using the sample responses in tracker/testdata/hiscores unless '
+            'other files are given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help='files holding hiscores responses')
+        parser.add_argument('--count', type=int, default=20000,
+                            help='number of responses parsed')
+
+    def handle(self, *args, **options):
+        paths = options['files'] or sorted(glob.glob(os.path.join(FIXTURES,
+                                                                  '*.txt')))
+        if not paths:
+            raise CommandError('No responses to parse.')
+
+        bodies = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                bodies.append(f.read())
+        count = options['count']
+        batch = (bodies * (count // len(bodies) + 1))[:count]
+
+        for name, parse in [('lines', split_lines),
+                            ('parse_hiscores', osrsapi.parse_hiscores)]:
+            start = time.perf_counter()
+            for body in batch:
+                parse(body)
+            elapsed = time.perf_counter() - start
+
+            # Memory held by the parsed responses of the whole batch, as when
+            # a bulk update keeps them until its datapoints are written.
+            tracemalloc.start()
+            records = [parse(body) for body in batch]
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del records
+
+            self.stdout.write('%s: %d responses in %.3fs, %.1f us each, '
+                              '%d bytes held per response'
+                              % (name, count, elapsed, elapsed / count * 1e6,
+                                 held // count))
@@ -0,0 +1,63 @@
+#
+# tracker/management/commands/convertlevels.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+
+from tracker.models import DataPoint
+from tracker.modules import levelstorage
+
+
+class Command(BaseCommand):
+    help = ('Copy stored skill levels between SkillLevel rows and packed '
+            'per-datapoint arrays, one batch of datapoints per transaction. '
+            'Run it before changing TRACKER_LEVEL_STORAGE; it can be '
+            'interrupted and run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=[levelstorage.ROWS,
+                                             levelstorage.COLUMNS],
+                            default=levelstorage.COLUMNS,
+                            help='storage mode to convert to')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='datapoint IDs converted per transaction')
+        parser.add_argument('--delete', action='store_true',
+                            help='delete the levels from the old storage '
+                                 'once converted, after switching '
+                                 'TRACKER_LEVEL_STORAGE to the new mode')
+
+    def handle(self, *args, **options):
+        bounds = DataPoint.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            self.stdout.write('No datapoints to convert.')
+            return
+
+        batch_size = options['batch_size']
+        converted = 0
+
+        for start in range(bounds['first'], bounds['last'] + 1, batch_size):
+            with transaction.atomic():
+                converted += levelstorage.convert(options['to'], start,
+                                                  start + batch_size,
+                                                  delete=options['delete'])
+            self.stdout.write('Converted %d datapoints up to ID %d.'
+                              % (converted, start + batch_size - 1))
+
+        self.stdout.write('Converted %d datapoints to %s storage.'
+                          % (converted, options['to']))
@@ -0,0 +1,58 @@
+#
+# tracker/management/commands/downsample.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+
+from tracker.modules import retention
+
+
+class Command(BaseCommand):
+    help = ('Thin out datapoints beyond the retention age to one per account '
+            'per period of the retained resolution. Datapoints which start or '
+            'end a Record or Current entry are kept.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age-days', type=int,
+                            help='thin datapoints older than this many days '
+                                 '(default TRACKER_RETENTION_AGE)')
+        parser.add_argument('--resolution-hours', type=float,
+                            help='keep one datapoint in each period of this '
+                                 'many hours (default '
+                                 'TRACKER_RETENTION_RESOLUTION)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='accounts thinned per transaction')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='count the datapoints which would be deleted')
+
+    def handle(self, *args, **options):
+        kwargs = {
+            'batch_size': options['batch_size'],
+            'dry_run': options['dry_run'],
+        }
+        if options['age_days'] is not None:
+            kwargs['age'] = timedelta(days=options['age_days'])
+        if options['resolution_hours'] is not None:
+            kwargs['resolution'] = timedelta(hours=options['resolution_hours'])
+
+        start = time.time()
+        n = retention.downsample(**kwargs)
+        self.stdout.write('%s %d datapoints in %.2fs.'
+                          % ('Would delete' if options['dry_run']
+                             else 'Deleted', n, time.time() - start))
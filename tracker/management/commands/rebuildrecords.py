@@ -0,0 +1,91 @@
+#
+# tracker/management/commands/rebuildrecords.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import multiprocessing
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models.functions import Lower
+
+from tracker.models import RSAccount
+from tracker.modules import history, leaderboard, summary
+from tracker.modules.recalculate import Progress
+
+
+class Command(BaseCommand):
+    help = ('Rebuild Record and Current entries of accounts from their raw '
+            'datapoint history.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*',
+                            help='accounts to rebuild (default all)')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='only print the entries which would change')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='number of worker processes')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='number of accounts rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        accounts = RSAccount.objects.order_by('id')
+        if options['usernames']:
+            names = [u.lower() for u in options['usernames']]
+            accounts = accounts.annotate(lname=Lower('username')) \
+                               .filter(lname__in=names)
+        usernames = dict(accounts.values_list('id', 'username'))
+
+        acc_ids = sorted(usernames)
+        size = options['batch_size']
+        jobs = [(acc_ids[i:i + size], options['dry_run'])
+                for i in range(0, len(acc_ids), size)]
+
+        progress = Progress(len(acc_ids), 'rebuilt')
+        changes = 0
+
+        if options['processes'] > 1:
+            # Worker processes must not share the parent's connection.
+            connections.close_all()
+            pool = multiprocessing.Pool(options['processes'])
+            results = pool.imap_unordered(history.rebuild_job, jobs)
+        else:
+            pool = None
+            results = map(history.rebuild_job, jobs)
+
+        try:
+            for accounts, points, changed in results:
+                progress.update(points, accounts)
+                changes += len(changed)
+                if options['dry_run']:
+                    for change in changed:
+                        self.print_change(usernames, *change)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        progress.report()
+        if changes and not options['dry_run']:
+            leaderboard.refresh_all()
+            summary.rebuild_summaries()
+        self.stdout.write('%d entries %s.' % (changes, 'differ'
+                          if options['dry_run'] else 'updated'))
+
+    def print_change(self, usernames, model, acc_id, skill_id, period, old,
+                     new):
+        self.stdout.write('%s %s skill %d period %s: %s (%d-%d) -> %s (%d-%d)'
+                          % (model, usernames[acc_id], skill_id, period,
+                             old[0], old[1], old[2], new[0], new[1], new[2]))
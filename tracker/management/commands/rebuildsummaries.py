@@ -0,0 +1,31 @@
+#
+# tracker/management/commands/rebuildsummaries.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management.base import BaseCommand
+
+from tracker.modules import summary
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the account summaries served on player pages from each '
+            'account\'s datapoints and records. Summaries are kept up to '
+            'date by account updates once they exist.')
+
+    def handle(self, *args, **options):
+        n = summary.rebuild_summaries()
+        self.stdout.write('Rebuilt summaries of %d accounts.' % n)
@@ -0,0 +1,42 @@
+#
+# tracker/management/commands/rebuildvirtualstats.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management.base import BaseCommand
+
+from tracker.modules import virtualhiscores
+
+
+class Command(BaseCommand):
+    help = ('Recompute the virtual hiscores statistics of every account from '
+            'its latest datapoint. Statistics are kept up to date by account '
+            'updates once they exist; the anchors by which numbered pages '
+            'are found are not, and can be refreshed with --anchors.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--anchors', action='store_true',
+                            help='only refresh the page anchors')
+
+    def handle(self, *args, **options):
+        if options['anchors']:
+            virtualhiscores.refresh_anchors()
+            self.stdout.write('Refreshed virtual hiscores page anchors.')
+            return
+
+        n = virtualhiscores.rebuild_stats()
+        self.stdout.write('Rebuilt virtual hiscores statistics of %d '
+                          'accounts.' % n)
@@ -0,0 +1,45 @@
+#
+# tracker/management/commands/recalculatehours.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tracker.modules import recalculate
+
+
+class Command(BaseCommand):
+    help = ('Recalculate hours played in the given skills for every '
+            'datapoint after their experience rates have changed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('skill_ids', nargs='+', type=int,
+                            help='IDs of the skills whose rates changed')
+        parser.add_argument('--orig', action='store_true', dest='orig',
+                            help='also overwrite original hours')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='number of worker processes')
+        parser.add_argument('--checkpoint',
+                            help='checkpoint file used to resume a run')
+
+    def handle(self, *args, **options):
+        try:
+            recalculate.recalculate_hours(options['skill_ids'],
+                                          recalc_orig=options['orig'],
+                                          processes=options['processes'],
+                                          checkpoint=options['checkpoint'])
+        except recalculate.RecalculationError as e:
+            raise CommandError(str(e))
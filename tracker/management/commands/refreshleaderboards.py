@@ -0,0 +1,51 @@
+#
+# tracker/management/commands/refreshleaderboards.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from django.core.management.base import BaseCommand
+
+from tracker.models import Leaderboard
+from tracker.modules import leaderboard
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the leaderboard snapshots served on the records and '
+            'current top pages, and the anchors by which their numbered '
+            'pages are found. Snapshots are kept up to date by account '
+            'updates once they exist; anchors are not.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--board', choices=['records', 'current'],
+                            help='only rebuild one board')
+        parser.add_argument('--skill', type=int, action='append',
+                            dest='skills', metavar='SKILL_ID',
+                            help='only rebuild the given skills')
+
+    def handle(self, *args, **options):
+        kwargs = {}
+        if options['board'] == 'records':
+            kwargs['boards'] = [Leaderboard.RECORDS]
+        elif options['board'] == 'current':
+            kwargs['boards'] = [Leaderboard.CURRENT]
+        if options['skills']:
+            kwargs['skill_ids'] = options['skills']
+
+        start = time.time()
+        n = leaderboard.refresh_all(**kwargs)
+        self.stdout.write('Rebuilt %d leaderboards in %.2fs.'
+                          % (n, time.time() - start))
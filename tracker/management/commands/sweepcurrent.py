@@ -0,0 +1,65 @@
+#
+# tracker/management/commands/sweepcurrent.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from tracker.modules import sweeper
+
+
+class Command(BaseCommand):
+    help = ('Advance expired Current entries as day, week, month and year '
+            'boundaries pass.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, metavar='SECONDS',
+                            help='keep running, sweeping every SECONDS')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='accounts updated per transaction')
+        parser.add_argument('--status', action='store_true', dest='status',
+                            help='report how far behind the sweeper is')
+        parser.add_argument('--max-lag', type=float, metavar='SECONDS',
+                            help='with --status, fail if any period is '
+                                 'further behind than this')
+
+    def handle(self, *args, **options):
+        if options['status']:
+            return self.status(options['max_lag'])
+
+        while True:
+            start = time.time()
+            n = sweeper.sweep_current(batch_size=options['batch_size'])
+            self.stdout.write('Swept %d Current entries in %.2fs.'
+                              % (n, time.time() - start))
+
+            if not options['loop']:
+                break
+            time.sleep(max(options['loop'] - (time.time() - start), 0))
+
+    def status(self, max_lag):
+        lagging = []
+
+        for period, (count, lag) in sorted(sweeper.sweep_status().items()):
+            self.stdout.write('%s: %d expired entries, %.0fs behind'
+                              % (period, count, lag))
+            if max_lag is not None and lag > max_lag:
+                lagging.append(period)
+
+        if lagging:
+            raise CommandError('Sweeper is behind in periods %s.'
+                               % ', '.join(lagging))
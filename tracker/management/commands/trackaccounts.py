@@ -0,0 +1,90 @@
+#
+# tracker/management/commands/trackaccounts.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tracker.models import RSAccount
+from tracker.modules import accounttracker, osrsapi
+
+# Report messages for each error that can occur while tracking an account.
+ERROR_MESSAGES = [
+    (accounttracker.RecentUpdateError, 'updated less than 30s ago'),
+    (osrsapi.PlayerNotFoundError, 'not found on hiscores'),
+    (osrsapi.OsrsRequestError, 'could not reach hiscores'),
+    (accounttracker.InvalidUsernameError, 'invalid username'),
+    (accounttracker.TrackError, 'invalid hiscores data'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Update a list of accounts in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*',
+                            help='usernames of accounts to update')
+        parser.add_argument('--file', dest='file',
+                            help='read usernames from a file, one per line')
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help='update every tracked account')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='number of concurrent hiscores requests')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='number of accounts written per transaction')
+
+    def handle(self, *args, **options):
+        usernames = list(options['usernames'])
+
+        if options['file']:
+            with open(options['file']) as f:
+                usernames.extend(l.strip() for l in f if l.strip())
+
+        if options['all']:
+            usernames.extend(RSAccount.objects.values_list('username',
+                                                           flat=True))
+
+        if not usernames:
+            raise CommandError('No accounts to update.')
+
+        results = accounttracker.track_many(usernames,
+                                            workers=options['workers'],
+                                            batch_size=options['batch_size'])
+
+        updated = 0
+        unchanged = 0
+        errors = {}
+        for username, result in sorted(results.items()):
+            if result is None:
+                unchanged += 1
+                continue
+            if not isinstance(result, Exception):
+                updated += 1
+                continue
+
+            for error, msg in ERROR_MESSAGES:
+                if isinstance(result, error):
+                    break
+            else:
+                msg = 'unknown error'
+
+            errors.setdefault(msg, []).append(username)
+            self.stderr.write('%s: %s' % (username, msg))
+
+        self.stdout.write('%d of %d accounts updated, %d unchanged.'
+                          % (updated, len(results), unchanged))
+        for msg, names in sorted(errors.items()):
+            self.stdout.write('  %s: %d' % (msg, len(names)))
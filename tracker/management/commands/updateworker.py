@@ -0,0 +1,67 @@
+#
+# tracker/management/commands/updateworker.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+
+from tracker.modules import updatequeue
+
+
+class Command(BaseCommand):
+    help = ('Process queued account update requests. Any number of workers '
+            'may run at once; together they stay within the hiscores rate '
+            'limit.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1,
+                            help='seconds to wait when the queue is empty')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='jobs claimed at a time')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='concurrent hiscores requests')
+        parser.add_argument('--rate', type=int,
+                            help='hiscores lookups per minute across all '
+                                 'workers (default TRACKER_HISCORES_RATE)')
+        parser.add_argument('--timeout', type=int, default=300,
+                            help='seconds after which a running job is '
+                                 'assumed lost and requeued')
+        parser.add_argument('--once', action='store_true', dest='once',
+                            help='exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        timeout = timedelta(seconds=options['timeout'])
+        last_cleanup = 0
+
+        while True:
+            if time.time() - last_cleanup > options['timeout']:
+                updatequeue.requeue_stale(timeout)
+                updatequeue.purge(timedelta(days=1))
+                last_cleanup = time.time()
+
+            jobs = updatequeue.claim(options['batch_size'],
+                                     rate=options['rate'])
+            if jobs:
+                start = time.time()
+                updatequeue.run(jobs, workers=options['workers'])
+                self.stdout.write('Processed %d update jobs in %.2fs.'
+                                  % (len(jobs), time.time() - start))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['interval'])
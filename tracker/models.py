@@ -16,6 +16,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+from django.contrib.postgres.fields import ArrayField
 from django.db import models
 
 class RSAccount(models.Model):
@@ -25,6 +26,11 @@ class RSAccount(models.Model):
 
     username = models.CharField(max_length=12, db_index=True)
     total_exp = models.BigIntegerField(db_index=True)
+    # Time of the latest hiscores lookup of the account and a hash of the
+    # levels it found. Lookups finding the same levels as the account's
+    # latest datapoint do not add a new one.
+    last_checked = models.DateTimeField(null=True)
+    levels_hash = models.BigIntegerField(null=True)
 
     def __str__(self):
         return self.username
@@ -37,9 +43,17 @@ class DataPoint(models.Model):
 
     id = models.BigAutoField(primary_key=True)
     rsaccount = models.ForeignKey(RSAccount, on_delete=models.CASCADE,
-                                  db_index=True)
+                                  db_index=False)
     time = models.DateTimeField(auto_now_add=True, editable=False,
                                 db_index=True)
+    # Time of the last lookup which found this datapoint's levels, set by
+    # lookups finding them unchanged and once the account's next datapoint
+    # is written. Null means its own time.
+    last_checked = models.DateTimeField(null=True)
+
+    class Meta:
+        # Datapoints are looked up by account, ordered by time and ID.
+        index_together = (( 'rsaccount', 'time', 'id' ),)
 
     def __str__(self):
         return 'Datapoint: %s at %s' % (str(self.rsaccount), str(self.time))
@@ -69,19 +83,39 @@ class SkillLevel(models.Model):
     id = models.BigAutoField(primary_key=True)
     skill = models.ForeignKey(Skill, on_delete=models.CASCADE)
     datapoint = models.ForeignKey(DataPoint, on_delete=models.CASCADE,
-                                  db_index=True)
+                                  db_index=False)
     experience = models.BigIntegerField()
     rank = models.IntegerField()
     current_hours = models.FloatField()
     original_hours = models.FloatField()
 
     class Meta:
-        unique_together = (( 'skill', 'datapoint' ))
+        # Levels are looked up by datapoint, then skill.
+        unique_together = (( 'datapoint', 'skill' ))
 
     def __str__(self):
         return '%s: %d, %d' % (self.skill.skillname, self.experience, self.rank)
 
 
+class PackedLevels(models.Model):
+    """
+    The skill levels of a datapoint stored in a single row, as arrays indexed
+    by skill ID. Used instead of SkillLevel when TRACKER_LEVEL_STORAGE is
+    'columns'.
+    """
+
+    datapoint = models.OneToOneField(DataPoint, on_delete=models.CASCADE,
+                                     primary_key=True,
+                                     related_name='packed_levels')
+    experience = ArrayField(models.BigIntegerField())
+    rank = ArrayField(models.IntegerField())
+    current_hours = ArrayField(models.FloatField())
+    original_hours = ArrayField(models.FloatField())
+
+    def __str__(self):
+        return 'Levels at datapoint %d' % self.datapoint_id
+
+
 class Current(models.Model):
     """
     Current experience gain in a skill for a player within a time period: day,
@@ -101,17 +135,18 @@ class Current(models.Model):
     )
 
     rsaccount = models.ForeignKey(RSAccount, on_delete=models.CASCADE,
-                                  db_index=True)
+                                  db_index=False)
     skill = models.ForeignKey(Skill, on_delete=models.CASCADE)
     start = models.ForeignKey(DataPoint, on_delete=models.CASCADE,
                               db_index=True, related_name='+')
     end = models.ForeignKey(DataPoint, on_delete=models.CASCADE,
                             db_index=True, related_name='+')
-    experience = models.BigIntegerField(db_index=True)
-    period = models.CharField(max_length=1, choices=PERIOD_CHOICES, db_index=True)
+    experience = models.BigIntegerField()
+    period = models.CharField(max_length=1, choices=PERIOD_CHOICES)
     hours = models.FloatField()
 
     class Meta:
+        # Entries are ranked by the partial indexes in `modules.indexes`.
         unique_together = (( 'rsaccount', 'skill', 'period' ))
 
     def __str__(self):
@@ -150,17 +185,18 @@ class Record(models.Model):
     )
 
     rsaccount = models.ForeignKey(RSAccount, on_delete=models.CASCADE,
-                                  db_index=True)
+                                  db_index=False)
     skill = models.ForeignKey(Skill, on_delete=models.CASCADE)
     start = models.ForeignKey(DataPoint, on_delete=models.CASCADE,
                               db_index=True, related_name='+')
     end = models.ForeignKey(DataPoint, on_delete=models.CASCADE,
                             db_index=True, related_name='+')
-    experience = models.BigIntegerField(db_index=True)
-    period = models.CharField(max_length=1, choices=PERIOD_CHOICES, db_index=True)
+    experience = models.BigIntegerField()
+    period = models.CharField(max_length=1, choices=PERIOD_CHOICES)
     hours = models.FloatField()
 
     class Meta:
+        # Entries are ranked by the partial indexes in `modules.indexes`.
         unique_together = (( 'rsaccount', 'skill', 'period' ))
 
     def __str__(self):
@@ -210,3 +246,224 @@ class TimePlayedRank(models.Model):
 
     def __str__(self):
         return 'datapoint %d: rank %d' % (self.datapoint_id, self.rank)
+
+
+class Leaderboard(models.Model):
+    """
+    Header of a precomputed ranking of the top Record or Current entries in a
+    skill and period. Stores the number of ranked entries and the value of the
+    lowest one, which an entry has to reach to enter the ranking.
+    """
+
+    RECORDS = 'R'
+    CURRENT = 'C'
+    BOARD_CHOICES = (
+        (RECORDS, 'Records'),
+        (CURRENT, 'Current'),
+    )
+
+    board = models.CharField(max_length=1, choices=BOARD_CHOICES)
+    skill_id = models.PositiveSmallIntegerField()
+    period = models.CharField(max_length=1)
+    size = models.IntegerField(default=0)
+    min_value = models.FloatField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (( 'board', 'skill_id', 'period' ))
+
+    def __str__(self):
+        return '%s leaderboard: skill %d period %s, %d entries' \
+               % (self.get_board_display(), self.skill_id, self.period,
+                  self.size)
+
+
+class LeaderboardEntry(models.Model):
+    """
+    A single ranked row of a Leaderboard. Holds a copy of everything needed to
+    display it so that leaderboard pages are read from this table alone.
+    """
+
+    board = models.CharField(max_length=1,
+                             choices=Leaderboard.BOARD_CHOICES)
+    skill_id = models.PositiveSmallIntegerField()
+    period = models.CharField(max_length=1)
+    rank = models.IntegerField()
+    rsaccount_id = models.IntegerField(db_index=True)
+    username = models.CharField(max_length=12)
+    experience = models.BigIntegerField()
+    hours = models.FloatField()
+    start_id = models.BigIntegerField()
+    end_id = models.BigIntegerField()
+    entry_id = models.IntegerField()
+
+    class Meta:
+        unique_together = (( 'board', 'skill_id', 'period', 'rank' ))
+
+    def __str__(self):
+        return '%s %d %s #%d: %s' % (self.board, self.skill_id, self.period,
+                                     self.rank, self.username)
+
+
+class VirtualStats(models.Model):
+    """
+    Statistics derived from an account's latest levels which are ranked on
+    the virtual hiscores: total experience, number of skills at level 99 and
+    at 200m experience, and experience in the account's lowest skill.
+    """
+
+    rsaccount = models.OneToOneField(RSAccount, on_delete=models.CASCADE,
+                                     primary_key=True)
+    username = models.CharField(max_length=12)
+    total_exp = models.BigIntegerField()
+    num_99s = models.PositiveSmallIntegerField()
+    num_200m = models.PositiveSmallIntegerField()
+    lowest_exp = models.BigIntegerField()
+
+    class Meta:
+        index_together = (
+            ( 'total_exp', 'rsaccount' ),
+            ( 'num_99s', 'rsaccount' ),
+            ( 'num_200m', 'rsaccount' ),
+            ( 'lowest_exp', 'rsaccount' ),
+        )
+
+    def __str__(self):
+        return '%s: %d 99s, %d 200m' % (self.username, self.num_99s,
+                                        self.num_200m)
+
+
+class PageAnchor(models.Model):
+    """
+    The (value, ID) cursor of one of every few entries of a ranked table, a
+    leaderboard or a virtual hiscores type. Numbered pages are read by keyset
+    from the anchor preceding them, without counting the entries above it.
+    """
+
+    ranking = models.CharField(max_length=16)
+    page = models.IntegerField()
+    value = models.FloatField()
+    entry_id = models.IntegerField()
+
+    class Meta:
+        unique_together = (( 'ranking', 'page' ))
+
+    def __str__(self):
+        return '%s anchor %d: %r:%d' % (self.ranking, self.page,
+                                        self.value, self.entry_id)
+
+
+class AccountSummary(models.Model):
+    """
+    Copy of the data shown on an account's player page, rewritten with each
+    datapoint: the account's latest levels in every skill, stored as arrays
+    indexed by skill ID, the times of its first and latest datapoints and its
+    Overall records in each period, packed as (experience, start ID, end ID)
+    triples for the day, week, month and year.
+    """
+
+    rsaccount = models.OneToOneField(RSAccount, on_delete=models.CASCADE,
+                                     primary_key=True, related_name='summary')
+    first_update = models.DateTimeField()
+    last_update = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    experience = ArrayField(models.BigIntegerField())
+    rank = ArrayField(models.IntegerField())
+    hours = ArrayField(models.FloatField())
+    records = ArrayField(models.BigIntegerField())
+
+    # Periods of the packed records, in order.
+    RECORD_PERIODS = 'DWMY'
+
+    def __str__(self):
+        return 'Summary of %s at %s' % (self.rsaccount_id, self.last_update)
+
+    def level_rows(self):
+        """
+        Return the latest levels as (datapoint ID, time, skill ID, experience,
+        rank, hours) rows.
+        """
+
+        return [(self.last_id, self.last_update, i, e, r, h)
+                for i, (e, r, h) in enumerate(zip(self.experience, self.rank,
+                                                  self.hours))]
+
+    def overall_records(self):
+        """
+        Return the (experience, start ID, end ID) of the Overall record in
+        each of the periods in RECORD_PERIODS.
+        """
+
+        return [tuple(self.records[i:i + 3])
+                for i in range(0, len(self.records), 3)]
+
+
+class UpdateJob(models.Model):
+    """
+    A request to update an account, queued by the update view and processed
+    by an update worker. Requests for an account which already has a queued
+    or running job are coalesced into it.
+    """
+
+    QUEUED = 'Q'
+    RUNNING = 'R'
+    DONE = 'D'
+    FAILED = 'F'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    username = models.CharField(max_length=12)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    # Response code of the update view: 'OK', or a negative error code.
+    result = models.CharField(max_length=2, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, db_index=True)
+    finished = models.DateTimeField(null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        # Workers claim queued jobs in order.
+        index_together = (( 'status', 'id' ),)
+
+    def __str__(self):
+        return 'Update of %s: %s' % (self.username, self.get_status_display())
+
+
+class TrackSchedule(models.Model):
+    """
+    When an account is next updated automatically. The interval between
+    updates halves each time an update finds experience gained since the
+    previous one, and doubles each time it finds none, within bounds.
+    """
+
+    # Bounds of the update interval, in seconds.
+    DEFAULT_INTERVAL = 86400
+    MIN_INTERVAL = 3600
+    MAX_INTERVAL = 604800
+
+    rsaccount = models.OneToOneField(RSAccount, on_delete=models.CASCADE,
+                                     primary_key=True)
+    update_interval = models.IntegerField()
+    next_update = models.DateTimeField(db_index=True)
+    # Overall experience gained between the account's last two datapoints.
+    last_gain = models.BigIntegerField(null=True)
+
+    def __str__(self):
+        return 'Update %s every %ds' % (self.rsaccount_id,
+                                        self.update_interval)
+
+    @staticmethod
+    def next_interval(interval, gained):
+        """
+        Return the interval following `interval` after an update which did
+        or did not find experience gained.
+        """
+
+        interval = interval // 2 if gained else interval * 2
+        return min(max(interval, TrackSchedule.MIN_INTERVAL),
+                   TrackSchedule.MAX_INTERVAL)
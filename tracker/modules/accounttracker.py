@@ -16,20 +16,65 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import hashlib
 import re
 from django.db import connection, transaction
-from django.db.models import Sum
+from django.db.models import Max, Sum
+from django.db.models.functions import Lower
 from django.utils import timezone
 from datetime import timedelta
 
 from tracker.models import *
 from tracker.modules.osrsapi import *
+from tracker.modules import leaderboard, levelstorage, pagecache, ranks, \
+    skillrates, skillregistry, summary, virtualhiscores
+
+# Current periods in the order of `get_period_firsts` entries 1 to 4.
+CURRENT_PERIODS = [Current.DAY, Current.WEEK, Current.MONTH, Current.YEAR]
+
+# Namespace of the advisory locks taken on accounts by `lock_accounts`.
+ACCOUNT_LOCK = 1
+
+# Lengths of the five record periods in the order of `get_period_firsts`.
+PERIOD_LENGTHS = [
+    timedelta(seconds=300),
+    timedelta(days=1),
+    timedelta(days=7),
+    timedelta(days=31),
+    timedelta(days=365),
+]
+
+# Lengths of the periods which can be viewed on a player page.
+RANGE_LENGTHS = {
+    'day': timedelta(days=1),
+    'week': timedelta(days=7),
+    'month': timedelta(days=31),
+    'year': timedelta(days=365),
+}
+
+# Subquery selecting the (ID, time) of the datapoint which opens a period
+# starting at `since` for account `acc`, both SQL expressions. It is the first
+# datapoint whose levels were found by a lookup within the period: the latest
+# datapoint before the period if it was last checked within it, or else the
+# first datapoint in the period. Each side is a single index probe.
+PERIOD_START = '(SELECT b.id, b.time FROM ( \
+                    (SELECT id, time, last_checked FROM tracker_datapoint \
+                     WHERE rsaccount_id = %(acc)s AND time < %(since)s \
+                     ORDER BY time DESC LIMIT 1) \
+                    UNION ALL \
+                    (SELECT id, time, last_checked FROM tracker_datapoint \
+                     WHERE rsaccount_id = %(acc)s AND time >= %(since)s \
+                     ORDER BY time LIMIT 1) \
+                 ) AS b WHERE COALESCE(b.last_checked, b.time) >= %(since)s \
+                 ORDER BY b.time LIMIT 1)'
 
 
 def track(username):
     """
     Look up player on the OSRS hiscores and add a new datapoint
-    with their current levels and ranks.
+    with their current levels and ranks. If they are the same as at the
+    player's latest datapoint, only the time of the lookup is recorded and
+    None is returned.
 
     Arguments:
         username (str) - username of the player to look up
@@ -40,512 +85,796 @@ def track(username):
     if not re.fullmatch(r'^[a-zA-Z0-9_]{1,12}$', username):
         raise InvalidUsernameError
 
+    accounts = {}
     try:
         acc = RSAccount.objects.get(username__iexact=username)
-        first = False
+        accounts[username.lower()] = acc
     except RSAccount.DoesNotExist:
         print('Tracking %s for the first time.' % username)
-        acc = RSAccount(username=username, total_exp=0)
-        first = True
+        acc = None
 
     # Check if the user has been updated recently.
-    try:
-        last = DataPoint.objects.filter(rsaccount=acc).order_by('-time')[0]
-        if timezone.now() < last.time + timedelta(seconds=30):
+    if acc:
+        last = last_checked(acc)
+        if last and timezone.now() < last + timedelta(seconds=30):
             print('Account %s was updated less than 30s ago.' % username)
             raise RecentUpdateError
-    except IndexError:
-        pass
+
+    try:
+        skills = parse_skills(hiscore_lookup(username))
+    except HiscoresFormatError:
+        raise TrackError
 
     # Of course, we want the whole datapoint to be added atomically.
     with transaction.atomic():
-        acc.save()
-
-        dp = DataPoint(rsaccount=acc)
-        dp.save()
+        dp = __track_batch([(username, skills)], accounts)[0]
 
-        # Create current and record entries first time account is tracked.
-        if first:
-            create_records(acc, dp)
-            TimePlayed.objects.create(rsaccount=acc, hours=0)
+    if dp is None:
+        print('Account %s has not changed.' % username)
+    else:
+        print('Account %s has been updated.' % username)
+    return dp
 
-        periods = get_period_firsts(acc, timezone.now())
-        skills = hiscore_lookup(username)
-        total_hours = 0
 
-        # Add a SkillLevel entry for each skill using hiscore data.
-        i = len(skills) - 1
-        while i >= 0:
-            fields = skills[i].split(',')
-            if len(fields) != 3:
-                raise TrackError
+def track_many(usernames, **kwargs):
+    """
+    Look up a batch of players on the OSRS hiscores concurrently and add a new
+    datapoint for each of them. Rows are written with bulk inserts and the
+    Current and Record entries of every account in a batch are updated
+    together, one transaction per batch.
 
-            if (fields[2] == '-1'):
-                exp = 0
-            else:
-                exp = int(fields[2])
+    Arguments:
+        usernames (list of str) - usernames of the players to look up
+        workers (int) - number of concurrent hiscores requests (default 8)
+        batch_size (int) - number of accounts written per transaction
+        (default 100)
+
+    Returns a dictionary mapping each username to the new DataPoint for the
+    account, None if its levels had not changed, or the exception which
+    prevented it from being tracked.
+    """
+
+    workers = kwargs.get('workers', 8)
+    batch_size = kwargs.get('batch_size', 100)
+
+    results = {}
+    names = {}
+    for username in usernames:
+        if not re.fullmatch(r'^[a-zA-Z0-9_]{1,12}$', username):
+            results[username] = InvalidUsernameError()
+        elif username.lower() not in names:
+            names[username.lower()] = username
+
+    print('Processing bulk update request for %d accounts.' % len(names))
+
+    accounts = {}
+    for acc in RSAccount.objects.annotate(lname=Lower('username')) \
+                                .filter(lname__in=list(names)):
+        accounts[acc.username.lower()] = acc
+
+    # Skip accounts which have been updated within the last 30s. Accounts
+    # without a recorded lookup time fall back to their latest datapoint.
+    recent = timezone.now() - timedelta(seconds=30)
+    recent_ids = set(acc.id for acc in accounts.values()
+                     if acc.last_checked and acc.last_checked > recent)
+    unchecked = [acc for acc in accounts.values() if not acc.last_checked]
+    if unchecked:
+        last = DataPoint.objects.filter(rsaccount__in=unchecked) \
+                                .values('rsaccount_id') \
+                                .annotate(last=Max('time')) \
+                                .filter(last__gt=recent)
+        recent_ids.update(l['rsaccount_id'] for l in last)
+    for lname, acc in accounts.items():
+        if acc.id in recent_ids:
+            results[names.pop(lname)] = RecentUpdateError()
+
+    fetched = hiscores_client().lookup_many(names.values(), workers=workers)
+
+    tracked = []
+    for username, record in fetched.items():
+        if isinstance(record, HiscoresFormatError):
+            results[username] = TrackError()
+            continue
+        if isinstance(record, Exception):
+            results[username] = record
+            continue
 
-            # SkillLevel for Overall holds total hours at this datapoint.
-            if i == 0:
-                hours = total_hours
-            else:
-                hours = calculate_hours(i, exp)
-                total_hours += hours
+        try:
+            tracked.append((username, parse_skills(record)))
+        except TrackError as e:
+            results[username] = e
+
+    for i in range(0, len(tracked), batch_size):
+        batch = tracked[i:i + batch_size]
+        with transaction.atomic():
+            points = __track_batch(batch, accounts)
+        for (username, _), dp in zip(batch, points):
+            results[username] = dp
+
+    unchanged = sum(1 for dp in results.values() if dp is None)
+    updated = sum(1 for dp in results.values()
+                  if dp is not None and not isinstance(dp, Exception))
+    print('Bulk update complete: %d of %d accounts updated, %d unchanged.'
+          % (updated, len(results), unchanged))
+    return results
+
+
+def __track_batch(batch, accounts):
+    """
+    Write a new datapoint for each (username, skills) pair in `batch` and
+    update all entries derived from it. Accounts missing from `accounts`
+    (keyed by lowercase username) are created. Accounts whose levels are the
+    same as at their latest datapoint only have their lookup time and update
+    schedule refreshed. Must be called inside a transaction. Return the new
+    datapoints in order, with None for the unchanged accounts.
+    """
+
+    now = timezone.now()
+    changed = []
+    unchanged = []
+    for username, skills in batch:
+        acc = accounts.get(username.lower())
+        if acc is not None and acc.levels_hash == levels_hash(skills):
+            unchanged.append(acc)
+        else:
+            changed.append((username, skills))
 
-            s = SkillLevel(skill_id=i, datapoint=dp,
-                           experience=exp, rank=int(fields[0]),
-                           current_hours=hours, original_hours=hours)
-            s.save()
-            update_current(acc, dp, s, periods)
-            if (periods[0] != None):
-                update_five_min(acc, dp, s, periods[0])
+    if unchanged:
+        acc_ids = [acc.id for acc in unchanged]
+        # The lookup also found the levels of each account's latest
+        # datapoint, which opens periods starting after that datapoint's
+        # time (see PERIOD_START).
+        with connection.cursor() as cursor:
+            cursor.execute('WITH latest AS ( \
+                                UPDATE tracker_datapoint d \
+                                SET last_checked = %s \
+                                FROM tracker_rsaccount a CROSS JOIN LATERAL ( \
+                                    SELECT id FROM tracker_datapoint \
+                                    WHERE rsaccount_id = a.id \
+                                    ORDER BY time DESC LIMIT 1 \
+                                ) AS l \
+                                WHERE a.id = ANY(%s) AND d.id = l.id \
+                            ) \
+                            UPDATE tracker_rsaccount SET last_checked = %s \
+                            WHERE id = ANY(%s)', [now, acc_ids] * 2)
+        update_schedules(acc_ids, [0] * len(acc_ids))
+        for acc in unchanged:
+            acc.last_checked = now
+
+    points = iter(__write_datapoints(changed, accounts, now)
+                  if changed else [])
+
+    # Every player page shows its lookup time; virtual hiscores change
+    # with new datapoints.
+    pagecache.bump([pagecache.account_key(username) for username, _ in batch]
+                   + ([pagecache.VIRTUAL_KEY] if changed else []))
+
+    unchanged_ids = set(acc.id for acc in unchanged)
+    return [None if username.lower() in accounts
+            and accounts[username.lower()].id in unchanged_ids
+            else next(points) for username, _ in batch]
+
+
+def __write_datapoints(batch, accounts, now):
+    """
+    Write a new datapoint for each (username, skills) pair in `batch`, looked
+    up at `now`, and update all entries derived from it. See `__track_batch`.
+    """
+
+    new_accounts = []
+    batch_accounts = []
+    gains = []
+    for username, skills in batch:
+        try:
+            acc = accounts[username.lower()]
+            gains.append(skills[0][1] - acc.total_exp)
+        except KeyError:
+            acc = RSAccount(username=username, total_exp=0)
+            new_accounts.append(acc)
+            gains.append(None)
+        acc.total_exp = skills[0][1]
+        acc.last_checked = now
+        acc.levels_hash = levels_hash(skills)
+        batch_accounts.append(acc)
+
+    lock_accounts([acc.id for acc in batch_accounts if acc.id is not None])
+    RSAccount.objects.bulk_create(new_accounts)
+
+    points = [DataPoint(rsaccount=acc) for acc in batch_accounts]
+    DataPoint.objects.bulk_create(points)
+
+    new_ids = set(acc.id for acc in new_accounts)
+    all_skills = skillregistry.skills(include_qha=True)
+    # Hours played in each skill are calculated for the whole batch at once.
+    batch_hours = [[0] * len(batch)]
+    for i in range(1, 24):
+        batch_hours.append(skillrates.hours_many(i, [s[i][1]
+                                                     for _, s in batch]))
+
+    currents = []
+    records = []
+    levels = []
+    total_hours = []
+    for j, (acc, dp, (_, skills)) in enumerate(zip(batch_accounts, points,
+                                                   batch)):
+        if acc.id in new_ids:
+            c, r = record_entries(acc, dp, all_skills)
+            currents.extend(c)
+            records.extend(r)
+
+        lvls, hours = skill_levels(dp, skills, [float(h[j])
+                                                for h in batch_hours])
+        levels.extend(lvls)
+        total_hours.append(hours)
+
+    # The rank index is loaded before this batch's hours are written so that
+    # it holds the old hours of its accounts.
+    index = ranks.time_played()
+
+    Current.objects.bulk_create(currents)
+    Record.objects.bulk_create(records)
+    TimePlayed.objects.bulk_create([TimePlayed(rsaccount=acc, hours=0)
+                                    for acc in new_accounts])
+    levelstorage.save(levels)
+    virtualhiscores.update_stats(batch_accounts, [s for _, s in batch])
+
+    acc_ids = [acc.id for acc in batch_accounts]
+    values = ', '.join(['(%s, %s)'] * len(batch_accounts))
+
+    with connection.cursor() as cursor:
+        params = []
+        for acc in batch_accounts:
+            params.extend([acc.id, acc.total_exp, acc.levels_hash])
+        # The time of each account's previous lookup is kept on its previous
+        # datapoint, whose levels it found, to open periods (see
+        # PERIOD_START).
+        cursor.execute('WITH previous AS ( \
+                            UPDATE tracker_datapoint d \
+                            SET last_checked = a.last_checked \
+                            FROM tracker_rsaccount a CROSS JOIN LATERAL ( \
+                                SELECT id FROM tracker_datapoint \
+                                WHERE rsaccount_id = a.id \
+                                AND id <> ALL(%%s) \
+                                ORDER BY time DESC LIMIT 1 \
+                            ) AS l \
+                            WHERE a.id = ANY(%%s) AND d.id = l.id \
+                        ) \
+                        UPDATE tracker_rsaccount a \
+                        SET total_exp = v.total_exp, \
+                        levels_hash = v.levels_hash, last_checked = %%s \
+                        FROM (VALUES %s) AS v (id, total_exp, levels_hash) \
+                        WHERE a.id = v.id'
+                       % ', '.join(['(%s, %s, %s)'] * len(batch_accounts)),
+                       [[dp.id for dp in points], acc_ids, now] + params)
+
+        params = []
+        for acc_id, hours in zip(acc_ids, total_hours):
+            params.extend([acc_id, hours])
+        cursor.execute('UPDATE tracker_timeplayed t SET hours = v.hours \
+                        FROM (VALUES %s) AS v (rsaccount_id, hours), \
+                        tracker_timeplayed o \
+                        WHERE t.rsaccount_id = v.rsaccount_id \
+                        AND o.id = t.id \
+                        RETURNING t.rsaccount_id, o.hours' % values, params)
+        old_hours = dict(cursor.fetchall())
+
+    # Accounts created in this batch are not in the index yet.
+    changes = [(None if acc_id in new_ids else old_hours[acc_id], hours)
+               for acc_id, hours in zip(acc_ids, total_hours)]
+    rank_list = ranks.ranks_after(index, changes)
+    transaction.on_commit(lambda: ranks.time_played_changed(changes))
+
+    TimePlayedRank.objects.bulk_create([TimePlayedRank(datapoint=dp, rank=r)
+                                        for dp, r in zip(points, rank_list)])
+
+    earliest = get_period_boundaries(acc_ids, timezone.now())
+    changed = update_current_records([(acc.id, dp.id, earliest[acc.id])
+                                      for acc, dp in zip(batch_accounts,
+                                                         points)])
+    leaderboard.update_accounts([acc.id for acc in batch_accounts], changed)
+    summary.update_summaries(points, levels)
+    update_schedules(acc_ids, gains)
 
-            i -= 1
+    return points
 
-        # `s` at this point is the Overall skill
-        acc.total_exp = s.experience
-        acc.save()
 
-        update_time_played(acc, dp, total_hours, periods)
-        tp = TimePlayed.objects.get(rsaccount=acc)
-        tp.hours = total_hours
-        tp.save()
+def parse_skills(record):
+    """
+    Convert a parsed hiscores response (see `osrsapi.parse_hiscores`) into a
+    list of (rank, experience) tuples indexed by skill ID. Unranked skills
+    have 0 experience.
+    """
 
-        # compute and save time played rank
-        rank = TimePlayed.objects.filter(hours__gte=total_hours).count()
-        TimePlayedRank.objects.create(datapoint=dp, rank=rank)
+    if len(record) != 3 * NUM_SKILLS:
+        raise TrackError
 
-    print('Account %s has been updated.' % username)
-    return dp
+    return [(record[i], max(record[i + 2], 0))
+            for i in range(0, len(record), 3)]
 
 
-def update_current(acc, datapoint, sklvl, earliest):
+def levels_hash(skills):
+    """
+    Return a 64-bit hash of parsed hiscores data (see `parse_skills`), which
+    is stored on an account to detect lookups finding unchanged levels.
     """
-    Update the current experience gains (and records, if necessary)
-    for player acc for a single skill.
-
-    Arguments:
-        acc (RSAccount) - the player to update
-        datapoint (DataPoint) - the most recent datapoint for the player
-        sklvl (SkillLevel) - the skilllevel entry at the above datapoint
-        for the skill to update
-        earliest (list of DataPoint) - earliest datapoints for acc within
-        all four periods (see `get_period_firsts`)
-    """
-
-    curr = Current.objects.filter(rsaccount=acc, skill_id=sklvl.skill_id)
-
-    for c in curr:
-        # For each Current entry, find the entry for the same skill
-        # corresponding to the first datapoint in that time period and check if
-        # the player has gained xp since then.
-        if c.period == Current.DAY:
-            first = earliest[1]
-        elif c.period == Current.WEEK:
-            first = earliest[2]
-        elif c.period == Current.MONTH:
-            first = earliest[3]
-        elif c.period == Current.YEAR:
-            first = earliest[4]
-
-        if first != None:
-            s = SkillLevel.objects.get(datapoint=first, skill_id=sklvl.skill_id)
-            c.start = first
-            c.end = datapoint
-            c.experience = sklvl.experience - s.experience
-        else:
-            c.start = datapoint
-            c.end = datapoint
-            c.experience = 0
-
-        # Now, check if their current xp beats their record for the given skill
-        # and time period. Update record if so.
-        rec = Record.objects.get(rsaccount=acc, skill_id=sklvl.skill_id,
-                                 period=c.period)
-        if c.experience > rec.experience:
-            rec.start = c.start
-            rec.end = c.end
-            rec.experience = c.experience
-            rec.save()
 
-        c.save()
+    digest = hashlib.sha1(repr(list(skills)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
 
 
-def update_five_min(acc, datapoint, sklvl, first):
+def skill_levels(datapoint, skills, hours):
     """
-    Check and update the five minute record for a player and skill.
+    Build the (unsaved) SkillLevel entries for a datapoint from parsed hiscore
+    data. Return the entries and the total hours played at the datapoint.
 
     Arguments:
-        acc (RSAccount) - player to update.
-        datapoint (DataPoint) - most recent data point for the player.
-        sklvl (SkillLevel) - SkillLevel entry at the above datapoint for the
-        skill to update.
-        first (DataPoint) - earliest data point for player within
-        five minutes of `datapoint`. Cannot be None.
+        datapoint (DataPoint) - the datapoint the entries belong to
+        skills (list of tuples) - parsed hiscores data (see `parse_skills`)
+        hours (list of float) - hours played in each skill; the entry for
+        Overall is ignored
     """
 
-    s = SkillLevel.objects.get(datapoint=first, skill_id=sklvl.skill_id)
-    dx = sklvl.experience - s.experience
-    rec = Record.objects.get(rsaccount=acc, skill_id=sklvl.skill_id,
-                             period=Record.FIVE_MIN)
+    levels = []
+    total_hours = 0
 
-    if dx > rec.experience:
-        rec.start = first
-        rec.end = datapoint
-        rec.experience = dx
-        rec.save()
+    for i, (rank, exp) in enumerate(skills):
+        if i == 0:
+            continue
+        total_hours += hours[i]
+        levels.append(SkillLevel(skill_id=i, datapoint=datapoint,
+                                 experience=exp, rank=rank,
+                                 current_hours=hours[i],
+                                 original_hours=hours[i]))
 
+    # SkillLevel for Overall holds total hours at this datapoint.
+    rank, exp = skills[0]
+    levels.insert(0, SkillLevel(skill_id=0, datapoint=datapoint,
+                                experience=exp, rank=rank,
+                                current_hours=total_hours,
+                                original_hours=total_hours))
 
-def update_time_played(acc, datapoint, hours, earliest):
-    """
-    Update the Current and Record entires for player acc in QHA and
-    Original QHA.
+    return levels, total_hours
+
+
+def update_current_records(entries):
     """
+    Update the Current and Record entries in every skill and period for a set
+    of accounts from their newest datapoints using set-based statements.
 
-    curr = Current.objects.filter(rsaccount=acc, skill_id=Skill.QHA_ID)
+    Arguments:
+        entries (list of tuples) - (account ID, datapoint ID, period firsts)
+        for each account to update, where period firsts is the list of earliest
+        datapoints returned by `get_period_firsts`
+
+    Returns a list of the IDs of the Record entries which were beaten.
+    """
+
+    if not entries:
+        return []
+
+    current_rows = []
+    fivemin_rows = []
+    acc_ids = []
+
+    for acc_id, dp_id, earliest in entries:
+        ids = [dp.id if dp is not None else dp_id for dp in earliest]
+        fivemin_rows.extend([acc_id, ids[0], dp_id])
+        for period, start_id in zip(CURRENT_PERIODS, ids[1:]):
+            current_rows.extend([acc_id, period, start_id, dp_id])
+        acc_ids.append(acc_id)
+
+    acc_ids = tuple(acc_ids)
+    table = levelstorage.table()
+    beaten = []
+    current_values = ', '.join(['(%s, %s, %s, %s)'] * (len(entries) * 4))
+    fivemin_values = ', '.join(['(%s, %s, %s)'] * len(entries))
+
+    with connection.cursor() as cursor:
+        # Experience gains in each skill and hours gained (QHA, calculated
+        # from the hours stored in Overall) within the current periods.
+        cursor.execute('UPDATE tracker_current c \
+                        SET start_id = b.start_id, end_id = b.end_id, \
+                        experience = CASE WHEN c.skill_id = %%s \
+                            THEN c.experience \
+                            ELSE e.experience - s.experience END, \
+                        hours = CASE WHEN c.skill_id = %%s \
+                            THEN e.current_hours - s.current_hours \
+                            ELSE c.hours END \
+                        FROM (VALUES %s) AS b (rsaccount_id, period, \
+                                               start_id, end_id), \
+                        %s s, %s e \
+                        WHERE c.rsaccount_id = b.rsaccount_id \
+                        AND c.period = b.period \
+                        AND s.datapoint_id = b.start_id \
+                        AND e.datapoint_id = b.end_id \
+                        AND s.skill_id = CASE WHEN c.skill_id = %%s \
+                            THEN 0 ELSE c.skill_id END \
+                        AND e.skill_id = s.skill_id'
+                       % (current_values, table, table),
+                       [Skill.QHA_ID, Skill.QHA_ID] + current_rows
+                       + [Skill.QHA_ID])
+
+        # Current gains which beat the corresponding records.
+        cursor.execute('UPDATE tracker_record r \
+                        SET start_id = c.start_id, end_id = c.end_id, \
+                        experience = c.experience \
+                        FROM tracker_current c \
+                        WHERE r.rsaccount_id IN %s \
+                        AND c.rsaccount_id = r.rsaccount_id \
+                        AND c.skill_id = r.skill_id AND c.period = r.period \
+                        AND r.skill_id < %s \
+                        AND c.experience > r.experience \
+                        RETURNING r.id',
+                       [acc_ids, Skill.QHA_ID])
+        beaten.extend(r[0] for r in cursor.fetchall())
+
+        # Both QHA and Original QHA records are set from current QHA.
+        cursor.execute('UPDATE tracker_record r \
+                        SET start_id = c.start_id, end_id = c.end_id, \
+                        hours = c.hours \
+                        FROM tracker_current c \
+                        WHERE r.rsaccount_id IN %s \
+                        AND c.rsaccount_id = r.rsaccount_id \
+                        AND c.skill_id = %s AND r.skill_id >= %s \
+                        AND c.period = r.period AND c.hours > r.hours \
+                        RETURNING r.id',
+                       [acc_ids, Skill.QHA_ID, Skill.QHA_ID])
+        beaten.extend(r[0] for r in cursor.fetchall())
+
+        # Five minute records are not tracked by Current.
+        cursor.execute('UPDATE tracker_record r \
+                        SET start_id = b.start_id, end_id = b.end_id, \
+                        experience = e.experience - s.experience \
+                        FROM (VALUES %s) AS b (rsaccount_id, \
+                                               start_id, end_id), \
+                        %s s, %s e \
+                        WHERE r.rsaccount_id = b.rsaccount_id \
+                        AND r.period = %%s AND r.skill_id < %%s \
+                        AND s.datapoint_id = b.start_id \
+                        AND s.skill_id = r.skill_id \
+                        AND e.datapoint_id = b.end_id \
+                        AND e.skill_id = r.skill_id \
+                        AND e.experience - s.experience > r.experience \
+                        RETURNING r.id'
+                       % (fivemin_values, table, table),
+                       fivemin_rows + [Record.FIVE_MIN, Skill.QHA_ID])
+        beaten.extend(r[0] for r in cursor.fetchall())
+
+        # Gains under 0.01 hours are floating point errors and are ignored.
+        cursor.execute('UPDATE tracker_record r \
+                        SET start_id = b.start_id, end_id = b.end_id, \
+                        hours = e.current_hours - s.current_hours \
+                        FROM (VALUES %s) AS b (rsaccount_id, \
+                                               start_id, end_id), \
+                        %s s, %s e \
+                        WHERE r.rsaccount_id = b.rsaccount_id \
+                        AND r.period = %%s AND r.skill_id >= %%s \
+                        AND s.datapoint_id = b.start_id AND s.skill_id = 0 \
+                        AND e.datapoint_id = b.end_id AND e.skill_id = 0 \
+                        AND e.current_hours - s.current_hours >= 0.01 \
+                        AND e.current_hours - s.current_hours > r.hours \
+                        RETURNING r.id'
+                       % (fivemin_values, table, table),
+                       fivemin_rows + [Record.FIVE_MIN, Skill.QHA_ID])
+        beaten.extend(r[0] for r in cursor.fetchall())
+
+    return beaten
+
+
+def update_schedules(acc_ids, gains):
+    """
+    Reschedule the automatic updates of a set of accounts which have just
+    been updated, with a single statement. See TrackSchedule.
 
-    for c in curr:
-        if c.period == Current.DAY:
-            first = earliest[1]
-        elif c.period == Current.WEEK:
-            first = earliest[2]
-        elif c.period == Current.MONTH:
-            first = earliest[3]
-        elif c.period == Current.YEAR:
-            first = earliest[4]
+    Arguments:
+        acc_ids (list of int) - IDs of the updated accounts
+        gains (list of int) - Overall experience gained by each account since
+        its previous datapoint, or None for new accounts
+    """
 
-        if first != None:
-            s = SkillLevel.objects.get(datapoint=first, skill_id=0)
-            c.start = first
-            c.end = datapoint
-            c.hours = hours - s.current_hours
-        else:
-            c.start = datapoint
-            c.end = datapoint
-            c.hours = 0
+    params = []
+    for acc_id, gain in zip(acc_ids, gains):
+        params.extend([acc_id, gain])
+    values = ', '.join(['(%s, %s::bigint)'] * len(acc_ids))
 
-        rec = Record.objects.filter(rsaccount=acc, skill_id__gte=Skill.QHA_ID,
-                                    period=c.period)
-        for r in rec:
-            if c.hours > r.hours:
-                r.start = c.start
-                r.end = c.end
-                r.hours = c.hours
-                r.save()
+    # SQL version of TrackSchedule.next_interval.
+    interval = 'LEAST(GREATEST(CASE WHEN EXCLUDED.last_gain > 0 \
+                THEN s.update_interval / 2 ELSE s.update_interval * 2 END, \
+                %d), %d)' % (TrackSchedule.MIN_INTERVAL,
+                             TrackSchedule.MAX_INTERVAL)
 
-        c.save()
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_trackschedule AS s \
+                        (rsaccount_id, update_interval, next_update, \
+                         last_gain) \
+                        SELECT v.rsaccount_id, %d, \
+                        now() + interval \'%d seconds\', v.gain \
+                        FROM (VALUES %s) AS v (rsaccount_id, gain) \
+                        ON CONFLICT (rsaccount_id) DO UPDATE \
+                        SET last_gain = EXCLUDED.last_gain, \
+                        update_interval = %s, \
+                        next_update = now() + %s * interval \'1 second\''
+                       % (TrackSchedule.DEFAULT_INTERVAL,
+                          TrackSchedule.DEFAULT_INTERVAL, values, interval,
+                          interval), params)
 
-    s = SkillLevel.objects.get(datapoint=earliest[0], skill_id=0)
-    dh = hours - s.current_hours
 
-    # Prevent floating point arithmetic errors
-    if dh < 0.01:
-        dh = 0
+def last_checked(acc):
+    """
+    Return the time at which an account was last looked up on the hiscores.
+    Accounts without a recorded lookup fall back to their latest datapoint.
+    """
 
-    rec = Record.objects.filter(rsaccount=acc, skill_id__gte=Skill.QHA_ID,
-                                period=Record.FIVE_MIN)
+    if acc.last_checked is not None:
+        return acc.last_checked
 
-    for r in rec:
-        if dh > r.hours:
-            r.start = first
-            r.end = datapoint
-            r.hours = dh
-            r.save()
+    last = latest_datapoint(acc)
+    return last.time if last else None
 
 
 def get_period_firsts(acc, time):
     """
     Return an array of the earliest datapoints for account acc within each
-    of the four periods: day, month, week and year.
+    of the five periods: five minutes, day, week, month and year.
     An entry in the array can be None, indicating that a data point does not
     exist within that period.
     """
 
-    acc_dp = DataPoint.objects.filter(rsaccount=acc).order_by('time')
-    points = []
+    return get_period_boundaries([acc.id], time)[acc.id]
 
-    # For five minute records
-    start = time - timedelta(seconds=300)
-    first = acc_dp.filter(time__gte=start).first()
-    points.append(first)
 
-    for d in [1, 7, 31, 365]:
-        start = time - timedelta(days=d)
-        first = acc_dp.filter(time__gte=start).first()
-        points.append(first)
-
-    return points
+def get_period_boundaries(acc_ids, time, **kwargs):
+    """
+    Resolve the datapoints opening each of the five periods ending at `time`
+    for a set of accounts in a single query (see PERIOD_START).
 
+    Arguments:
+        acc_ids (list of int) - IDs of the accounts to look up
+        time (datetime) - the time at which the periods end
+        skill_ids (list of int) - if given, the SkillLevel entries for these
+        skills are fetched in the same query and stored in a `levels`
+        dictionary, keyed by skill ID, on each returned DataPoint
 
-def create_records(acc, datapoint):
-    """
-    Create Current and Record database entries for a newly tracked account.
+    Returns a dictionary mapping each account ID to its list of earliest
+    datapoints, in the same format as `get_period_firsts`.
     """
 
-    skills = Skill.objects.order_by('skill_id')
+    skill_ids = kwargs.get('skill_ids')
+    boundaries = dict((acc_id, [None] * len(PERIOD_LENGTHS))
+                      for acc_id in acc_ids)
+
+    if not boundaries:
+        return boundaries
+
+    since = ', '.join(['(%s, %%s)' % i for i in range(len(PERIOD_LENGTHS))])
+    params = [list(boundaries)] + [time - p for p in PERIOD_LENGTHS]
+
+    if skill_ids is None:
+        levels = 'NULL, NULL, NULL, NULL, NULL'
+        join = ''
+    else:
+        levels = 's.skill_id, s.experience, s.rank, s.current_hours, \
+                  s.original_hours'
+        join = 'LEFT JOIN %s s ON s.datapoint_id = d.id \
+                AND s.skill_id = ANY(%%s)' % levelstorage.table()
+        params.append(list(skill_ids))
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT a.id, p.idx, d.id, d.time, %s \
+                        FROM unnest(%%s::integer[]) AS a (id) \
+                        CROSS JOIN (VALUES %s) AS p (idx, since) \
+                        CROSS JOIN LATERAL %s AS d %s'
+                       % (levels, since,
+                          PERIOD_START % {'acc': 'a.id', 'since': 'p.since'},
+                          join), params)
+        rows = cursor.fetchall()
+
+    points = {}
+    for acc_id, idx, dp_id, dp_time, skill_id, exp, rank, ch, oh in rows:
+        try:
+            dp = points[dp_id]
+        except KeyError:
+            dp = DataPoint(id=dp_id, rsaccount_id=acc_id, time=dp_time)
+            if skill_ids is not None:
+                dp.levels = {}
+            points[dp_id] = dp
+
+        boundaries[acc_id][idx] = dp
+        if skill_id is not None:
+            dp.levels[skill_id] = SkillLevel(skill_id=skill_id, datapoint=dp,
+                                             experience=exp, rank=rank,
+                                             current_hours=ch,
+                                             original_hours=oh)
+
+    return boundaries
+
+
+def record_entries(acc, datapoint, skills):
+    """
+    Return lists of the (unsaved) Current and Record entries in each of
+    `skills` for a newly tracked account, all starting and ending at
+    `datapoint`.
+    """
+
+    currents = []
+    records = []
+
     for s in skills:
         if s.skill_id != Skill.ORIG_QHA_ID:
-            Current.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                                   end=datapoint, experience=0, hours=0,
-                                   period=Current.DAY)
-            Current.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                                   end=datapoint, experience=0, hours=0,
-                                   period=Current.WEEK)
-            Current.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                                   end=datapoint, experience=0, hours=0,
-                                   period=Current.MONTH)
-            Current.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                                   end=datapoint, experience=0, hours=0,
-                                   period=Current.YEAR)
-
-        Record.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                              end=datapoint, experience=0, hours=0,
-                              period=Record.FIVE_MIN)
-        Record.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                              end=datapoint, experience=0, hours=0,
-                              period=Record.DAY)
-        Record.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                              end=datapoint, experience=0, hours=0,
-                              period=Record.WEEK)
-        Record.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                              end=datapoint, experience=0, hours=0,
-                              period=Record.MONTH)
-        Record.objects.create(rsaccount=acc, skill=s, start=datapoint,
-                              end=datapoint, experience=0, hours=0,
-                              period=Record.YEAR)
+            for p in CURRENT_PERIODS:
+                currents.append(Current(rsaccount=acc, skill_id=s.skill_id,
+                                        start=datapoint, end=datapoint,
+                                        experience=0, hours=0, period=p))
+
+        for p in [Record.FIVE_MIN] + CURRENT_PERIODS:
+            records.append(Record(rsaccount=acc, skill_id=s.skill_id,
+                                  start=datapoint, end=datapoint,
+                                  experience=0, hours=0, period=p))
+
+    return currents, records
 
 
 def get_data_range(acc, period):
     """
-    Fetch all datapoints for player acc within the given time period.
+    Fetch all datapoints for player acc within the given time period as a
+    DataRange.
     """
 
-    if period == 'day':
-        p = timedelta(days=1)
-    elif period == 'week':
-        p = timedelta(days=7)
-    elif period == 'month':
-        p = timedelta(days=31)
-    elif period == 'year':
-        p = timedelta(days=365)
-    else:
-        raise InvalidPeriodError
-
-    start = timezone.now() - p
-    lst = DataPoint.objects.filter(rsaccount=acc, time__gte=start) \
-                           .order_by('-time')
-
-    skillpoints = []
-    for point in lst:
-        sp = SkillLevel.objects.filter(datapoint=point).order_by('skill_id')
-        skillpoints.append((point, sp))
-
-    return skillpoints
+    return load_range(acc, *period_condition(acc, period))
 
 
 def specific_data_range(acc, start, end):
     """
     Fetch all datapoints for player acc between the points with IDs start and
-    end, inclusive.
+    end, inclusive, as a DataRange.
     """
 
-    lst = DataPoint.objects.filter(rsaccount=acc, id__gte=start, id__lte=end) \
-                           .order_by('-time')
-    skillpoints = []
-    for point in lst:
-        sp = SkillLevel.objects.filter(datapoint=point).order_by('skill_id')
-        skillpoints.append((point, sp))
+    return load_range(acc, *id_condition(start, end))
 
-    return skillpoints
 
+def get_delta(acc, period):
+    """
+    Compare the first and last datapoints for player acc within the given
+    time period. Returns a Delta.
+    """
 
-def latest_datapoint(acc):
+    return load_delta(acc, *period_condition(acc, period))
+
+
+def specific_delta(acc, start, end):
     """
-    Return the most recent datapoint for account acc.
+    Compare the first and last datapoints for player acc between the points
+    with IDs start and end, inclusive. Returns a Delta.
     """
-    return DataPoint.objects.filter(rsaccount=acc).order_by('-time').first()
 
+    return load_delta(acc, *id_condition(start, end))
 
-def first_datapoint(acc):
+
+def get_summary_delta(acc_summary, period):
     """
-    Return the first datapoint on record for account acc.
+    Compare the first datapoint for an account within the given time period
+    with its latest levels, read from its AccountSummary. Returns a Delta.
     """
-    return DataPoint.objects.filter(rsaccount=acc).order_by('time').first()
 
+    try:
+        start = timezone.now() - RANGE_LENGTHS[period]
+    except KeyError:
+        raise InvalidPeriodError
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT d.id, d.time, s.skill_id, s.experience, \
+                        s.rank, s.current_hours \
+                        FROM tracker_datapoint d \
+                        JOIN %s s ON s.datapoint_id = d.id \
+                        WHERE d.id = (SELECT f.id FROM %s AS f) \
+                        ORDER BY s.skill_id'
+                       % (levelstorage.table(),
+                          PERIOD_START % {'acc': '%s', 'since': '%s'}),
+                       [acc_summary.rsaccount_id, start] * 2 + [start])
+        rows = cursor.fetchall()
 
-def update_player_current_top(acc):
+    # No lookup found the account's levels within the period.
+    if not rows:
+        return Delta([])
+
+    return Delta(rows + acc_summary.level_rows())
+
+
+def period_condition(acc, period):
+    """
+    Return an SQL condition on datapoint `d` and its parameters selecting the
+    datapoints of account acc within a period ending now, starting from the
+    datapoint which opens it (see PERIOD_START).
     """
-    Update all current top entries for a single player.
 
-    Arguments:
-        acc (RSAccount) - the account to update.
-    """
-
-    earliest = get_period_firsts(acc, timezone.now())
-    s = skills()
-    current = Current.objects.filter(rsaccount=acc)
-    dp = latest_datapoint(acc)
-
-    for skill in s:
-        curr = current.filter(skill=skill)
-
-        for c in curr:
-            if c.period == Current.DAY:
-                first = earliest[1]
-            elif c.period == Current.WEEK:
-                first = earliest[2]
-            elif c.period == Current.MONTH:
-                first = earliest[3]
-            elif c.period == Current.YEAR:
-                first = earliest[4]
-
-            if first != None:
-                # The Current entry is not out-of-date; don't bother updating it.
-                if first.time >= c.start.time:
-                    continue
-                start = SkillLevel.objects.get(datapoint=first, skill=skill)
-                end = SkillLevel.objects.get(datapoint=dp, skill=skill)
-                c.start = first
-                c.end = dp
-                c.experience = end.experience - start.experience
-            else:
-                c.start = dp
-                c.end = dp
-                c.experience = 0
-
-            c.save()
-
-    # Now we update current hours
-    curr = current.filter(skill=Skill.QHA_ID)
-    for c in curr:
-        if c.period == Current.DAY:
-            first = earliest[1]
-        elif c.period == Current.WEEK:
-            first = earliest[2]
-        elif c.period == Current.MONTH:
-            first = earliest[3]
-        elif c.period == Current.YEAR:
-            first = earliest[4]
-
-        if first != None:
-            if first.time >= c.start.time:
-                continue
-            # Overall hours stored in Overall skill
-            start = SkillLevel.objects.get(datapoint=first, skill=0)
-            end = SkillLevel.objects.get(datapoint=dp, skill=0)
-            c.start = first
-            c.end = dp
-            c.hours = end.current_hours - start.current_hours
-        else:
-            c.start = dp
-            c.end = dp
-            c.hours = 0
+    try:
+        start = timezone.now() - RANGE_LENGTHS[period]
+    except KeyError:
+        raise InvalidPeriodError
+
+    return 'd.time >= (SELECT f.time FROM %s AS f)' \
+           % (PERIOD_START % {'acc': '%s', 'since': '%s'}), \
+           [acc.id, start] * 2 + [start]
 
-        c.save()
+
+def id_condition(start, end):
+    """
+    Return an SQL condition on datapoint `d` and its parameters selecting the
+    datapoints with IDs from start to end, inclusive.
+    """
+
+    return 'd.id >= %s AND d.id <= %s', [int(start), int(end)]
 
 
-def get_updated_current_top(skill_id, period, start, limit):
+def load_range(acc, condition, params):
+    """
+    Load the datapoints of an account matching a datapoint condition, along
+    with all of their skill levels, in one query.
     """
-    Check if any current top entires for skill `skill_id` in `period`
-    are out-of-date and update them.
-    Return a list of `limit` current top entries, starting from entry `start`.
 
-    Arguments:
-        skill_id (int) - ID of skill to check.
-        period (str) - Current period to check.
-        start (int) - Starting index of entries to return.
-        Always a multiple of 25.
-        limit (int) - Number of entries to return.
-        Either 10 (overview page) or 25 (full table page).
-    """
-
-    # We check more entries than required as an experience drop could push
-    # an entry out of the requested range.
-    if start == 0:
-        first = start
-        last = 25 if limit == 10 else 50
-    else:
-        first = start - 25
-        last = start + 50
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT d.id, d.time, s.skill_id, s.experience, \
+                        s.rank, s.current_hours \
+                        FROM tracker_datapoint d \
+                        JOIN %s s ON s.datapoint_id = d.id \
+                        WHERE d.rsaccount_id = %%s AND %s \
+                        ORDER BY d.time, d.id, s.skill_id'
+                       % (levelstorage.table(), condition),
+                       [acc.id] + params)
+        return DataRange(cursor.fetchall())
 
-    if skill_id < Skill.QHA_ID:
-        order = '-experience'
-    else:
-        order = '-hours'
-
-    currtop = Current.objects.filter(skill_id=skill_id, period=period) \
-                             .order_by(order)
-    top = currtop[first:last]
-
-    periods = {
-        'D': 1,
-        'W': 7,
-        'M': 31,
-        'Y': 365,
-    }
-    period_start = timezone.now() - timedelta(days=periods[period])
-
-    for c in top:
-        # Has the entry expired?
-        if c.start.time < period_start:
-            # Fetch the first datapoint within the time period.
-            dps = DataPoint.objects.filter(rsaccount=c.rsaccount,
-                                           time__gte=period_start) \
-                                   .order_by('time')
-            if len(dps) == 0:
-                dp = latest_datapoint(c.rsaccount)
-                c.start = dp
-                c.end = dp
-                if skill_id < Skill.QHA_ID:
-                    c.experience = 0
-                else:
-                    c.hours = 0
-                c.save()
-                continue
-
-            dp = dps[0]
-            # Update entry with the proper datapoint.
-            if skill_id < Skill.QHA_ID:
-                s1 = SkillLevel.objects.get(datapoint=dp, skill_id=skill_id)
-                s2 = SkillLevel.objects.get(datapoint=c.end, skill_id=skill_id)
-                c.experience = s2.experience - s1.experience
-            else:
-                s1 = SkillLevel.objects.get(datapoint=dp, skill_id=0)
-                s2 = SkillLevel.objects.get(datapoint=c.end, skill_id=0)
-                c.hours = s2.current_hours - s1.current_hours
 
-            c.start = dp
-            c.save()
+def load_delta(acc, condition, params):
+    """
+    Load the skill levels of the first and last datapoints of an account
+    matching a datapoint condition. Both ends are found with an indexed
+    lookup each, so the cost does not depend on the number of datapoints in
+    between.
+    """
 
+    first = 'SELECT d.id FROM tracker_datapoint d \
+             WHERE d.rsaccount_id = %%s AND %s \
+             ORDER BY d.time %s, d.id %s LIMIT 1'
 
-    return currtop.order_by(order)[start:start + limit]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT d.id, d.time, s.skill_id, s.experience, \
+                        s.rank, s.current_hours \
+                        FROM tracker_datapoint d \
+                        JOIN %s s ON s.datapoint_id = d.id \
+                        WHERE d.id IN ((%s), (%s)) \
+                        ORDER BY d.time, d.id, s.skill_id'
+                       % (levelstorage.table(),
+                          first % (condition, 'ASC', 'ASC'),
+                          first % (condition, 'DESC', 'DESC')),
+                       [acc.id] + params + [acc.id] + params)
+        return Delta(cursor.fetchall())
 
 
-def skills(**kwargs):
+def latest_datapoint(acc):
+    """
+    Return the most recent datapoint for account acc.
     """
-    Return set of Skill objects for all in-game skills.
+    return DataPoint.objects.filter(rsaccount=acc).order_by('-time').first()
+
+
+def first_datapoint(acc):
     """
+    Return the first datapoint on record for account acc.
+    """
+    return DataPoint.objects.filter(rsaccount=acc).order_by('time').first()
 
-    try:
-        include_hours = kwargs['include_qha']
-    except KeyError:
-        include_hours = False
 
-    if include_hours:
-        s = Skill.objects.all()
-    else:
-        s = Skill.objects.filter(skill_id__lt=Skill.QHA_ID)
+def skills(**kwargs):
+    """
+    Return a tuple of all in-game skills, or of every skill if `include_qha`
+    is set, from the skill registry.
+    """
 
-    return s.order_by('skill_id')
+    return skillregistry.skills(kwargs.get('include_qha', False))
 
 
 def skill_name(skill_id):
-    try:
-        name = Skill.objects.get(skill_id=skill_id).skillname
-    except Skill.DoesNotExist:
-        return ''
-
-    return name
+    return skillregistry.skill_name(skill_id)
 
 
 def calculate_hours(skill_id, experience):
@@ -554,171 +883,124 @@ def calculate_hours(skill_id, experience):
     experience.
     """
 
-    rates = SkillRate.objects.filter(skill_id=skill_id).order_by('-start_exp')
-    return __calculate_hours(rates, experience)
+    return skillrates.hours(skill_id, experience)
 
 
-def __calculate_hours(rates, experience):
+class DataRange(object):
     """
-    Calculate hours played using given experience rates and experience.
+    The skill levels of an account at a series of datapoints, stored by
+    column: for each skill, parallel lists of its experience, rank and hours
+    at each datapoint, in time order.
     """
 
-    hours = 0
+    __slots__ = ('ids', 'times', 'experience', 'rank', 'hours')
 
-    for r in rates:
-        if experience <= r.start_exp:
-            continue
+    def __init__(self, rows):
+        """
+        Arguments:
+            rows (list of tuples) - (datapoint ID, time, skill ID, experience,
+            rank, hours) rows ordered by time, datapoint and skill
+        """
 
-        diff = experience - r.start_exp
-        if r.rate != 0:
-            hours += diff / r.rate
-        experience = r.start_exp
+        self.ids = []
+        self.times = []
+        self.experience = {}
+        self.rank = {}
+        self.hours = {}
 
-    return hours
+        for dp_id, dp_time, skill_id, exp, rank, hours in rows:
+            if not self.ids or self.ids[-1] != dp_id:
+                self.ids.append(dp_id)
+                self.times.append(dp_time)
+            self.experience.setdefault(skill_id, []).append(exp)
+            self.rank.setdefault(skill_id, []).append(rank)
+            self.hours.setdefault(skill_id, []).append(hours)
 
+    def __len__(self):
+        return len(self.ids)
+
+    def skill_ids(self):
+        """
+        Return the IDs of the skills in the range, in order.
+        """
+
+        return sorted(self.experience)
 
-def recalculate_hours(modified_skills, **kwargs):
-    """
-    Recalculate hours played for each skill ID in `modified_skills`
-    for every datapoint in the database.
 
-    This function takes a very long time to complete and should only be used
-    after all desired changes to experience rates are made.
+class Delta(object):
+    """
+    The skill levels of an account at the first and last datapoints of a
+    range. If the range holds a single datapoint, it is both the first and
+    the last; if it holds none, the Delta is false.
     """
 
-    try:
-        orig = kwargs['recalc_orig']
-    except KeyError:
-        orig = False
+    __slots__ = ('start_id', 'start_time', 'end_id', 'end_time', 'start',
+                 'end')
 
-    if 0 in modified_skills:
-        modified_skills.remove(0)
+    def __init__(self, rows):
+        """
+        Arguments:
+            rows (list of tuples) - (datapoint ID, time, skill ID, experience,
+            rank, hours) rows of at most two datapoints, ordered by time
+        """
 
-    Current.objects.filter(skill_id=Skill.QHA_ID).update(hours=0)
-    Record.objects.filter(skill_id=Skill.QHA_ID).update(hours=0)
+        self.start_id = self.end_id = None
+        self.start_time = self.end_time = None
+        self.start = {}
+        self.end = {}
 
-    if orig:
-        Record.objects.filter(skill_id=Skill.ORIG_QHA_ID).update(hours=0)
+        for dp_id, dp_time, skill_id, exp, rank, hours in rows:
+            if self.start_id is None:
+                self.start_id, self.start_time = dp_id, dp_time
+            if dp_id == self.start_id:
+                self.start[skill_id] = (exp, rank, hours)
+            else:
+                self.end_id, self.end_time = dp_id, dp_time
+                self.end[skill_id] = (exp, rank, hours)
 
-    rates = []
-    all_skills = skills()
-    for s in all_skills:
-        rates.append(SkillRate.objects.filter(skill=s).order_by('-start_exp'))
+        if self.end_id is None:
+            self.end_id, self.end_time = self.start_id, self.start_time
+            self.end = self.start
 
-    for acc in RSAccount.objects.all():
-        # TODO: lock account from being modified
-        recalculate_single(acc, modified_skills, rates, orig)
-        # TODO: unlock account
+    def __bool__(self):
+        return self.start_id is not None
 
+    def levels(self, skill_id):
+        """
+        Return the (experience, rank, hours) of a skill at the last datapoint.
+        """
 
-def recalculate_single(acc, modified_skills, rates, orig):
-    """
-    Recalculate hours played for all datapoints belonging to player `acc`
-    for each skill ID in `modified_skills`, and update player's QHA records.
-    """
+        return self.end[skill_id]
 
-    points = DataPoint.objects.filter(rsaccount=acc)
-    rec = Record.objects.filter(rsaccount=acc, skill_id=Skill.QHA_ID)
+    def change(self, skill_id):
+        """
+        Return the change in experience, rank and hours of a skill between
+        the first and last datapoints. A rise in the hiscores is a positive
+        change in rank.
+        """
 
-    records = [
-        [rec.get(period=Record.FIVE_MIN), None],
-        [rec.get(period=Record.DAY), None],
-        [rec.get(period=Record.WEEK), None],
-        [rec.get(period=Record.MONTH), None],
-        [rec.get(period=Record.YEAR), None],
-    ]
+        start = self.start[skill_id]
+        end = self.end[skill_id]
 
-    if orig:
-        orec = Record.objects.filter(rsaccount=acc, skill_id=Skill.ORIG_QHA_ID)
-        records[0][1] = orec.get(period=Record.FIVE_MIN)
-        records[1][1] = orec.get(period=Record.DAY)
-        records[2][1] = orec.get(period=Record.WEEK)
-        records[3][1] = orec.get(period=Record.MONTH)
-        records[4][1] = orec.get(period=Record.YEAR)
+        return (end[0] - start[0], start[1] - end[1], end[2] - start[2])
 
-    for dp in points:
-        # Optimize for time through raw SQL queries.
-        with connection.cursor() as cursor:
-            # Recalculate hours for each modified skill.
-            for s in modified_skills:
-                cursor.execute('SELECT experience FROM tracker_skilllevel WHERE \
-                                datapoint_id = %s AND skill_id = %s', [dp.id, s])
-                h = __calculate_hours(rates[s], cursor.fetchone()[0])
-                if not orig:
-                    cursor.execute('UPDATE tracker_skilllevel \
-                                    SET current_hours = %s \
-                                    WHERE datapoint_id = %s AND skill_id = %s',
-                                    [h, dp.id, s])
-                else:
-                    cursor.execute('UPDATE tracker_skilllevel \
-                                    SET current_hours = %s, original_hours = %s \
-                                    WHERE datapoint_id = %s AND skill_id = %s',
-                                    [h, h, dp.id, s])
-
-            # Recalculate total hours for this datapoint.
-            cursor.execute('SELECT sum(current_hours) FROM tracker_skilllevel \
-                            WHERE datapoint_id = %s AND skill_id != 0', [dp.id])
-            hours = cursor.fetchone()[0]
-
-            cursor.execute('UPDATE tracker_skilllevel SET current_hours = %s \
-                            WHERE datapoint_id = %s AND skill_id = 0',
-                            [hours, dp.id])
-
-        ### TODO: Record checking and updating should be optimized to avoid
-        ### redundantly checking the same datapoints multiple times.
-        ### Amount of database queries can be reduced.
-
-        # Check the five minute QHA from this datapoint
-        # and update record if necessary.
-        start = dp.time - timedelta(seconds=300)
-        first = points.filter(time__gte=start).first()
-        if first:
-            h = SkillLevel.objects.get(datapoint=first, skill_id=0).current_hours
-            dh = hours - h
-            if dh < 0.01:
-                dh = 0
-
-            day = records[0][0]
-            if dh > day.hours:
-                day.hours = dh
-                day.start = first
-                day.end = dp
-                if orig:
-                    records[0][1].hours = dh
-                    records[0][1].start = first
-                    records[0][1].end = dp
-
-
-        # Check and update day, week, month and year records.
-        for i, d in enumerate([1, 7, 31, 365]):
-            ind = i + 1
-            start = dp.time - timedelta(days=d)
-            first = points.filter(time__gte=start).first()
-
-            if not first:
-                continue
-
-            h = SkillLevel.objects.get(datapoint=first, skill_id=0).current_hours
-            dh = hours - h
-            if dh < 0.01:
-                dh = 0
-
-            r = records[ind][0]
-            if dh > r.hours:
-                r.hours = dh
-                r.start = first
-                r.end = dp
-                if orig:
-                    records[ind][1].hours = dh
-                    records[ind][1].start = first
-                    records[ind][1].end = dp
-
-    # Store all record values back into the database.
-    for r in records:
-        r[0].save()
-        if orig:
-            r[1].save()
 
+def lock_accounts(acc_ids):
+    """
+    Acquire the update locks of a set of accounts for the rest of the current
+    transaction, waiting until any other transaction holding them finishes.
+    Every operation which modifies an account's datapoints, Current or Record
+    entries takes these locks.
+    """
+
+    if not acc_ids:
+        return
+
+    # Locks are always acquired in the same order to prevent deadlocks.
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, a.id) \
+                        FROM unnest(%s::integer[]) AS a (id) ORDER BY a.id',
+                       [ACCOUNT_LOCK, sorted(acc_ids)])
 
 
 class RecentUpdateError(Exception):
@@ -0,0 +1,411 @@
+#
+# tracker/modules/history.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tracker.models import *
+from tracker.modules import accounttracker, levelstorage, skillregistry
+
+# Record periods in the order of `accounttracker.PERIOD_LENGTHS`.
+RECORD_PERIODS = [Record.FIVE_MIN] + accounttracker.CURRENT_PERIODS
+
+
+def window_gains(times, values, lengths, **kwargs):
+    """
+    Find the largest gain in a time-ordered series within a window of each of
+    the given lengths. Each window is found in a single pass in which both the
+    window's start and end only ever move forward.
+
+    Arguments:
+        times (list of datetime) - ascending times of the series
+        values (list) - value of the series at each time
+        lengths (list of timedelta) - window lengths to check
+        min_gain - gains smaller than this are counted as 0 (default 0)
+        checked (list of datetime) - time until which each value was known
+        to be current (default `times`); a window starts at the first value
+        current within it
+
+    Returns a list of (gain, start index, end index) tuples, one for each
+    window length. The earliest window with the largest gain is returned; its
+    indices are None if there was no positive gain.
+    """
+
+    min_gain = kwargs.get('min_gain', 0)
+    checked = kwargs.get('checked', times)
+    results = []
+
+    for length in lengths:
+        best = (0, None, None)
+        start = 0
+
+        for end in range(len(times)):
+            # Advance to the first point current within the window ending
+            # here.
+            since = times[end] - length
+            while checked[start] < since:
+                start += 1
+
+            gain = values[end] - values[start]
+            if gain < min_gain:
+                gain = 0
+
+            if gain > best[0]:
+                best = (gain, start, end)
+
+        results.append(best)
+
+    return results
+
+
+def skill_history(acc_id, skill_ids):
+    """
+    Load the full history of an account in a set of skills with one query.
+
+    Returns a list of (datapoint ID, time, last checked) tuples in time order
+    and a dictionary mapping each skill ID to a pair of lists holding its
+    experience and hours at each of those datapoints. The last checked time
+    of a datapoint is the time until which its levels were current.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT d.id, d.time, \
+                        COALESCE(d.last_checked, d.time), s.skill_id, \
+                        s.experience, s.current_hours \
+                        FROM tracker_datapoint d \
+                        JOIN %s s ON s.datapoint_id = d.id \
+                        WHERE d.rsaccount_id = %%s \
+                        AND s.skill_id = ANY(%%s) \
+                        ORDER BY d.time, d.id' % levelstorage.table(),
+                       [acc_id, list(skill_ids)])
+        rows = cursor.fetchall()
+
+    return group_history(rows, skill_ids)
+
+
+def group_history(rows, skill_ids):
+    """
+    Group time-ordered (datapoint ID, time, last checked, skill ID,
+    experience, hours) rows into the format returned by `skill_history`.
+    """
+
+    points = []
+    levels = dict((s, ([], [])) for s in skill_ids)
+
+    for dp_id, dp_time, checked, skill_id, exp, hours in rows:
+        if not points or points[-1][0] != dp_id:
+            points.append((dp_id, dp_time, checked))
+        levels[skill_id][0].append(exp)
+        levels[skill_id][1].append(hours)
+
+    return points, levels
+
+
+def compute_records(points, levels, skill_ids):
+    """
+    Compute the record gains of an account in every period for each skill in
+    `skill_ids` from its history, as returned by `skill_history`. QHA and
+    Original QHA records are computed from the hours stored in Overall.
+
+    Returns a dictionary mapping each (skill ID, period) pair to a tuple of
+    (gain, start datapoint ID, end datapoint ID).
+    """
+
+    times = [p[1] for p in points]
+    checked = [p[2] for p in points]
+    records = {}
+
+    for skill_id in skill_ids:
+        if skill_id >= Skill.QHA_ID:
+            values = levels[0][1]
+            min_gain = 0.01
+        else:
+            values = levels[skill_id][0]
+            min_gain = 0
+
+        gains = window_gains(times, values, accounttracker.PERIOD_LENGTHS,
+                             min_gain=min_gain, checked=checked)
+
+        for period, (gain, start, end) in zip(RECORD_PERIODS, gains):
+            if start is None:
+                # Records without gains span the account's first datapoint.
+                start = end = 0
+            records[(skill_id, period)] = (gain, points[start][0],
+                                           points[end][0])
+
+    return records
+
+
+def level_ids(skill_ids):
+    """
+    Return the IDs of the skills whose levels are required to compute records
+    in `skill_ids`.
+    """
+
+    return sorted(set(0 if s >= Skill.QHA_ID else s for s in skill_ids))
+
+
+def rebuild_records(acc_id, skill_ids, **kwargs):
+    """
+    Rebuild the Record entries of an account in the given skills from its raw
+    skill level history.
+
+    Arguments:
+        acc_id (int) - ID of the account to rebuild
+        skill_ids (list of int) - skills whose records to rebuild
+        save (bool) - write changed records to the database (default True)
+
+    Returns a list of (Record, old values) pairs for each record which
+    differed from its rebuilt value, where old values is a tuple of
+    (gain, start ID, end ID).
+    """
+
+    save = kwargs.get('save', True)
+
+    points, levels = skill_history(acc_id, level_ids(skill_ids))
+    if not points:
+        return []
+
+    return apply_records(acc_id, compute_records(points, levels, skill_ids),
+                         save)
+
+
+def apply_records(acc_id, computed, save):
+    """
+    Update the Record entries of an account with computed record values (see
+    `compute_records`). Return the changed records as in `rebuild_records`.
+    """
+
+    skill_ids = set(s for s, _ in computed)
+    records = Record.objects.filter(rsaccount_id=acc_id,
+                                    skill_id__in=skill_ids)
+    changed = diff_entries(records, dict(((acc_id,) + k, v)
+                                         for k, v in computed.items()))
+
+    if save:
+        save_entries(Record, [rec for rec, _ in changed])
+
+    return changed
+
+
+def diff_entries(entries, computed):
+    """
+    Compare Record or Current entries with their computed values, keyed by
+    (account ID, skill ID, period). Entries which differ are updated in place
+    and returned along with their old (gain, start ID, end ID) values.
+    """
+
+    changed = []
+
+    for entry in entries:
+        try:
+            gain, start, end = computed[(entry.rsaccount_id, entry.skill_id,
+                                         entry.period)]
+        except KeyError:
+            continue
+
+        hours = entry.skill_id >= Skill.QHA_ID
+        old = (entry.hours if hours else entry.experience, entry.start_id,
+               entry.end_id)
+
+        if hours:
+            if abs(old[0] - gain) < 1e-6 and old[1:] == (start, end):
+                continue
+            entry.hours = gain
+        else:
+            if old == (gain, start, end):
+                continue
+            entry.experience = gain
+
+        entry.start_id = start
+        entry.end_id = end
+        changed.append((entry, old))
+
+    return changed
+
+
+def save_entries(model, entries):
+    """
+    Write the gains and datapoints of a list of Record or Current entries back
+    to the database with a single statement.
+    """
+
+    if not entries:
+        return
+
+    params = []
+    for e in entries:
+        params.extend([e.id, e.experience, float(e.hours), e.start_id,
+                       e.end_id])
+    values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(entries))
+
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE %s t SET experience = v.experience, \
+                        hours = v.hours, start_id = v.start_id, \
+                        end_id = v.end_id \
+                        FROM (VALUES %s) AS v (id, experience, hours, \
+                                               start_id, end_id) \
+                        WHERE t.id = v.id' % (model._meta.db_table, values),
+                       params)
+
+
+def compute_currents(points, levels, skill_ids, now):
+    """
+    Compute the current gains of an account in every period for each skill in
+    `skill_ids` at time `now` from its history (see `skill_history`). The
+    current QHA is computed from the hours stored in Overall.
+
+    Returns a dictionary mapping each (skill ID, period) pair to a tuple of
+    (gain, start datapoint ID, end datapoint ID).
+    """
+
+    checked = [p[2] for p in points]
+    last = len(points) - 1
+    currents = {}
+
+    for skill_id in skill_ids:
+        if skill_id == Skill.ORIG_QHA_ID:
+            continue
+        elif skill_id == Skill.QHA_ID:
+            values = levels[0][1]
+        else:
+            values = levels[skill_id][0]
+
+        for period, length in zip(accounttracker.CURRENT_PERIODS,
+                                  accounttracker.PERIOD_LENGTHS[1:]):
+            # The period opens at the first datapoint current within it.
+            start = bisect.bisect_left(checked, now - length)
+            if start > last:
+                # No datapoints within the period.
+                currents[(skill_id, period)] = (0, points[last][0],
+                                                points[last][0])
+            else:
+                currents[(skill_id, period)] = (values[last] - values[start],
+                                                points[start][0],
+                                                points[last][0])
+
+    return currents
+
+
+def stream_histories(acc_ids, skill_ids, **kwargs):
+    """
+    Stream the histories of a set of accounts in the given skills through a
+    server-side cursor, yielding (account ID, points, levels) tuples one
+    account at a time, where points and levels are as returned by
+    `skill_history`. Must be called inside a transaction.
+
+    Arguments:
+        acc_ids (list of int) - accounts whose histories to stream
+        skill_ids (list of int) - skills to include
+        itersize (int) - rows fetched from the server at a time
+    """
+
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name='tracker_history')
+    cursor.itersize = kwargs.get('itersize', 20000)
+
+    try:
+        cursor.execute('SELECT d.rsaccount_id, d.id, d.time, \
+                        COALESCE(d.last_checked, d.time), s.skill_id, \
+                        s.experience, s.current_hours \
+                        FROM tracker_datapoint d \
+                        JOIN %s s ON s.datapoint_id = d.id \
+                        WHERE d.rsaccount_id = ANY(%%s) \
+                        AND s.skill_id = ANY(%%s) \
+                        ORDER BY d.rsaccount_id, d.time, d.id'
+                       % levelstorage.table(),
+                       [list(acc_ids), list(skill_ids)])
+
+        acc_id = None
+        rows = []
+        for row in cursor:
+            if row[0] != acc_id:
+                if rows:
+                    yield (acc_id,) + group_history(rows, skill_ids)
+                acc_id = row[0]
+                rows = []
+            rows.append(row[1:])
+
+        if rows:
+            yield (acc_id,) + group_history(rows, skill_ids)
+    finally:
+        cursor.close()
+
+
+def rebuild_accounts(acc_ids, **kwargs):
+    """
+    Rebuild all Record and Current entries of a set of accounts from their
+    raw history in a single transaction, holding the accounts' update locks.
+
+    Arguments:
+        acc_ids (list of int) - accounts to rebuild
+        dry_run (bool) - compute changes without writing them (default False)
+
+    Returns the number of datapoints processed and a list of the changes
+    made, each a tuple of (model name, account ID, skill ID, period,
+    old values, new values), values being (gain, start ID, end ID) tuples.
+    """
+
+    dry_run = kwargs.get('dry_run', False)
+    skill_ids = list(skillregistry.skill_ids())
+    now = timezone.now()
+
+    records = {}
+    currents = {}
+    points_read = 0
+
+    with transaction.atomic():
+        accounttracker.lock_accounts(acc_ids)
+
+        for acc_id, points, levels in stream_histories(acc_ids,
+                                                       level_ids(skill_ids)):
+            points_read += len(points)
+            for (s, p), v in compute_records(points, levels,
+                                             skill_ids).items():
+                records[(acc_id, s, p)] = v
+            for (s, p), v in compute_currents(points, levels, skill_ids,
+                                              now).items():
+                currents[(acc_id, s, p)] = v
+
+        changes = []
+        for model, computed in [(Record, records), (Current, currents)]:
+            entries = model.objects.filter(rsaccount_id__in=acc_ids)
+            changed = diff_entries(entries, computed)
+            if not dry_run:
+                save_entries(model, [e for e, _ in changed])
+
+            for e, old in changed:
+                new = (e.hours if e.skill_id >= Skill.QHA_ID else e.experience,
+                       e.start_id, e.end_id)
+                changes.append((model.__name__, e.rsaccount_id, e.skill_id,
+                                e.period, old, new))
+
+    return points_read, changes
+
+
+def rebuild_job(job):
+    """
+    Process pool entry point for `rebuild_accounts`. `job` is a tuple of
+    (account IDs, dry_run). Returns the number of accounts and datapoints
+    processed and the list of changes.
+    """
+
+    acc_ids, dry_run = job
+    points, changes = rebuild_accounts(acc_ids, dry_run=dry_run)
+    return len(acc_ids), points, changes
@@ -0,0 +1,66 @@
+#
+# tracker/modules/indexes.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import connections
+
+from tracker.models import Skill
+
+# Indexes which cannot be declared on the models: partial indexes ranking
+# the Record and Current entries of each skill and period, which leave out
+# the entries without gains that are never ranked, and the expression indexes
+# used by case-insensitive username lookups. Each is a (name, table,
+# definition) tuple.
+INDEXES = [
+    ('tracker_record_rank_exp', 'tracker_record',
+     '(skill_id, period, experience, id) WHERE experience >= 1 '
+     'AND skill_id < %d' % Skill.QHA_ID),
+    ('tracker_record_rank_hours', 'tracker_record',
+     '(skill_id, period, hours, id) WHERE hours >= 0.001 '
+     'AND skill_id >= %d' % Skill.QHA_ID),
+    ('tracker_current_rank_exp', 'tracker_current',
+     '(skill_id, period, experience, id) WHERE experience >= 1 '
+     'AND skill_id < %d' % Skill.QHA_ID),
+    ('tracker_current_rank_hours', 'tracker_current',
+     '(skill_id, period, hours, id) WHERE hours >= 0.001 '
+     'AND skill_id >= %d' % Skill.QHA_ID),
+    ('tracker_rsaccount_username_upper', 'tracker_rsaccount',
+     '(UPPER(username::text))'),
+    ('tracker_rsaccount_username_lower', 'tracker_rsaccount',
+     '(LOWER(username::text))'),
+]
+
+# Unique indexes which cannot be declared on the models, in the same format.
+# An account has at most one pending update job.
+UNIQUE_INDEXES = [
+    ('tracker_updatejob_pending', 'tracker_updatejob',
+     "(LOWER(username::text)) WHERE status IN ('Q', 'R')"),
+]
+
+
+def create_indexes(using='default', **kwargs):
+    """
+    Create any of the indexes in INDEXES and UNIQUE_INDEXES which do not
+    exist yet. Connected to the post_migrate signal of the tracker app.
+    """
+
+    with connections[using].cursor() as cursor:
+        for indexes, kind in [(INDEXES, 'INDEX'),
+                              (UNIQUE_INDEXES, 'UNIQUE INDEX')]:
+            for name, table, definition in indexes:
+                cursor.execute('CREATE %s IF NOT EXISTS %s ON %s %s'
+                               % (kind, name, table, definition))
@@ -0,0 +1,423 @@
+#
+# tracker/modules/leaderboard.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+from tracker.models import *
+from tracker.modules import pagecache, pagination, skillregistry
+
+# Tables ranked by each board.
+BOARD_TABLES = {
+    Leaderboard.RECORDS: 'tracker_record',
+    Leaderboard.CURRENT: 'tracker_current',
+}
+
+# Periods ranked by each board.
+BOARD_PERIODS = {
+    Leaderboard.RECORDS: [p for p, _ in Record.PERIOD_CHOICES],
+    Leaderboard.CURRENT: [p for p, _ in Current.PERIOD_CHOICES],
+}
+
+# Namespace of the advisory locks taken on leaderboards by `refresh`.
+LEADERBOARD_LOCK = 2
+
+# Ranked value of an entry: experience in game skills, hours in QHA.
+VALUE = 'CASE WHEN %%(t)s.skill_id < %d THEN %%(t)s.experience \
+         ELSE %%(t)s.hours END' % Skill.QHA_ID
+
+# Entries below these values have no gain and are not ranked.
+QUALIFIES = '%s >= CASE WHEN %%(t)s.skill_id < %d THEN 1 ELSE 0.001 END' \
+            % (VALUE, Skill.QHA_ID)
+
+
+def board_size():
+    """
+    Return the number of entries kept in each leaderboard snapshot.
+    """
+
+    return getattr(settings, 'TRACKER_LEADERBOARD_SIZE', 250)
+
+
+def value_column(skill_id):
+    """
+    Return the column ranked in a skill's leaderboards.
+    """
+
+    return 'experience' if skill_id < Skill.QHA_ID else 'hours'
+
+
+def ranking_sql(board, skill_id, keyset=False, condition=''):
+    """
+    Return a query selecting the ranked entries of a board in a skill and
+    period, taking parameters (skill ID, period, limit). Each row is
+    (entry ID, value, account ID, username, experience, hours, start ID,
+    end ID). With `keyset`, the query takes a (value, entry ID) cursor after
+    the period and only selects the entries ranked below it. `condition` is
+    an additional SQL condition on the entries `t`, whose parameters precede
+    the limit.
+    """
+
+    column = value_column(skill_id)
+    minimum = 1 if skill_id < Skill.QHA_ID else 0.001
+    after = 'AND (t.%s, t.id) < (%%s, %%s)' % column if keyset else ''
+
+    return 'SELECT t.id, t.%s AS value, t.rsaccount_id, a.username, \
+            t.experience, t.hours, t.start_id, t.end_id \
+            FROM %s t JOIN tracker_rsaccount a ON a.id = t.rsaccount_id \
+            WHERE t.skill_id = %%s AND t.period = %%s AND t.%s >= %s %s %s \
+            ORDER BY t.%s DESC, t.id DESC LIMIT %%s' \
+           % (column, BOARD_TABLES[board], column, minimum, after, condition,
+              column)
+
+
+def top(board, skill_id, period, start=0, limit=10, after=None):
+    """
+    Return the entries of a leaderboard ranked from `start` + 1 to `start` +
+    `limit` as (username, experience, hours, start ID, end ID, entry ID)
+    tuples, where entry ID is the ID of the Record or Current entry. They are
+    read from the leaderboard's snapshot if it holds those ranks, and ranked
+    from the Record or Current table otherwise, starting from the page anchor
+    preceding them (see `pagination.find_page`). Ranks past the anchors
+    stored by the last `refresh` of the leaderboard are not found.
+
+    Entries are ordered by value and then by entry ID, both descending. If
+    `after` is given, `start` is ignored and the entries following that
+    (value, entry ID) cursor are returned instead, so that a page can be
+    found without counting the entries before it and does not shift as
+    entries above it change.
+
+    Arguments:
+        board (str) - Leaderboard.RECORDS or Leaderboard.CURRENT
+        skill_id (int) - skill of the leaderboard
+        period (str) - period of the leaderboard
+        start (int) - number of entries to skip
+        limit (int) - number of entries to return
+        after (tuple) - (value, entry ID) of the entry preceding the page
+    """
+
+    end = start + limit
+    size = board_size()
+    column = value_column(skill_id)
+    fields = ('username', 'experience', 'hours', 'start_id', 'end_id',
+              'entry_id')
+
+    snapshot = Leaderboard.objects.filter(board=board, skill_id=skill_id,
+                                          period=period) \
+                                  .values_list('size', flat=True).first()
+
+    if snapshot is not None:
+        entries = LeaderboardEntry.objects.filter(board=board,
+                                                  skill_id=skill_id,
+                                                  period=period)
+        if after is None:
+            # A snapshot smaller than the board size holds every ranked
+            # entry.
+            if end <= size or snapshot < size:
+                entries = entries.filter(rank__gt=start, rank__lte=end)
+                return list(entries.order_by('rank')
+                                   .values_list(*fields))
+        else:
+            value, entry_id = after
+            entries = entries.filter(Q(**{column + '__lt': value})
+                                     | Q(**{column: value,
+                                            'entry_id__lt': entry_id}))
+            rows = list(entries.order_by('rank')
+                               .values_list(*fields)[:limit])
+            if len(rows) == limit or snapshot < size:
+                return rows
+
+    skip = 0
+    if after is None:
+        page = pagination.find_page(board_ranking(board, skill_id, period),
+                                    start)
+        if page is None:
+            return []
+        after, skip = page
+
+    with connection.cursor() as cursor:
+        if after is None:
+            cursor.execute(ranking_sql(board, skill_id),
+                           [skill_id, period, skip + limit])
+        else:
+            cursor.execute(ranking_sql(board, skill_id, keyset=True),
+                           [skill_id, period] + list(after)
+                           + [skip + limit])
+        return [r[3:] + (r[0],) for r in cursor.fetchall()[skip:]]
+
+
+def entry_cursor(skill_id, entry):
+    """
+    Return the (value, entry ID) cursor of an entry returned by `top`.
+    """
+
+    return (entry[1] if skill_id < Skill.QHA_ID else entry[2], entry[5])
+
+
+def board_ranking(board, skill_id, period):
+    """
+    Return the name under which the page anchors of a leaderboard are stored.
+    """
+
+    return '%s:%d:%s' % (board, skill_id, period)
+
+
+def refresh(boards):
+    """
+    Rebuild the snapshots and page anchors of a list of (board, skill ID,
+    period) leaderboards from the Record and Current tables, creating any
+    which do not exist yet. Must be called inside a transaction.
+    """
+
+    boards = sorted(set(boards))
+    size = board_size()
+
+    with connection.cursor() as cursor:
+        # Locks are taken in a fixed order so that concurrent refreshes
+        # of overlapping sets of boards cannot deadlock.
+        for board, skill_id, period in boards:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                           [LEADERBOARD_LOCK, lock_key(board, skill_id,
+                                                       period)])
+
+        for board, skill_id, period in boards:
+            key = [board, skill_id, period]
+            cursor.execute('DELETE FROM tracker_leaderboardentry \
+                            WHERE board = %s AND skill_id = %s \
+                            AND period = %s', key)
+            cursor.execute('WITH ins AS ( \
+                                INSERT INTO tracker_leaderboardentry \
+                                (board, skill_id, period, rank, \
+                                 rsaccount_id, username, experience, hours, \
+                                 start_id, end_id, entry_id) \
+                                SELECT %%s, %%s, %%s, row_number() OVER \
+                                (ORDER BY r.value DESC, r.id DESC), \
+                                r.rsaccount_id, r.username, r.experience, \
+                                r.hours, r.start_id, r.end_id, r.id \
+                                FROM (%s) AS r \
+                                RETURNING %s AS value \
+                            ) \
+                            INSERT INTO tracker_leaderboard \
+                            (board, skill_id, period, size, min_value, \
+                             updated) \
+                            SELECT %%s, %%s, %%s, count(*), \
+                            COALESCE(min(value), 0), now() FROM ins \
+                            ON CONFLICT (board, skill_id, period) DO UPDATE \
+                            SET size = EXCLUDED.size, \
+                            min_value = EXCLUDED.min_value, \
+                            updated = EXCLUDED.updated'
+                           % (ranking_sql(board, skill_id),
+                              VALUE % {'t': 'tracker_leaderboardentry'}),
+                           key + [skill_id, period, size] + key)
+            pagination.store_anchors(cursor,
+                                     board_ranking(board, skill_id, period),
+                                     ranking_sql(board, skill_id),
+                                     [skill_id, period, None])
+
+    pagecache.bump(pagecache.board_key(*b) for b in boards)
+
+
+def refresh_all(**kwargs):
+    """
+    Rebuild the snapshots and page anchors of every leaderboard.
+
+    Arguments:
+        boards (list of str) - boards to rebuild (default all)
+        skill_ids (list of int) - skills to rebuild (default all)
+    """
+
+    boards = kwargs.get('boards', sorted(BOARD_TABLES))
+    skill_ids = kwargs.get('skill_ids')
+    if skill_ids is None:
+        skill_ids = skillregistry.skill_ids()
+
+    keys = []
+    for board in boards:
+        for skill_id in skill_ids:
+            # Original QHA is not tracked by Current.
+            if board == Leaderboard.CURRENT \
+                    and skill_id == Skill.ORIG_QHA_ID:
+                continue
+            keys.extend((board, skill_id, p) for p in BOARD_PERIODS[board])
+
+    with transaction.atomic():
+        refresh(keys)
+
+    return len(keys)
+
+
+def update_accounts(acc_ids, record_ids):
+    """
+    Update the leaderboard snapshots affected by an update of a set of
+    accounts. A Current snapshot is affected if it ranks one of the accounts
+    or one of their entries can now enter it; a Record snapshot is affected
+    if one of the changed records can enter it. Only the rows of the changed
+    entries and of the entries whose ranks they shift are rewritten (see
+    `merge_entries`). Leaderboards without snapshots are ranked on demand and
+    are not created here. Must be called inside a transaction.
+
+    Arguments:
+        acc_ids (list of int) - accounts whose Current entries changed
+        record_ids (list of int) - IDs of the Record entries which changed
+    """
+
+    if not acc_ids:
+        return
+
+    # Selects the leaderboard and `ranking_sql` row of a changed entry `t`,
+    # and whether it is ranked at all.
+    columns = 'l.board, l.skill_id, l.period, t.id, %s, t.rsaccount_id, \
+               a.username, t.experience, t.hours, t.start_id, t.end_id, %s' \
+              % (VALUE % {'t': 't'}, QUALIFIES % {'t': 't'})
+
+    # An entry enters a leaderboard which is not full, or by beating its
+    # lowest entry.
+    enters = '%s AND (l.size < %%(size)s OR %s >= l.min_value)' \
+             % (QUALIFIES, VALUE) % {'t': 't', 'size': '%(size)s'}
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT %s FROM tracker_current t \
+                        JOIN tracker_rsaccount a ON a.id = t.rsaccount_id \
+                        JOIN tracker_leaderboard l ON l.board = %%(current)s \
+                        AND l.skill_id = t.skill_id AND l.period = t.period \
+                        LEFT JOIN tracker_leaderboardentry e \
+                        ON e.board = l.board AND e.skill_id = l.skill_id \
+                        AND e.period = l.period \
+                        AND e.rsaccount_id = t.rsaccount_id \
+                        WHERE t.rsaccount_id = ANY(%%(accounts)s) \
+                        AND (e.id IS NOT NULL OR %s) \
+                        UNION ALL \
+                        SELECT %s FROM tracker_record t \
+                        JOIN tracker_rsaccount a ON a.id = t.rsaccount_id \
+                        JOIN tracker_leaderboard l ON l.board = %%(records)s \
+                        AND l.skill_id = t.skill_id AND l.period = t.period \
+                        WHERE t.id = ANY(%%(changed)s) AND %s'
+                       % (columns, enters, columns, enters),
+                       {
+                           'current': Leaderboard.CURRENT,
+                           'records': Leaderboard.RECORDS,
+                           'accounts': list(acc_ids),
+                           'changed': list(record_ids),
+                           'size': board_size(),
+                       })
+
+        changes = {}
+        for row in cursor.fetchall():
+            changes.setdefault(row[:3], []).append(row[3:])
+
+        boards = sorted(changes)
+        for board, skill_id, period in boards:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                           [LEADERBOARD_LOCK, lock_key(board, skill_id,
+                                                       period)])
+
+        updated = [key for key in boards
+                   if merge_entries(cursor, key, changes[key])]
+
+    pagecache.bump(pagecache.board_key(*b) for b in updated)
+
+
+def merge_entries(cursor, key, changed):
+    """
+    Merge changed entries into the snapshot of a leaderboard. Entries which
+    left the snapshot are replaced by the next ranked entries if it was full.
+    Only rows whose entries or ranks changed are rewritten. The leaderboard's
+    lock must be held.
+
+    Arguments:
+        cursor - database cursor
+        key (tuple) - (board, skill ID, period) of the leaderboard
+        changed (list of tuples) - rows of the changed entries in the format
+        of `ranking_sql`, each followed by whether the entry is ranked
+
+    Returns whether the snapshot changed.
+    """
+
+    board, skill_id, period = key
+    size = board_size()
+    changed_ids = [row[0] for row in changed]
+
+    cursor.execute('SELECT entry_id, %s, rsaccount_id, username, \
+                    experience, hours, start_id, end_id \
+                    FROM tracker_leaderboardentry \
+                    WHERE board = %%s AND skill_id = %%s AND period = %%s \
+                    ORDER BY rank' % value_column(skill_id), list(key))
+    old = cursor.fetchall()
+
+    rows = [row for row in old if row[0] not in changed_ids]
+    rows.extend(row[:-1] for row in changed if row[-1])
+
+    if len(old) >= size:
+        # Entries ranked below a full snapshot move up into the ranks left
+        # by entries which dropped out of it.
+        cutoff = (old[-1][1], old[-1][0])
+        above = sum(1 for row in rows if (row[1], row[0]) >= cutoff)
+        if above < size:
+            cursor.execute(ranking_sql(board, skill_id, keyset=True,
+                                       condition='AND t.id <> ALL(%s)'),
+                           [skill_id, period] + list(cutoff)
+                           + [changed_ids, size - above])
+            rows.extend(cursor.fetchall())
+
+    rows.sort(key=lambda row: (row[1], row[0]), reverse=True)
+    rows = rows[:size]
+
+    old_ranks = dict((row[0], (rank, row))
+                     for rank, row in enumerate(old, 1))
+    ranked = set(row[0] for row in rows)
+    write = [(rank, row) for rank, row in enumerate(rows, 1)
+             if old_ranks.get(row[0]) != (rank, tuple(row))]
+    delete = [i for i in old_ranks if i not in ranked] \
+        + [row[0] for _, row in write if row[0] in old_ranks]
+
+    if not write and not delete:
+        return False
+
+    # Rows are deleted before they are written with their new ranks, so no
+    # two rows of the snapshot share a rank at any point.
+    if delete:
+        cursor.execute('DELETE FROM tracker_leaderboardentry \
+                        WHERE board = %s AND skill_id = %s AND period = %s \
+                        AND entry_id = ANY(%s)', list(key) + [delete])
+
+    if write:
+        params = []
+        for rank, row in write:
+            params.extend(list(key) + [rank] + list(row[2:]) + [row[0]])
+        cursor.execute('INSERT INTO tracker_leaderboardentry \
+                        (board, skill_id, period, rank, rsaccount_id, \
+                         username, experience, hours, start_id, end_id, \
+                         entry_id) VALUES %s'
+                       % ', '.join(['(%s)' % ', '.join(['%s'] * 11)]
+                                   * len(write)), params)
+
+    cursor.execute('UPDATE tracker_leaderboard \
+                    SET size = %s, min_value = %s, updated = now() \
+                    WHERE board = %s AND skill_id = %s AND period = %s',
+                   [len(rows), rows[-1][1] if rows else 0] + list(key))
+
+    return True
+
+
+def lock_key(board, skill_id, period):
+    """
+    Return the advisory lock key of a leaderboard.
+    """
+
+    return (ord(board) << 16) | (skill_id << 8) | ord(period)
@@ -0,0 +1,170 @@
+#
+# tracker/modules/levelstorage.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.conf import settings
+from django.db import connection
+
+from tracker.models import *
+
+# Storage modes of skill levels: one SkillLevel row per skill, or one
+# PackedLevels row per datapoint.
+ROWS = 'rows'
+COLUMNS = 'columns'
+
+# Number of skills stored at each datapoint, Overall included.
+NUM_SKILLS = 24
+
+# PackedLevels unpacked into rows with the columns of tracker_skilllevel.
+# Array positions start at 1 and skill IDs at 0.
+UNPACKED = '(SELECT p.datapoint_id, (u.i - 1)::smallint AS skill_id, \
+             u.experience, u.rank, u.current_hours, u.original_hours \
+             FROM tracker_packedlevels p \
+             CROSS JOIN LATERAL unnest(p.experience, p.rank, \
+                                       p.current_hours, p.original_hours) \
+             WITH ORDINALITY AS u (experience, rank, current_hours, \
+                                   original_hours, i))'
+
+
+def mode():
+    """
+    Return the storage mode of skill levels, set by TRACKER_LEVEL_STORAGE.
+    """
+
+    storage = getattr(settings, 'TRACKER_LEVEL_STORAGE', ROWS)
+    if storage not in (ROWS, COLUMNS):
+        raise StorageModeError('Unknown level storage mode %r.' % storage)
+
+    return storage
+
+
+def table(**kwargs):
+    """
+    Return an SQL relation holding one row per datapoint and skill, with the
+    datapoint_id, skill_id, experience, rank, current_hours and
+    original_hours columns of tracker_skilllevel, for use in a FROM or JOIN
+    clause in either storage mode.
+
+    Arguments:
+        storage (str) - storage mode to read (default the configured mode)
+    """
+
+    storage = kwargs.get('storage') or mode()
+    return UNPACKED if storage == COLUMNS else 'tracker_skilllevel'
+
+
+def save(levels, **kwargs):
+    """
+    Write the SkillLevel entries of a set of datapoints with a single insert.
+
+    Arguments:
+        levels (list of SkillLevel) - unsaved entries of every skill at each
+        datapoint, in order of datapoint and skill ID
+        storage (str) - storage mode to write (default the configured mode)
+    """
+
+    storage = kwargs.get('storage') or mode()
+    if storage == ROWS:
+        SkillLevel.objects.bulk_create(levels)
+        return
+
+    PackedLevels.objects.bulk_create([
+        pack(levels[i:i + NUM_SKILLS])
+        for i in range(0, len(levels), NUM_SKILLS)
+    ])
+
+
+def pack(levels):
+    """
+    Return an unsaved PackedLevels holding the SkillLevel entries of a single
+    datapoint, ordered by skill ID.
+    """
+
+    return PackedLevels(datapoint=levels[0].datapoint,
+                        experience=[l.experience for l in levels],
+                        rank=[l.rank for l in levels],
+                        current_hours=[l.current_hours for l in levels],
+                        original_hours=[l.original_hours for l in levels])
+
+
+def convert(storage, start, end, **kwargs):
+    """
+    Copy the skill levels of the datapoints with IDs from `start` up to, but
+    excluding, `end` into the given storage mode. Datapoints already stored
+    in that mode are skipped, and incomplete datapoints are not packed.
+
+    Arguments:
+        storage (str) - storage mode to convert to, ROWS or COLUMNS
+        start (int) - first datapoint ID of the batch
+        end (int) - datapoint ID following the batch
+        delete (bool) - delete the converted levels from the other storage
+        (default False)
+
+    Returns the number of datapoints converted.
+    """
+
+    delete = kwargs.get('delete', False)
+
+    with connection.cursor() as cursor:
+        if storage == COLUMNS:
+            cursor.execute('INSERT INTO tracker_packedlevels (datapoint_id, \
+                            experience, rank, current_hours, original_hours) \
+                            SELECT s.datapoint_id, \
+                            array_agg(s.experience ORDER BY s.skill_id), \
+                            array_agg(s.rank ORDER BY s.skill_id), \
+                            array_agg(s.current_hours ORDER BY s.skill_id), \
+                            array_agg(s.original_hours ORDER BY s.skill_id) \
+                            FROM tracker_skilllevel s \
+                            WHERE s.datapoint_id >= %s \
+                            AND s.datapoint_id < %s \
+                            GROUP BY s.datapoint_id HAVING count(*) = %s \
+                            AND min(s.skill_id) = 0 \
+                            AND max(s.skill_id) = %s \
+                            ON CONFLICT (datapoint_id) DO NOTHING',
+                           [start, end, NUM_SKILLS, NUM_SKILLS - 1])
+            converted = cursor.rowcount
+            if delete:
+                cursor.execute('DELETE FROM tracker_skilllevel s \
+                                USING tracker_packedlevels p \
+                                WHERE s.datapoint_id = p.datapoint_id \
+                                AND p.datapoint_id >= %s \
+                                AND p.datapoint_id < %s', [start, end])
+        elif storage == ROWS:
+            cursor.execute('INSERT INTO tracker_skilllevel (datapoint_id, \
+                            skill_id, experience, rank, current_hours, \
+                            original_hours) \
+                            SELECT u.datapoint_id, u.skill_id, u.experience, \
+                            u.rank, u.current_hours, u.original_hours \
+                            FROM %s u \
+                            WHERE u.datapoint_id >= %%s \
+                            AND u.datapoint_id < %%s \
+                            ON CONFLICT (skill_id, datapoint_id) DO NOTHING'
+                           % UNPACKED, [start, end])
+            converted = cursor.rowcount // NUM_SKILLS
+            if delete:
+                cursor.execute('DELETE FROM tracker_packedlevels \
+                                WHERE datapoint_id >= %s \
+                                AND datapoint_id < %s', [start, end])
+        else:
+            raise StorageModeError('Unknown level storage mode %r.'
+                                   % storage)
+
+    return converted
+
+
+class StorageModeError(Exception):
+    pass
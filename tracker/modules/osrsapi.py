@@ -16,21 +16,177 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import re
+import time
+import threading
 import requests
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from requests.adapters import HTTPAdapter
 
 OSRS_HS_API = 'http://services.runescape.com/m=hiscore_oldschool'
 OSRS_HS_REQ = '/index_lite.ws?player='
 
+# Number of skills at the start of a hiscores response, Overall included.
+# Activity and boss scores follow them.
+NUM_SKILLS = 24
+
+# Matches the skill lines of a hiscores response, three integers each.
+SKILL_LINES = re.compile(rb'(?:-?\d+,-?\d+,-?\d+\r?\n){%d}'
+                         rb'-?\d+,-?\d+,-?\d+(?=\r|\n|$)'
+                         % (NUM_SKILLS - 1))
+
 def hiscore_lookup(username, **kwargs):
-    url = OSRS_HS_API + OSRS_HS_REQ + username
+    """
+    Look up a player on the OSRS hiscores using the shared client and return
+    the parsed response (see `parse_hiscores`).
+    """
+
+    return hiscores_client().lookup(username)
+
+
+def parse_hiscores(body):
+    """
+    Decode the body of a hiscores response into a flat array of NUM_SKILLS
+    (rank, level, experience) triples indexed by skill ID, so the
+    experience in skill i is at index 3 * i + 2. Unranked skills have rank
+    and experience -1. The activity and boss lines following the skills are
+    not decoded.
+
+    The skill lines are validated by a single match against the raw bytes,
+    without decoding the response. The matched bytes are copied out, copied
+    again with their line breaks turned into commas, and split into
+    NUM_SKILLS * 3 fields; int() ignores the carriage returns of CRLF lines.
+    Each field is converted as the array is filled, with no intermediate
+    list or per-line tuples.
+
+    Arguments:
+        body (bytes or str) - the body of the response
+
+    Raises HiscoresFormatError if the response does not start with NUM_SKILLS
+    lines of three integers.
+    """
+
+    if isinstance(body, str):
+        body = body.encode()
+
+    m = SKILL_LINES.match(body)
+    if m is None:
+        raise HiscoresFormatError
+
+    try:
+        return array('q', map(int, m.group(0).replace(b'\n', b',')
+                                             .split(b',')))
+    except OverflowError:
+        raise HiscoresFormatError
+
+
+class HiscoresClient(object):
+    """
+    Client for the OSRS hiscores API. Keeps a pool of keep-alive connections
+    which is shared between threads and retries failed requests with an
+    exponential backoff.
+
+    Arguments:
+        base_url (str) - hiscores API location, e.g. a local stub server
+        timeout (float) - seconds to wait for a response
+        retries (int) - times to retry a request which failed with
+        an OsrsRequestError
+        backoff (float) - seconds to wait before the first retry; doubled for
+        each subsequent retry
+        pool_size (int) - maximum number of pooled connections
+    """
+
+    def __init__(self, base_url=OSRS_HS_API, timeout=10, retries=2,
+                 backoff=0.5, pool_size=10):
+        self.url = base_url + OSRS_HS_REQ
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    r = requests.get(url)
-    if r.status_code == 200:
-        return r.text.split('\n')[:24]
-    elif r.status_code == 404:
-        raise PlayerNotFoundError
-    else:
-        raise OsrsRequestError
+    def lookup(self, username):
+        """
+        Return the parsed hiscores response of player `username` (see
+        `parse_hiscores`). Raises PlayerNotFoundError if the player does not
+        exist, HiscoresFormatError if the response is malformed and
+        OsrsRequestError once all retries have failed. Malformed responses
+        are not retried.
+        """
+
+        attempt = 0
+        while True:
+            try:
+                return self._request(username)
+            except OsrsRequestError:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    def lookup_many(self, usernames, workers=None):
+        """
+        Look up several players concurrently. Return a dictionary mapping each
+        username to its parsed response or the exception raised while looking
+        it up.
+        """
+
+        def lookup(username):
+            try:
+                return self.lookup(username)
+            except (PlayerNotFoundError, OsrsRequestError,
+                    HiscoresFormatError) as e:
+                return e
+
+        usernames = list(usernames)
+        if workers is None:
+            workers = self.pool_size
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            return dict(zip(usernames, executor.map(lookup, usernames)))
+
+    def _request(self, username):
+        try:
+            r = self.session.get(self.url + username, timeout=self.timeout)
+        except requests.RequestException:
+            raise OsrsRequestError
+
+        if r.status_code == 200:
+            return parse_hiscores(r.content)
+        elif r.status_code == 404:
+            raise PlayerNotFoundError
+        else:
+            raise OsrsRequestError
+
+
+__client = None
+__client_lock = threading.Lock()
+
+def hiscores_client():
+    """
+    Return the process-wide HiscoresClient, configured from the
+    TRACKER_HISCORES_* settings.
+    """
+
+    global __client
+
+    with __client_lock:
+        if __client is None:
+            __client = HiscoresClient(
+                base_url=getattr(settings, 'TRACKER_HISCORES_URL',
+                                 OSRS_HS_API),
+                timeout=getattr(settings, 'TRACKER_HISCORES_TIMEOUT', 10),
+                retries=getattr(settings, 'TRACKER_HISCORES_RETRIES', 2),
+                backoff=getattr(settings, 'TRACKER_HISCORES_BACKOFF', 0.5),
+                pool_size=getattr(settings, 'TRACKER_HISCORES_POOL_SIZE', 10))
+
+    return __client
 
 
 class PlayerNotFoundError(Exception):
@@ -38,3 +194,6 @@ class PlayerNotFoundError(Exception):
 
 class OsrsRequestError(Exception):
     pass
+
+class HiscoresFormatError(Exception):
+    pass
@@ -0,0 +1,251 @@
+#
+# tracker/modules/pagecache.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+# Prefix of the version keys in the version cache.
+VERSION_PREFIX = 'tracker:version:'
+
+# Version of the virtual hiscores pages, bumped whenever accounts are
+# updated.
+VIRTUAL_KEY = 'virtual'
+
+
+def account_key(username):
+    """
+    Return the version key of the pages of an account.
+    """
+
+    return 'player:%s' % username.lower()
+
+
+def board_key(board, skill_id, period):
+    """
+    Return the version key of the pages showing a leaderboard.
+    """
+
+    return 'board:%s:%d:%s' % (board, skill_id, period)
+
+
+def version_cache():
+    """
+    Return the cache holding page versions, set by TRACKER_PAGE_VERSION_CACHE.
+    It has to be shared by every process which updates accounts or serves
+    pages, e.g. memcached, for pages to be invalidated across processes.
+    """
+
+    return caches[getattr(settings, 'TRACKER_PAGE_VERSION_CACHE', 'default')]
+
+
+def versions(keys):
+    """
+    Return the versions of a list of version keys: the time at which each was
+    last bumped, or first looked up.
+    """
+
+    cache = version_cache()
+    names = [VERSION_PREFIX + k for k in keys]
+    found = cache.get_many(names)
+
+    now = time.time()
+    for name in names:
+        if name not in found:
+            cache.add(name, now, None)
+            found[name] = cache.get(name, now)
+
+    return [found[name] for name in names]
+
+
+def bump(keys):
+    """
+    Bump the versions of a list of version keys once the current transaction
+    commits, so pages rendered before the commit are not cached under the
+    new versions.
+    """
+
+    keys = list(keys)
+    if not keys:
+        return
+
+    def set_versions():
+        now = time.time()
+        version_cache().set_many(dict((VERSION_PREFIX + k, now)
+                                      for k in keys), None)
+
+    transaction.on_commit(set_versions)
+
+
+class FragmentCache(object):
+    """
+    Rendered pages keyed by ETag, held in memory up to a total size in bytes.
+    The least recently used pages are evicted once the size is exceeded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, key):
+        """
+        Return the content cached under `key`, or None.
+        """
+
+        with self._lock:
+            content = self._pages.get(key)
+            if content is not None:
+                self._pages.move_to_end(key)
+            return content
+
+    def put(self, key, content):
+        """
+        Cache `content` under `key`. Content larger than the whole cache is
+        not stored.
+        """
+
+        if len(content) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._pages[key] = content
+            self.size += len(content)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.size = 0
+
+
+__fragments = None
+__fragments_lock = threading.Lock()
+
+
+def fragments():
+    """
+    Return the process-wide FragmentCache, holding up to
+    TRACKER_PAGE_CACHE_SIZE bytes (default 16 MB).
+    """
+
+    global __fragments
+
+    with __fragments_lock:
+        if __fragments is None:
+            __fragments = FragmentCache(getattr(settings,
+                                                'TRACKER_PAGE_CACHE_SIZE',
+                                                16 * 1024 * 1024))
+
+    return __fragments
+
+
+def ttl_start():
+    """
+    Return the start of the current period of TRACKER_PAGE_CACHE_TTL seconds
+    (default 60), as a timestamp.
+    """
+
+    ttl = getattr(settings, 'TRACKER_PAGE_CACHE_TTL', 60)
+    return time.time() // ttl * ttl
+
+
+def cached(keys, **kwargs):
+    """
+    Decorator serving a view's GET requests with ETag and Last-Modified
+    validators derived from the versions of the data the page shows. Requests
+    whose validators match get a 304 response; other requests for a page
+    which has not changed are answered from the FragmentCache.
+
+    Pages are revalidated at least every TRACKER_PAGE_CACHE_TTL seconds
+    (default 60), as their periods move on with time even when no version
+    changes.
+
+    Arguments:
+        keys (function) - called with the view's arguments, without the
+        request; returns the version keys of the page
+        vary (function) - called with the request; returns a value, other
+        than the URL, which the page depends on
+    """
+
+    vary = kwargs.get('vary')
+
+    # The versions and ETag are computed once per request and stored on it,
+    # as they are needed by both the validators and the view.
+    def page_versions(request, *args, **kwargs):
+        if not hasattr(request, 'page_versions'):
+            request.page_versions = versions(keys(*args, **kwargs))
+        return request.page_versions
+
+    def etag(request, *args, **kwargs):
+        if not hasattr(request, 'page_etag'):
+            key = repr((request.get_full_path(),
+                        vary(request) if vary else None,
+                        page_versions(request, *args, **kwargs),
+                        ttl_start()))
+            request.page_etag = hashlib.sha1(key.encode()).hexdigest()
+        return request.page_etag
+
+    def last_modified(request, *args, **kwargs):
+        changed = max(page_versions(request, *args, **kwargs) + [ttl_start()])
+        return datetime.fromtimestamp(changed, timezone.utc)
+
+    def decorator(view):
+        @functools.wraps(view)
+        def cached_view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            tag = etag(request, *args, **kwargs)
+            content = fragments().get(tag)
+            if content is not None:
+                response = HttpResponse(content)
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    fragments().put(tag, response.content)
+
+            # Browsers revalidate the page each time it is shown.
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        return condition(etag_func=etag,
+                         last_modified_func=last_modified)(cached_view)
+
+    return decorator
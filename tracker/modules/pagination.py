@@ -0,0 +1,125 @@
+#
+# tracker/modules/pagination.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from tracker.models import PageAnchor
+
+# Keyset pagination cursors identify the last entry of a page by its
+# (value, ID) pair. They are passed between pages in the `after` query
+# parameter as "value:ID".
+
+
+def encode_cursor(cursor):
+    """
+    Return the query parameter form of a (value, ID) cursor.
+    """
+
+    value, entry_id = cursor
+    return '%r:%d' % (value, entry_id)
+
+
+def decode_cursor(param):
+    """
+    Parse a cursor query parameter into a (value, ID) tuple. Returns None if
+    the parameter is missing or malformed.
+    """
+
+    if not param:
+        return None
+
+    value, _, entry_id = param.partition(':')
+    try:
+        entry_id = int(entry_id)
+        try:
+            value = int(value)
+        except ValueError:
+            value = float(value)
+    except ValueError:
+        return None
+
+    return value, entry_id
+
+
+def page_cursor(request):
+    """
+    Return the cursor passed to a page request, if any.
+    """
+
+    return decode_cursor(request.GET.get('after'))
+
+
+# Numbered pages of a ranked table are found through its anchors: the
+# cursors of every ANCHOR_INTERVAL-th entry, stored when the table is ranked
+# in full. A page is read by keyset from the anchor preceding it, so deep
+# pages cost the same as the first.
+ANCHOR_INTERVAL = 25
+
+
+def store_anchors(cursor, ranking, ranked, params):
+    """
+    Replace the anchors of a ranked table.
+
+    Arguments:
+        cursor - database cursor
+        ranking (str) - name of the ranked table
+        ranked (str) - query selecting the entries of the table with their
+        values and IDs in columns named `value` and `id`
+        params (list) - parameters of the query
+    """
+
+    cursor.execute('DELETE FROM tracker_pageanchor WHERE ranking = %s',
+                   [ranking])
+    cursor.execute('INSERT INTO tracker_pageanchor \
+                    (ranking, page, value, entry_id) \
+                    SELECT %%s, r.n / %d, r.value, r.id FROM ( \
+                        SELECT value, id, row_number() OVER \
+                        (ORDER BY value DESC, id DESC) AS n \
+                        FROM (%s) AS e \
+                    ) AS r WHERE r.n %%%% %d = 0'
+                   % (ANCHOR_INTERVAL, ranked, ANCHOR_INTERVAL),
+                   [ranking] + list(params))
+
+
+def find_page(ranking, start):
+    """
+    Locate the entries of a ranked table from rank `start` + 1 by the anchor
+    preceding them. Returns a (cursor, skip) tuple: the entries are those
+    following the cursor, or the top of the table if it is None, after the
+    first `skip` of them, which are fewer than ANCHOR_INTERVAL. Returns None
+    if the table has no anchor that deep, i.e. the page was past its end
+    when its anchors were stored.
+
+    Arguments:
+        ranking (str) - name of the ranked table
+        start (int) - number of entries ranked above the page
+    """
+
+    page, skip = divmod(start, ANCHOR_INTERVAL)
+    if not page:
+        return None, skip
+
+    anchor = PageAnchor.objects.filter(ranking=ranking, page=page) \
+                               .values_list('value', 'entry_id').first()
+    if anchor is None:
+        return None
+
+    value, entry_id = anchor
+    # Experience is ranked as an integer; a float bound would keep the
+    # ranking index from being used.
+    if value.is_integer():
+        value = int(value)
+    return (value, entry_id), skip
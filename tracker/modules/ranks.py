@@ -0,0 +1,223 @@
+#
+# tracker/modules/ranks.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import threading
+import time
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from tracker.models import TimePlayed
+
+# Values closer than this are tied. Hours are sums of floating point values
+# calculated in different orders, so equal totals may differ slightly.
+TIE_TOLERANCE = 1e-6
+
+
+class RankIndex(object):
+    """
+    Sorted array of values answering rank queries by bisection. Higher values
+    rank higher, and tied values share the best rank among them.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = sorted(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def greater(self, value):
+        """
+        Return the number of values greater than `value`.
+        """
+
+        return len(self.values) - bisect.bisect_right(self.values,
+                                                      value + TIE_TOLERANCE)
+
+    def rank(self, value):
+        """
+        Return the rank `value` would have in the index.
+        """
+
+        return self.greater(value) + 1
+
+    def value_at(self, rank):
+        """
+        Return the value at a rank, counting from 1. Raises IndexError if
+        the rank is out of range.
+        """
+
+        if rank < 1 or rank > len(self.values):
+            raise IndexError('rank %d out of range' % rank)
+
+        return self.values[len(self.values) - rank]
+
+    def ranks_after(self, changes):
+        """
+        Return the rank each new value would have once a set of changes is
+        applied, without applying them. The index may be stale, so old values
+        which are not in it are not removed from it.
+
+        Arguments:
+            changes (list of tuples) - (old value, new value) pairs, where
+            old value is None for values which are not yet in the index
+        """
+
+        # Find the old values which are in the index, each matching a
+        # different value.
+        removed = []
+        matched = {}
+        for old, _ in changes:
+            if old is None:
+                continue
+            i = bisect.bisect_left(self.values, old - TIE_TOLERANCE)
+            j = bisect.bisect_right(self.values, old + TIE_TOLERANCE)
+            if i + matched.get(i, 0) < j:
+                removed.append(self.values[i + matched.get(i, 0)])
+                matched[i] = matched.get(i, 0) + 1
+
+        ranks = []
+
+        for _, value in changes:
+            greater = self.greater(value)
+            for old in removed:
+                if old > value + TIE_TOLERANCE:
+                    greater -= 1
+            for _, new in changes:
+                if new > value + TIE_TOLERANCE:
+                    greater += 1
+            ranks.append(max(greater, 0) + 1)
+
+        return ranks
+
+    def apply(self, changes):
+        """
+        Replace the old value of each (old value, new value) pair in
+        `changes` with its new value.
+        """
+
+        for old, new in changes:
+            if old is not None:
+                self.remove(old)
+            bisect.insort(self.values, new)
+
+    def remove(self, value):
+        """
+        Remove a value, or one tied with it, from the index.
+        """
+
+        i = bisect.bisect_left(self.values, value - TIE_TOLERANCE)
+        if i < len(self.values) and self.values[i] <= value + TIE_TOLERANCE:
+            del self.values[i]
+
+
+__index = None
+__loaded = 0
+__lock = threading.Lock()
+
+
+def time_played():
+    """
+    Return the cached RankIndex of the hours played by every account, loading
+    it from the database if it has been invalidated or is older than
+    TRACKER_RANKS_TTL seconds. Updates made by this process are applied to
+    the index as they are committed; the TTL bounds how long updates made by
+    other processes are missed.
+
+    The index is changed in place by other threads, so it must only be read
+    through `rank` and `ranks_after`.
+    """
+
+    with __lock:
+        return __load()
+
+
+def __load():
+    """
+    Return the cached index, reloading it if required. Must be called with
+    the lock held.
+    """
+
+    global __index, __loaded
+
+    ttl = getattr(settings, 'TRACKER_RANKS_TTL', 60)
+    now = time.time()
+
+    if __index is None or now - __loaded > ttl:
+        __index = RankIndex(TimePlayed.objects.values_list('hours',
+                                                           flat=True))
+        # The time at which the index was read, rather than when the read
+        # finished, tells which commits it holds.
+        __loaded = now
+
+    return __index
+
+
+def rank(hours):
+    """
+    Return the rank of an amount of hours played among every account.
+    """
+
+    with __lock:
+        return __load().rank(hours)
+
+
+def ranks_after(index, changes):
+    """
+    Return the ranks of new hours played once a set of (old hours, new
+    hours) changes is applied to `index`, a RankIndex returned by
+    `time_played` (see `RankIndex.ranks_after`).
+    """
+
+    with __lock:
+        return index.ranks_after(changes)
+
+
+def time_played_changed(changes):
+    """
+    Apply committed changes in hours played, as (old hours, new hours) pairs,
+    to the cached index. Must be called once the changes are committed. If
+    the index has been reloaded since then, it already holds them and they
+    are skipped.
+    """
+
+    committed = time.time()
+
+    with __lock:
+        if __index is not None and __loaded < committed:
+            __index.apply(changes)
+
+
+def invalidate():
+    """
+    Discard the cached rank index. It is reloaded on next use.
+    """
+
+    global __index
+
+    with __lock:
+        __index = None
+
+
+@receiver(post_save, sender=TimePlayed)
+@receiver(post_delete, sender=TimePlayed)
+def timeplayed_changed(sender, **kwargs):
+    invalidate()
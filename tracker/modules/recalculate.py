@@ -0,0 +1,375 @@
+#
+# tracker/modules/recalculate.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import multiprocessing
+import os
+import time
+from django.db import connection, connections, transaction
+
+from tracker.models import *
+from tracker.modules import accounttracker, history, leaderboard, \
+    levelstorage, skillrates, summary
+
+# Experience value above any reachable amount, closing the last rate segment.
+MAX_EXP = 2 ** 62
+
+
+def recalculate_hours(modified_skills, **kwargs):
+    """
+    Recalculate hours played for each skill ID in `modified_skills`
+    for every datapoint in the database, and rebuild all QHA records and
+    current QHA gains.
+
+    Accounts are processed in parallel and each one is locked while it is
+    being recalculated. Progress is written to a checkpoint file so that an
+    interrupted run can be resumed by calling this function again with the
+    same file.
+
+    Arguments:
+        modified_skills (list of int) - skills whose rates have changed
+        recalc_orig (bool) - also overwrite original hours and Original QHA
+        records (default False)
+        processes (int) - number of worker processes (default 1)
+        checkpoint (str) - path of the checkpoint file (default None)
+    """
+
+    orig = kwargs.get('recalc_orig', False)
+    processes = kwargs.get('processes', 1)
+    checkpoint = kwargs.get('checkpoint')
+
+    modified_skills = sorted(set(modified_skills) - set([0]))
+    done = read_checkpoint(checkpoint, modified_skills, orig)
+
+    if done is None:
+        Record.objects.filter(skill_id=Skill.QHA_ID).update(hours=0)
+        if orig:
+            Record.objects.filter(skill_id=Skill.ORIG_QHA_ID).update(hours=0)
+        done = set()
+        write_checkpoint(checkpoint, modified_skills, orig)
+    else:
+        print('Resuming recalculation: %d accounts already done.' % len(done))
+
+    # Make sure the latest rates are used.
+    skillrates.invalidate()
+    segments = rate_segments(modified_skills)
+
+    accounts = RSAccount.objects.order_by('id').values_list('id', flat=True)
+    acc_ids = [a for a in accounts if a not in done]
+    jobs = [(a, modified_skills, orig) for a in acc_ids]
+    progress = Progress(len(acc_ids))
+
+    out = open(checkpoint, 'a') if checkpoint else None
+    try:
+        if processes > 1:
+            # Worker processes must not share the parent's connection.
+            connections.close_all()
+            pool = multiprocessing.Pool(processes, initializer=init_worker,
+                                        initargs=(segments,))
+            try:
+                for acc_id, points in pool.imap_unordered(recalculate_single,
+                                                          jobs):
+                    progress.update(points)
+                    if out:
+                        out.write('%d\n' % acc_id)
+                        out.flush()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_worker(segments)
+            for job in jobs:
+                acc_id, points = recalculate_single(job)
+                progress.update(points)
+                if out:
+                    out.write('%d\n' % acc_id)
+                    out.flush()
+    finally:
+        if out:
+            out.close()
+
+    progress.report()
+    leaderboard.refresh_all(skill_ids=[Skill.QHA_ID, Skill.ORIG_QHA_ID])
+    summary.rebuild_summaries()
+    if checkpoint:
+        os.remove(checkpoint)
+
+
+def recalculate_single(job):
+    """
+    Recalculate hours played for all datapoints belonging to a single account
+    for each skill ID in `modified_skills`, and update the account's QHA
+    records and current QHA gains. `job` is a tuple (account ID,
+    modified_skills, orig).
+    Return the account ID and the number of datapoints processed.
+    """
+
+    acc_id, modified_skills, orig = job
+
+    with transaction.atomic():
+        accounttracker.lock_accounts([acc_id])
+
+        with connection.cursor() as cursor:
+            if levelstorage.mode() == levelstorage.COLUMNS:
+                recalculate_packed(cursor, acc_id, orig)
+            else:
+                recalculate_rows(cursor, acc_id, orig)
+
+            cursor.execute('SELECT d.id, d.time, s.current_hours, \
+                            COALESCE(d.last_checked, d.time) \
+                            FROM tracker_datapoint d \
+                            JOIN %s s \
+                            ON s.datapoint_id = d.id AND s.skill_id = 0 \
+                            WHERE d.rsaccount_id = %%s ORDER BY d.time'
+                           % levelstorage.table(), [acc_id])
+            points = cursor.fetchall()
+
+            # Current QHA gains are the difference in the Overall hours
+            # stored at their datapoints, as in `sweeper.sweep_batch`.
+            cursor.execute('UPDATE tracker_current c \
+                            SET hours = COALESCE(e.current_hours \
+                                                 - s.current_hours, 0) \
+                            FROM tracker_current x \
+                            LEFT JOIN %s s \
+                            ON s.datapoint_id = x.start_id AND s.skill_id = 0 \
+                            LEFT JOIN %s e \
+                            ON e.datapoint_id = x.end_id AND e.skill_id = 0 \
+                            WHERE c.id = x.id AND c.rsaccount_id = %%s \
+                            AND c.skill_id = %%s'
+                           % (levelstorage.table(), levelstorage.table()),
+                           [acc_id, Skill.QHA_ID])
+
+        update_qha_records(acc_id, points, orig)
+
+    return acc_id, len(points)
+
+
+def recalculate_rows(cursor, acc_id, orig):
+    """
+    Recalculate the hours of an account stored as SkillLevel rows from the
+    worker's rate segments.
+    """
+
+    columns = 'current_hours = %s, original_hours = %s' if orig \
+              else 'current_hours = %s'
+
+    # Recalculate hours for each modified skill from the rate segment its
+    # experience falls in.
+    if __segments:
+        hours = 'b.cum_hours + COALESCE((s.experience - b.start_exp) \
+                 ::double precision / NULLIF(b.rate, 0), 0)'
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(__segments))
+        params = [p for seg in __segments for p in seg]
+        cursor.execute('UPDATE tracker_skilllevel s SET %s \
+                        FROM (VALUES %s) AS b (skill_id, start_exp, end_exp, \
+                                               cum_hours, rate), \
+                        tracker_datapoint d \
+                        WHERE d.rsaccount_id = %%s \
+                        AND s.datapoint_id = d.id \
+                        AND s.skill_id = b.skill_id \
+                        AND s.experience > b.start_exp \
+                        AND s.experience <= b.end_exp'
+                       % (columns % ((hours,) * columns.count('%s')), values),
+                       params + [acc_id])
+
+    # Recalculate total hours for each datapoint.
+    cursor.execute('UPDATE tracker_skilllevel s \
+                    SET current_hours = t.hours \
+                    FROM (SELECT l.datapoint_id, \
+                          sum(l.current_hours) AS hours \
+                          FROM tracker_skilllevel l \
+                          JOIN tracker_datapoint d ON d.id = l.datapoint_id \
+                          WHERE d.rsaccount_id = %s AND l.skill_id != 0 \
+                          GROUP BY l.datapoint_id) AS t \
+                    WHERE s.datapoint_id = t.datapoint_id \
+                    AND s.skill_id = 0', [acc_id])
+
+
+def recalculate_packed(cursor, acc_id, orig):
+    """
+    Recalculate the hours of an account stored as PackedLevels arrays from
+    the worker's rate segments, rewriting each datapoint's arrays with a
+    single statement. The total hours played are stored first.
+    """
+
+    if __segments:
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(__segments))
+        params = [p for seg in __segments for p in seg]
+        segments = 'LEFT JOIN (VALUES %s) AS b (skill_id, start_exp, \
+                    end_exp, cum_hours, rate) \
+                    ON b.skill_id = s.i - 1 AND s.experience > b.start_exp \
+                    AND s.experience <= b.end_exp' % values
+        hours = 'CASE WHEN b.skill_id IS NULL THEN s.hours \
+                 ELSE b.cum_hours + COALESCE((s.experience - b.start_exp) \
+                 ::double precision / NULLIF(b.rate, 0), 0) END'
+    else:
+        params = []
+        segments = ''
+        hours = 's.hours'
+
+    # Hours of every skill in an array column, with their total in place of
+    # Overall's if `total` is set.
+    def recalculated(column, total):
+        first = 'sum(h.hours) OVER (ORDER BY h.i ROWS BETWEEN 1 FOLLOWING \
+                 AND UNBOUNDED FOLLOWING)' if total else 'h.hours'
+        return 'ARRAY(SELECT CASE WHEN h.i = 1 THEN %s ELSE h.hours END \
+                      FROM (SELECT s.i, %s AS hours \
+                            FROM unnest(p.experience, p.%s) \
+                            WITH ORDINALITY AS s (experience, hours, i) \
+                            %s) AS h \
+                      ORDER BY h.i)' % (first, hours, column, segments)
+
+    # As with SkillLevel rows, only the current total is recalculated.
+    columns = [('current_hours', True)]
+    if orig:
+        columns.append(('original_hours', False))
+
+    cursor.execute('UPDATE tracker_packedlevels p SET %s \
+                    FROM tracker_datapoint d \
+                    WHERE d.rsaccount_id = %%s AND p.datapoint_id = d.id'
+                   % ', '.join('%s = %s' % (c, recalculated(c, t))
+                               for c, t in columns),
+                   params * len(columns) + [acc_id])
+
+
+def update_qha_records(acc_id, points, orig):
+    """
+    Update the QHA records (and Original QHA records if `orig` is set) of an
+    account from its time-ordered (datapoint ID, time, hours, last checked)
+    tuples.
+    """
+
+    skill_ids = [Skill.QHA_ID, Skill.ORIG_QHA_ID] if orig else [Skill.QHA_ID]
+    records = {}
+    for r in Record.objects.filter(rsaccount_id=acc_id,
+                                   skill_id__in=skill_ids):
+        records[(r.skill_id, r.period)] = r
+
+    gains = history.window_gains([p[1] for p in points],
+                                 [p[2] for p in points],
+                                 accounttracker.PERIOD_LENGTHS, min_gain=0.01,
+                                 checked=[p[3] for p in points])
+
+    # Store all changed record values back into the database.
+    for period, (dh, start, end) in zip(history.RECORD_PERIODS, gains):
+        for skill_id in skill_ids:
+            rec = records[(skill_id, period)]
+            if dh > rec.hours:
+                rec.hours = dh
+                rec.start_id = points[start][0]
+                rec.end_id = points[end][0]
+                rec.save()
+
+
+def rate_segments(skill_ids):
+    """
+    Return a list of (skill ID, start_exp, end_exp, cum_hours, rate) tuples
+    covering every experience value of each skill in `skill_ids`, built from
+    the cached rate tables.
+    """
+
+    segments = []
+
+    for skill_id in skill_ids:
+        table = skillrates.rate_table(skill_id)
+        bp = table.breakpoints()
+
+        # No hours are played below the first rate.
+        first = bp[0][0] if bp else MAX_EXP
+        segments.append((skill_id, -1, first, 0.0, 0))
+
+        for start, end, cum, rate in bp:
+            segments.append((skill_id, start,
+                             end if end is not None else MAX_EXP,
+                             float(cum), rate))
+
+    return segments
+
+
+__segments = []
+
+def init_worker(segments):
+    """
+    Set up a recalculation worker with the rate segments to apply.
+    """
+
+    global __segments
+    __segments = segments
+
+
+def read_checkpoint(path, modified_skills, orig):
+    """
+    Return the set of account IDs recorded as done in the checkpoint file at
+    `path`, or None if there is no checkpoint to resume from.
+    """
+
+    if not path or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header != {'skills': modified_skills, 'orig': orig}:
+            raise RecalculationError('Checkpoint %s is for a different '
+                                     'recalculation.' % path)
+        return set(int(l) for l in f if l.strip())
+
+
+def write_checkpoint(path, modified_skills, orig):
+    """
+    Start a new checkpoint file at `path`.
+    """
+
+    if path:
+        with open(path, 'w') as f:
+            f.write(json.dumps({'skills': modified_skills, 'orig': orig}))
+            f.write('\n')
+
+
+class Progress(object):
+    """
+    Tracks and periodically prints the throughput of a job processing
+    accounts.
+    """
+
+    INTERVAL = 10
+
+    def __init__(self, total, action='recalculated'):
+        self.total = total
+        self.action = action
+        self.accounts = 0
+        self.points = 0
+        self.start = time.time()
+        self.last = self.start
+
+    def update(self, points, accounts=1):
+        self.accounts += accounts
+        self.points += points
+
+        if time.time() - self.last >= self.INTERVAL:
+            self.report()
+            self.last = time.time()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        print('%d/%d accounts %s (%.1f accounts/s, %.1f datapoints/s)'
+              % (self.accounts, self.total, self.action,
+                 self.accounts / elapsed, self.points / elapsed))
+
+
+class RecalculationError(Exception):
+    pass
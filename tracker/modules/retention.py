@@ -0,0 +1,134 @@
+#
+# tracker/modules/retention.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tracker.models import *
+from tracker.modules import accounttracker
+
+# Selects the datapoints of a batch of accounts older than a cutoff which are
+# not the first of their account in a bucket of the retained resolution.
+# Datapoints referenced by a Record or Current entry are always kept, so
+# record links stay valid; every account's latest datapoint is the end of
+# its Current entries.
+THINNED = 'SELECT b.id FROM ( \
+               SELECT d.id, row_number() OVER ( \
+                   PARTITION BY d.rsaccount_id, \
+                   floor(extract(epoch FROM d.time) / %(resolution)s) \
+                   ORDER BY d.time, d.id) AS n \
+               FROM tracker_datapoint d \
+               WHERE d.rsaccount_id = ANY(%(accounts)s) \
+               AND d.time < %(cutoff)s \
+           ) AS b \
+           WHERE b.n > 1 \
+           AND NOT EXISTS (SELECT 1 FROM tracker_record r \
+                           WHERE r.start_id = b.id) \
+           AND NOT EXISTS (SELECT 1 FROM tracker_record r \
+                           WHERE r.end_id = b.id) \
+           AND NOT EXISTS (SELECT 1 FROM tracker_current c \
+                           WHERE c.start_id = b.id) \
+           AND NOT EXISTS (SELECT 1 FROM tracker_current c \
+                           WHERE c.end_id = b.id)'
+
+
+def downsample(**kwargs):
+    """
+    Thin out the history of every account beyond the retention age, keeping
+    only the first datapoint of each account in each period of the retained
+    resolution, along with every datapoint a Record or Current entry starts
+    or ends at.
+
+    Arguments:
+        age (timedelta) - datapoints older than this are thinned (default
+        TRACKER_RETENTION_AGE, or 365 days)
+        resolution (timedelta) - length of the periods in which one datapoint
+        is kept (default TRACKER_RETENTION_RESOLUTION, or 1 day)
+        batch_size (int) - accounts thinned per transaction (default 500)
+        dry_run (bool) - count the datapoints without deleting them (default
+        False)
+
+    Returns the number of datapoints deleted, or which would be deleted.
+    """
+
+    age = kwargs.get('age') or getattr(settings, 'TRACKER_RETENTION_AGE',
+                                       timedelta(days=365))
+    resolution = kwargs.get('resolution') \
+        or getattr(settings, 'TRACKER_RETENTION_RESOLUTION', timedelta(days=1))
+    batch_size = kwargs.get('batch_size', 500)
+    dry_run = kwargs.get('dry_run', False)
+
+    cutoff = timezone.now() - age
+    deleted = 0
+    last_id = 0
+
+    while True:
+        acc_ids = list(RSAccount.objects.filter(id__gt=last_id)
+                                        .order_by('id')
+                                        .values_list('id', flat=True)
+                                        [:batch_size])
+        if not acc_ids:
+            break
+        last_id = acc_ids[-1]
+
+        with transaction.atomic():
+            deleted += downsample_batch(acc_ids, cutoff,
+                                        resolution.total_seconds(), dry_run)
+
+    return deleted
+
+
+def downsample_batch(acc_ids, cutoff, resolution, dry_run):
+    """
+    Thin the datapoints of a batch of accounts older than `cutoff` to one in
+    every `resolution` seconds. Return the number of datapoints deleted.
+    Must be called inside a transaction.
+    """
+
+    params = {
+        'accounts': list(acc_ids),
+        'cutoff': cutoff,
+        'resolution': resolution,
+    }
+
+    with connection.cursor() as cursor:
+        if dry_run:
+            cursor.execute('SELECT count(*) FROM (%s) AS t' % THINNED, params)
+            return cursor.fetchone()[0]
+
+        accounttracker.lock_accounts(acc_ids)
+
+        # Foreign keys are checked at commit, so the datapoints can be
+        # deleted along with the rows referencing them in one statement.
+        cursor.execute('WITH thinned AS (%s), \
+                        levels AS ( \
+                            DELETE FROM tracker_skilllevel \
+                            WHERE datapoint_id IN (SELECT id FROM thinned) \
+                        ), packed AS ( \
+                            DELETE FROM tracker_packedlevels \
+                            WHERE datapoint_id IN (SELECT id FROM thinned) \
+                        ), ranks AS ( \
+                            DELETE FROM tracker_timeplayedrank \
+                            WHERE datapoint_id IN (SELECT id FROM thinned) \
+                        ) \
+                        DELETE FROM tracker_datapoint \
+                        WHERE id IN (SELECT id FROM thinned)' % THINNED,
+                       params)
+        return cursor.rowcount
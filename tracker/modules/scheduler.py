@@ -0,0 +1,148 @@
+#
+# tracker/modules/scheduler.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+from django.db import connection, transaction
+
+from tracker.models import *
+from tracker.modules import accounttracker, osrsapi, updatequeue
+
+
+def seed_schedules():
+    """
+    Schedule automatic updates of every account which does not have a
+    schedule yet. Their first updates are spread over the default interval.
+    Returns the number of accounts scheduled.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_trackschedule (rsaccount_id, \
+                        update_interval, next_update, last_gain) \
+                        SELECT a.id, %s, \
+                        now() + random() * %s * interval \'1 second\', NULL \
+                        FROM tracker_rsaccount a \
+                        ON CONFLICT (rsaccount_id) DO NOTHING',
+                       [TrackSchedule.DEFAULT_INTERVAL,
+                        TrackSchedule.DEFAULT_INTERVAL])
+        return cursor.rowcount
+
+
+def schedule(limit, **kwargs):
+    """
+    Queue updates of the accounts whose automatic updates are due, most
+    overdue first, and move their next updates one interval ahead. Their
+    intervals are adjusted once the updates are made.
+
+    Arguments:
+        limit (int) - maximum number of updates to queue
+        max_pending (int) - queue no more updates than would bring the
+        number of queued jobs above this (default `limit`)
+
+    Returns the number of updates queued.
+    """
+
+    max_pending = kwargs.get('max_pending', limit)
+    limit = min(limit, max_pending - updatequeue.pending())
+    if limit <= 0:
+        return 0
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('UPDATE tracker_trackschedule s \
+                        SET next_update = now() \
+                        + s.update_interval * interval \'1 second\' \
+                        FROM (SELECT rsaccount_id FROM tracker_trackschedule \
+                              WHERE next_update <= now() \
+                              ORDER BY next_update LIMIT %s \
+                              FOR UPDATE SKIP LOCKED) AS d \
+                        WHERE s.rsaccount_id = d.rsaccount_id \
+                        RETURNING s.rsaccount_id', [limit])
+        acc_ids = [r[0] for r in cursor.fetchall()]
+
+        return updatequeue.submit_many(acc_ids)
+
+
+def simulate(profiles, **kwargs):
+    """
+    Simulate automatic updates of a set of accounts against stubbed hiscores,
+    one hour at a time, to compare the requests made with the freshness of
+    the data.
+
+    Arguments:
+        profiles (list of float) - probability of each account gaining
+        experience in any hour
+        hours (int) - length of the simulation (default 28 days)
+        interval (int) - if given, every account is updated at this fixed
+        interval, in seconds, instead of an adaptive one
+        seed (int) - seed of the simulated activity (default 0)
+
+    Returns a dictionary holding the number of hiscores `requests` made, the
+    number of those which found no gain (`unchanged`) and the mean hours
+    between an account starting to gain experience and an update recording
+    it (`staleness`).
+    """
+
+    hours = kwargs.get('hours', 24 * 28)
+    fixed = kwargs.get('interval')
+    rng = random.Random(kwargs.get('seed', 0))
+
+    exp = [0] * len(profiles)
+    seen = [0] * len(profiles)
+    # Hour at which each account started gaining unrecorded experience.
+    unseen = [None] * len(profiles)
+    intervals = [fixed or TrackSchedule.DEFAULT_INTERVAL] * len(profiles)
+    due = [rng.uniform(0, i / 3600) for i in intervals]
+
+    def hiscore_lookup(i):
+        return osrsapi.parse_hiscores('1,1,%d\n' % exp[i] + '1,1,0\n' * 23)
+
+    requests = unchanged = 0
+    stale_hours = []
+
+    for hour in range(hours):
+        for i, p in enumerate(profiles):
+            if rng.random() < p:
+                exp[i] += rng.randint(1000, 100000)
+                if unseen[i] is None:
+                    unseen[i] = hour
+
+            if due[i] > hour:
+                continue
+
+            requests += 1
+            total = accounttracker.parse_skills(hiscore_lookup(i))[0][1]
+            gained = total != seen[i]
+            if gained:
+                stale_hours.append(hour - unseen[i])
+                unseen[i] = None
+                seen[i] = total
+            else:
+                unchanged += 1
+
+            if not fixed:
+                intervals[i] = TrackSchedule.next_interval(intervals[i],
+                                                           gained)
+            due[i] = hour + intervals[i] / 3600
+
+    # Gains still unrecorded at the end are stale until then.
+    stale_hours.extend(hours - u for u in unseen if u is not None)
+
+    return {
+        'requests': requests,
+        'unchanged': unchanged,
+        'staleness': sum(stale_hours) / max(len(stale_hours), 1),
+    }
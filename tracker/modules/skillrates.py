@@ -0,0 +1,188 @@
+#
+# tracker/modules/skillrates.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import threading
+import time
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from tracker.models import SkillRate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RateTable(object):
+    """
+    Experience rates for a single skill, stored as parallel arrays sorted by
+    starting experience along with the total hours required to reach each
+    starting experience.
+    """
+
+    __slots__ = ('start_exp', 'rate', 'cum_hours', '_arrays')
+
+    def __init__(self, rates):
+        """
+        Arguments:
+            rates (list of tuples) - (start_exp, rate) for each rate of the
+            skill, in any order
+        """
+
+        rates = sorted(rates)
+        self.start_exp = [r[0] for r in rates]
+        self.rate = [r[1] for r in rates]
+        self.cum_hours = []
+        self._arrays = None
+
+        hours = 0
+        for i, (start, rate) in enumerate(rates):
+            self.cum_hours.append(hours)
+            if i + 1 < len(rates) and rate != 0:
+                hours += (rates[i + 1][0] - start) / rate
+
+    def hours(self, experience):
+        """
+        Return the number of hours required to reach `experience`.
+        """
+
+        # Index of the highest rate starting strictly below `experience`.
+        i = bisect.bisect_left(self.start_exp, experience) - 1
+        if i < 0:
+            return 0
+
+        hours = self.cum_hours[i]
+        if self.rate[i] != 0:
+            hours += (experience - self.start_exp[i]) / self.rate[i]
+        return hours
+
+    def hours_many(self, experiences):
+        """
+        Return the number of hours required to reach each value in the
+        sequence `experiences`, as a NumPy array if NumPy is available and
+        a list otherwise.
+        """
+
+        if numpy is None or not self.start_exp:
+            return [self.hours(e) for e in experiences]
+
+        start, rate, cum, inv = self.__arrays()
+        exp = numpy.asarray(experiences, dtype=numpy.float64)
+        i = numpy.searchsorted(start, exp, side='left') - 1
+        valid = i >= 0
+        i = numpy.maximum(i, 0)
+
+        return numpy.where(valid, cum[i] + (exp - start[i]) * inv[i], 0.0)
+
+    def breakpoints(self):
+        """
+        Return a list of (start_exp, end_exp, cum_hours, rate) tuples
+        describing each rate segment. `end_exp` is None for the last segment.
+        """
+
+        ends = self.start_exp[1:] + [None]
+        return list(zip(self.start_exp, ends, self.cum_hours, self.rate))
+
+    def __arrays(self):
+        if self._arrays is None:
+            rate = numpy.array(self.rate, dtype=numpy.float64)
+            inv = numpy.zeros_like(rate)
+            nonzero = rate != 0
+            inv[nonzero] = 1 / rate[nonzero]
+            self._arrays = (numpy.array(self.start_exp, dtype=numpy.float64),
+                            rate,
+                            numpy.array(self.cum_hours, dtype=numpy.float64),
+                            inv)
+        return self._arrays
+
+
+EMPTY_TABLE = RateTable([])
+
+__tables = None
+__loaded = 0
+__lock = threading.Lock()
+
+
+def rate_tables():
+    """
+    Return the cached dictionary mapping skill IDs to their RateTables,
+    loading it from the database if it has been invalidated or is older
+    than TRACKER_RATES_TTL seconds.
+    """
+
+    global __tables, __loaded
+
+    ttl = getattr(settings, 'TRACKER_RATES_TTL', 300)
+
+    with __lock:
+        if __tables is None or time.time() - __loaded > ttl:
+            rates = {}
+            for skill_id, start, rate in SkillRate.objects.values_list(
+                    'skill_id', 'start_exp', 'rate'):
+                rates.setdefault(skill_id, []).append((start, rate))
+
+            __tables = dict((s, RateTable(r)) for s, r in rates.items())
+            __loaded = time.time()
+
+        return __tables
+
+
+def rate_table(skill_id):
+    """
+    Return the RateTable for a single skill.
+    """
+
+    return rate_tables().get(skill_id, EMPTY_TABLE)
+
+
+def hours(skill_id, experience):
+    """
+    Calculate the number of hours played in a skill given an amount of
+    experience.
+    """
+
+    return rate_table(skill_id).hours(experience)
+
+
+def hours_many(skill_id, experiences):
+    """
+    Calculate the number of hours played in a skill for each amount of
+    experience in `experiences`.
+    """
+
+    return rate_table(skill_id).hours_many(experiences)
+
+
+def invalidate():
+    """
+    Discard the cached rate tables. They are reloaded on next use.
+    """
+
+    global __tables
+
+    with __lock:
+        __tables = None
+
+
+@receiver(post_save, sender=SkillRate)
+@receiver(post_delete, sender=SkillRate)
+def skillrate_changed(sender, **kwargs):
+    invalidate()
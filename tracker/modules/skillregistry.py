@@ -0,0 +1,119 @@
+#
+# tracker/modules/skillregistry.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from tracker.models import Skill
+
+# Immutable copy of a Skill row. Has the same attributes as Skill, so it can
+# be used in its place in templates.
+SkillInfo = namedtuple('SkillInfo', ['skill_id', 'skillname'])
+
+
+class SkillRegistry(object):
+    """
+    Snapshot of the Skill table: every skill and the in-game skills as
+    tuples of SkillInfo ordered by ID, and a read-only mapping of skill IDs
+    to names.
+    """
+
+    __slots__ = ('all', 'in_game', 'names')
+
+    def __init__(self, skills):
+        """
+        Arguments:
+            skills (list of tuples) - (skill ID, name) of each skill, in any
+            order
+        """
+
+        self.all = tuple(SkillInfo(*s) for s in sorted(skills))
+        self.in_game = tuple(s for s in self.all if s.skill_id < Skill.QHA_ID)
+        self.names = MappingProxyType(dict(self.all))
+
+
+__registry = None
+__loaded = 0
+__lock = threading.Lock()
+
+
+def registry():
+    """
+    Return the cached SkillRegistry, loading it from the database if it has
+    been invalidated or is older than TRACKER_SKILLS_TTL seconds.
+    """
+
+    global __registry, __loaded
+
+    ttl = getattr(settings, 'TRACKER_SKILLS_TTL', 3600)
+
+    with __lock:
+        if __registry is None or time.time() - __loaded > ttl:
+            __registry = SkillRegistry(
+                Skill.objects.values_list('skill_id', 'skillname'))
+            __loaded = time.time()
+
+        return __registry
+
+
+def skills(include_qha=False):
+    """
+    Return a tuple of the in-game skills, or of every skill including QHA
+    and Original QHA, ordered by ID.
+    """
+
+    r = registry()
+    return r.all if include_qha else r.in_game
+
+
+def skill_ids():
+    """
+    Return a tuple of the IDs of every skill.
+    """
+
+    return tuple(s.skill_id for s in registry().all)
+
+
+def skill_name(skill_id):
+    """
+    Return the name of a skill, or an empty string if it does not exist.
+    """
+
+    return registry().names.get(skill_id, '')
+
+
+def invalidate():
+    """
+    Discard the cached registry. It is reloaded on next use.
+    """
+
+    global __registry
+
+    with __lock:
+        __registry = None
+
+
+@receiver(post_save, sender=Skill)
+@receiver(post_delete, sender=Skill)
+def skill_changed(sender, **kwargs):
+    invalidate()
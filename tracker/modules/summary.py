@@ -0,0 +1,111 @@
+#
+# tracker/modules/summary.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import connection
+
+from tracker.models import *
+from tracker.modules import levelstorage
+
+# Overall records of an account packed in the order of
+# `AccountSummary.RECORD_PERIODS`.
+PACKED_RECORDS = 'ARRAY(SELECT u.x FROM tracker_record r \
+                  CROSS JOIN LATERAL unnest(ARRAY[r.experience, \
+                  r.start_id, r.end_id]) WITH ORDINALITY AS u (x, i) \
+                  WHERE r.rsaccount_id = %%s AND r.skill_id = 0 \
+                  AND position(r.period IN \'%s\') > 0 \
+                  ORDER BY position(r.period IN \'%s\'), u.i)' \
+                 % ((AccountSummary.RECORD_PERIODS,) * 2)
+
+
+def update_summaries(points, levels):
+    """
+    Rewrite the summaries of a set of accounts from their newest datapoints
+    with a single statement. The accounts' Record entries must already be
+    up to date.
+
+    Arguments:
+        points (list of DataPoint) - newest datapoint of each account
+        levels (list of SkillLevel) - skill levels of the datapoints, in
+        order of datapoint and skill ID
+    """
+
+    if not points:
+        return
+
+    params = []
+    for i, dp in enumerate(points):
+        lvls = levels[i * 24:(i + 1) * 24]
+        params.extend([dp.rsaccount_id, dp.time, dp.id,
+                       [l.experience for l in lvls], [l.rank for l in lvls],
+                       [l.current_hours for l in lvls]])
+    values = ', '.join(['(%s, %s::timestamptz, %s::bigint, %s::bigint[], '
+                        '%s::integer[], %s::double precision[])']
+                       * len(points))
+
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_accountsummary (rsaccount_id, \
+                        first_update, last_update, last_id, experience, rank, \
+                        hours, records) \
+                        SELECT v.rsaccount_id, v.time, v.time, v.dp_id, \
+                        v.experience, v.rank, v.hours, %s \
+                        FROM (VALUES %s) AS v (rsaccount_id, time, dp_id, \
+                                               experience, rank, hours) \
+                        ON CONFLICT (rsaccount_id) DO UPDATE \
+                        SET last_update = EXCLUDED.last_update, \
+                        last_id = EXCLUDED.last_id, \
+                        experience = EXCLUDED.experience, \
+                        rank = EXCLUDED.rank, hours = EXCLUDED.hours, \
+                        records = EXCLUDED.records'
+                       % (PACKED_RECORDS % 'v.rsaccount_id', values), params)
+
+
+def rebuild_summaries():
+    """
+    Rebuild the summary of every account from its first and latest
+    datapoints and its records. Returns the number of accounts updated.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_accountsummary (rsaccount_id, \
+                        first_update, last_update, last_id, experience, rank, \
+                        hours, records) \
+                        SELECT a.id, f.time, l.time, l.id, \
+                        array_agg(s.experience ORDER BY s.skill_id), \
+                        array_agg(s.rank ORDER BY s.skill_id), \
+                        array_agg(s.current_hours ORDER BY s.skill_id), %s \
+                        FROM tracker_rsaccount a \
+                        JOIN LATERAL ( \
+                            SELECT time FROM tracker_datapoint \
+                            WHERE rsaccount_id = a.id ORDER BY time LIMIT 1 \
+                        ) AS f ON true \
+                        JOIN LATERAL ( \
+                            SELECT id, time FROM tracker_datapoint \
+                            WHERE rsaccount_id = a.id \
+                            ORDER BY time DESC LIMIT 1 \
+                        ) AS l ON true \
+                        JOIN %s s ON s.datapoint_id = l.id \
+                        GROUP BY a.id, f.time, l.time, l.id \
+                        ON CONFLICT (rsaccount_id) DO UPDATE \
+                        SET first_update = EXCLUDED.first_update, \
+                        last_update = EXCLUDED.last_update, \
+                        last_id = EXCLUDED.last_id, \
+                        experience = EXCLUDED.experience, \
+                        rank = EXCLUDED.rank, hours = EXCLUDED.hours, \
+                        records = EXCLUDED.records'
+                       % (PACKED_RECORDS % 'a.id', levelstorage.table()))
+        return cursor.rowcount
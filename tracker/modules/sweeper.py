@@ -0,0 +1,152 @@
+#
+# tracker/modules/sweeper.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tracker.models import *
+from tracker.modules import accounttracker, leaderboard, levelstorage
+
+# Lengths of the Current periods.
+CURRENT_LENGTHS = dict(zip(accounttracker.CURRENT_PERIODS,
+                           accounttracker.PERIOD_LENGTHS[1:]))
+
+# Time until which the levels of start datapoint `st` were current.
+CHECKED = 'COALESCE(st.last_checked, st.time)'
+
+# Condition selecting the Current entries in a period whose start datapoint
+# has left the period: it was last checked before the period started.
+# Entries starting and ending at the same datapoint have no gain to expire.
+EXPIRED = 'FROM tracker_current c \
+           JOIN tracker_datapoint st ON st.id = c.start_id \
+           WHERE c.period = %%s AND %s < %%s AND c.start_id != c.end_id' \
+          % CHECKED
+
+
+def sweep_current(**kwargs):
+    """
+    Advance the start of every expired Current entry to the datapoint of its
+    account which opens the entry's period (see
+    `accounttracker.PERIOD_START`), recalculating its gain.
+    Entries of accounts without datapoints in the period are reset to a gain
+    of 0 at their latest datapoint.
+
+    Arguments:
+        batch_size (int) - accounts updated per transaction (default 500)
+
+    Returns the number of entries updated.
+    """
+
+    batch_size = kwargs.get('batch_size', 500)
+    updated = 0
+
+    for period, length in CURRENT_LENGTHS.items():
+        while True:
+            since = timezone.now() - length
+            with transaction.atomic():
+                n = sweep_batch(period, since, batch_size)
+            if n is None:
+                break
+            updated += n
+
+    return updated
+
+
+def sweep_batch(period, since, batch_size):
+    """
+    Sweep the expired Current entries in `period` of up to `batch_size`
+    accounts. Return the number of entries updated, or None if there were no
+    expired entries. Must be called inside a transaction.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT DISTINCT c.rsaccount_id %s \
+                        ORDER BY c.rsaccount_id LIMIT %%s' % EXPIRED,
+                       [period, since, batch_size])
+        acc_ids = [r[0] for r in cursor.fetchall()]
+
+        if not acc_ids:
+            return None
+
+        accounttracker.lock_accounts(acc_ids)
+
+        # Overall hours stored in Overall skill.
+        level = 'CASE WHEN x.skill_id = %d THEN 0 ELSE x.skill_id END' \
+                % Skill.QHA_ID
+        cursor.execute('WITH expired AS ( \
+                            SELECT c.id, c.rsaccount_id, c.skill_id, \
+                            c.end_id %s AND c.rsaccount_id = ANY(%%s) \
+                        ), firsts AS ( \
+                            SELECT a.rsaccount_id, f.id \
+                            FROM (SELECT DISTINCT rsaccount_id \
+                                  FROM expired) AS a \
+                            CROSS JOIN (VALUES (%%s::timestamptz)) \
+                            AS p (since) \
+                            LEFT JOIN LATERAL %s AS f ON true \
+                        ) \
+                        UPDATE tracker_current c \
+                        SET start_id = COALESCE(f.id, x.end_id), \
+                        experience = CASE WHEN c.skill_id = %%s \
+                            THEN c.experience \
+                            ELSE COALESCE(e.experience - s.experience, 0) \
+                            END, \
+                        hours = CASE WHEN c.skill_id = %%s \
+                            THEN COALESCE(e.current_hours \
+                                          - s.current_hours, 0) \
+                            ELSE c.hours END \
+                        FROM expired x \
+                        JOIN firsts f ON f.rsaccount_id = x.rsaccount_id \
+                        LEFT JOIN %s s \
+                        ON s.datapoint_id = f.id AND s.skill_id = %s \
+                        LEFT JOIN %s e \
+                        ON e.datapoint_id = x.end_id AND e.skill_id = %s \
+                        WHERE c.id = x.id'
+                       % (EXPIRED,
+                          accounttracker.PERIOD_START
+                          % {'acc': 'a.rsaccount_id', 'since': 'p.since'},
+                          levelstorage.table(), level,
+                          levelstorage.table(), level),
+                       [period, since, acc_ids, since, Skill.QHA_ID,
+                        Skill.QHA_ID])
+        updated = cursor.rowcount
+
+    leaderboard.update_accounts(acc_ids, [])
+    return updated
+
+
+def sweep_status():
+    """
+    Report how far behind the sweeper is. Returns a dictionary mapping each
+    Current period to a tuple of (number of expired entries, seconds since
+    the oldest expired entry should have been swept).
+    """
+
+    status = {}
+    now = timezone.now()
+
+    with connection.cursor() as cursor:
+        for period, length in CURRENT_LENGTHS.items():
+            since = now - length
+            cursor.execute('SELECT count(*), min(%s) %s'
+                           % (CHECKED, EXPIRED),
+                           [period, since])
+            count, oldest = cursor.fetchone()
+            lag = (now - (oldest + length)).total_seconds() if oldest else 0
+            status[period] = (count, lag)
+
+    return status
@@ -19,14 +19,14 @@
 from django.template import loader
 
 from tracker.models import *
-from tracker.modules import accounttracker
+from tracker.modules import accounttracker, leaderboard, pagination, ranks
 
-def player_skill_table(acc, datapoints):
+def player_skill_table(acc, delta):
     """
-    Set up an array of tuples to populate the rows in a player's skill table.
-    The first entry in each tuple is the difference in experience, the second
-    is difference in rank, third and fourth are total experience and rank,
-    respectively and the fifth is the name of the skill.
+    Set up an array of tuples to populate the rows in a player's skill table
+    from a Delta. Each row holds the differences in experience, rank and
+    hours between the first and last datapoints of the range, the levels at
+    the last datapoint and the name of the skill.
     """
 
     skills = accounttracker.skills()
@@ -34,19 +34,13 @@ def player_skill_table(acc, datapoints):
         'skill_list': [],
     }
 
-    if len(datapoints) == 0:
+    if not delta:
         table_data['total_hours'] = '0.00'
         return table_data
 
-    for i in range(len(skills)):
-        exp = datapoints[0][1][i].experience
-        rank = datapoints[0][1][i].rank
-        hours =  datapoints[0][1][i].current_hours
-
-        de = exp - datapoints[-1][1][i].experience
-        # Reversed as higher ranks are better.
-        dr = datapoints[-1][1][i].rank - rank
-        dh = hours - datapoints[-1][1][i].current_hours
+    for skill in skills:
+        exp, rank, hours = delta.levels(skill.skill_id)
+        de, dr, dh = delta.change(skill.skill_id)
         if dh < 0.01:
             dh = 0
 
@@ -70,16 +64,12 @@ def player_skill_table(acc, datapoints):
         skilldata['exp'] = '{:,}'.format(exp)
         skilldata['rank'] = '{:,}'.format(rank)
         skilldata['hours'] = '{:,.2f}'.format(hours)
-        skilldata['skillname'] = skills[i].skillname
+        skilldata['skillname'] = skill.skillname
 
         table_data['skill_list'].append(skilldata)
 
-    # HACK: subtracting 0.01 and using strictly greater than as the filter
-    # seems to make the rank accurate whereas the standard greater than or
-    # equal to filter occasionally reports duplicate ranks.
-    total_hours = datapoints[0][1][0].current_hours - 0.01
-    rank = TimePlayed.objects.filter(hours__gt=total_hours).count()
-    orig_rank = TimePlayedRank.objects.get(datapoint=datapoints[-1][0]).rank
+    rank = ranks.rank(delta.levels(0)[2])
+    orig_rank = TimePlayedRank.objects.get(datapoint_id=delta.start_id).rank
     delta_rank = orig_rank - rank
 
     table_data['delta_hours'] = table_data['skill_list'][0]['dh']
@@ -99,7 +89,7 @@ def player_records(acc, skill_id):
     page for a specific skill.
     """
 
-    rec = []
+    records = []
 
     for p in 'DWMY':
         try:
@@ -107,25 +97,35 @@ def player_records(acc, skill_id):
         except Record.DoesNotExist:
             return []
 
+        value = r.experience if skill_id < Skill.QHA_ID else r.hours
+        records.append((value, r.start_id, r.end_id))
+
+    return format_records(acc, skill_id, records)
+
+
+def format_records(acc, skill_id, records):
+    """
+    Format a player's (value, start ID, end ID) records in each period for the
+    small records table.
+    """
+
+    rec = []
+
+    for value, start_id, end_id in records:
+        if value == 0:
+            url = "#"
+        else:
+            url = "/player/%s/period/%d-%d" % (acc.username, start_id, end_id)
+
         if skill_id < Skill.QHA_ID:
-            if r.experience == 0:
-                url = "#"
-            else:
-                url = "/player/%s/period/%d-%d" % (acc.username, r.start_id,
-                                                   r.end_id)
-            rec.append(('{:,}'.format(r.experience), url))
+            rec.append(('{:,}'.format(value), url))
         else:
-            if r.hours == 0:
-                url = "#"
-            else:
-                url = "/player/%s/period/%d-%d" % (acc.username, r.start_id,
-                                                   r.end_id)
-            rec.append(('{:,.2f}'.format(r.hours), url))
+            rec.append(('{:,.2f}'.format(value), url))
 
     return rec
 
 
-def record_table(skill_id, period, start=0, limit=10):
+def record_table(skill_id, period, start=0, limit=10, after=None):
     """
     Set up an array of tuples to populate a single table on a records page.
 
@@ -134,37 +134,14 @@ def record_table(skill_id, period, start=0, limit=10):
     period (str): period for which to look up records.
     start (int): the index at which to begin.
     limit (int): number of players to return.
+    after (tuple): cursor of the entry preceding the table; overrides start.
     """
 
-    rec = []
-    end = start + limit
-
-    if skill_id < Skill.QHA_ID:
-        top = Record.objects.filter(skill_id=skill_id, period=period) \
-                            .order_by('-experience')[start:end]
-    else:
-        top = Record.objects.filter(skill_id=skill_id, period=period) \
-                            .order_by('-hours')[start:end]
+    return leaderboard_rows(Leaderboard.RECORDS, skill_id, period, start,
+                            limit, after)
 
-    for r in top:
-        if skill_id < Skill.QHA_ID:
-            if r.experience == 0:
-                break
-            recval = '{:,}'.format(r.experience)
 
-        else:
-            if r.hours == 0:
-                break
-            recval = '{:,.2f}'.format(r.hours)
-
-        name = r.rsaccount.username
-        rec.append((name, name.replace('_', ' '), recval,
-                    str(r.start_id), str(r.end_id)))
-
-    return rec
-
-
-def current_table(skill_id, period, start=0, limit=10):
+def current_table(skill_id, period, start=0, limit=10, after=None):
     """
     Set up an array of tuples to populate a single table on a current top page.
 
@@ -173,49 +150,67 @@ def current_table(skill_id, period, start=0, limit=10):
     period (str): period for which to look up records.
     start (int): the index at which to begin.
     limit (int): number of players to return.
+    after (tuple): cursor of the entry preceding the table; overrides start.
     """
 
-    curr = []
-    top = accounttracker.get_updated_current_top(skill_id, period, start, limit)
+    # Expired entries are advanced by the Current sweeper (see `sweeper`).
+    return leaderboard_rows(Leaderboard.CURRENT, skill_id, period, start,
+                            limit, after)
 
-    for c in top:
-        if skill_id < Skill.QHA_ID:
-            if c.experience == 0:
-                break
-            curval = '{:,}'.format(c.experience)
 
+def leaderboard_rows(board, skill_id, period, start, limit, after):
+    """
+    Format the entries of a leaderboard as (username, display name, value,
+    start ID, end ID, cursor) tuples, where cursor is the `after` parameter
+    of the page following the entry.
+    """
+
+    rows = []
+
+    for entry in leaderboard.top(board, skill_id, period, start, limit,
+                                 after):
+        name, exp, hours, start_id, end_id, _ = entry
+        if skill_id < Skill.QHA_ID:
+            value = '{:,}'.format(exp)
         else:
-            if c.hours < 0.001:
-                break
-            curval = '{:,.2f}'.format(c.hours)
+            value = '{:,.2f}'.format(hours)
 
-        name = c.rsaccount.username
-        curr.append((name, name.replace('_', ' '), curval,
-                     str(c.start_id), str(c.end_id)))
+        rows.append((name, name.replace('_', ' '), value, str(start_id),
+                     str(end_id), pagination.encode_cursor(
+                         leaderboard.entry_cursor(skill_id, entry))))
 
-    return curr
+    return rows
 
 
-def player_page(acc, datapoints, period, searchperiod):
+def player_page(acc, delta, period, searchperiod, acc_summary=None):
     """
-    Return the HTML of the player page for a specific player and period.
+    Return the HTML of the player page for a specific player and period, given
+    the Delta of the period. The account's AccountSummary, if given, is used
+    instead of looking up its first datapoint and records.
     """
 
-    table_data = player_skill_table(acc, datapoints)
-    firstupdate = accounttracker.first_datapoint(acc).time
+    table_data = player_skill_table(acc, delta)
+
+    if acc_summary is not None:
+        firstupdate = acc_summary.first_update
+        records = format_records(acc, 0, acc_summary.overall_records())
+    else:
+        firstupdate = accounttracker.first_datapoint(acc).time
+        records = player_records(acc, 0)
+
+    # Lookups finding unchanged levels do not add datapoints, so the latest
+    # lookup may be later than the end of the delta.
+    lastupdate = accounttracker.last_checked(acc)
 
-    if len(datapoints) == 0:
-        lastupdate = accounttracker.latest_datapoint(acc).time
+    if not delta:
         skills = accounttracker.skills()
         cs = None
         ce = None
     else:
-        lastupdate = datapoints[0][0].time
         skills = None
-        cs = datapoints[-1][0].time
-        ce = lastupdate
+        cs = delta.start_time
+        ce = delta.end_time
 
-    records = player_records(acc, 0)
     skillname = 'Overall'
 
     t = loader.get_template('tracker/player/player.html')
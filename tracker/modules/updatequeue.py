@@ -0,0 +1,259 @@
+#
+# tracker/modules/updatequeue.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tracker.models import *
+from tracker.modules import accounttracker, osrsapi
+
+# Queue backends: jobs are either run inline by the request which submits
+# them, or queued in the database for the update workers.
+SYNC = 'sync'
+DATABASE = 'database'
+
+# Namespace of the advisory lock taken by workers claiming jobs.
+QUEUE_LOCK = 3
+
+# Response codes of failed updates, checked in order.
+RESULT_CODES = [
+    (accounttracker.RecentUpdateError, '-1'),
+    (osrsapi.PlayerNotFoundError, '-2'),
+    (osrsapi.OsrsRequestError, '-3'),
+    (accounttracker.InvalidUsernameError, '-4'),
+    (accounttracker.TrackError, '-5'),
+]
+
+OK = 'OK'
+
+
+def backend():
+    """
+    Return the queue backend, set by TRACKER_UPDATE_QUEUE.
+    """
+
+    return getattr(settings, 'TRACKER_UPDATE_QUEUE', DATABASE)
+
+
+def submit(username):
+    """
+    Request an update of an account. With the database backend, the request
+    is queued, or joins the account's pending job if it already has one;
+    with the sync backend, the account is updated before returning.
+
+    Raises InvalidUsernameError if the username is not valid.
+    Returns the UpdateJob of the request.
+    """
+
+    if not re.fullmatch(r'^[a-zA-Z0-9_]{1,12}$', username):
+        raise accounttracker.InvalidUsernameError
+
+    if backend() == SYNC:
+        job = UpdateJob(username=username, status=UpdateJob.RUNNING,
+                        started=timezone.now(), attempts=1)
+        try:
+            accounttracker.track(username)
+            finish(job, OK)
+        except tuple(cls for cls, _ in RESULT_CODES) as e:
+            finish(job, result_code(e))
+        job.save()
+        return job
+
+    with connection.cursor() as cursor:
+        cursor.execute('WITH ins AS ( \
+                            INSERT INTO tracker_updatejob (username, status, \
+                            result, created, attempts) \
+                            VALUES (%s, %s, \'\', now(), 0) \
+                            ON CONFLICT ((LOWER(username::text))) \
+                            WHERE status IN (%s, %s) DO NOTHING \
+                            RETURNING id \
+                        ) \
+                        SELECT id FROM ins \
+                        UNION ALL \
+                        SELECT id FROM tracker_updatejob \
+                        WHERE LOWER(username::text) = LOWER(%s) \
+                        AND status IN (%s, %s) \
+                        LIMIT 1',
+                       [username, UpdateJob.QUEUED, UpdateJob.QUEUED,
+                        UpdateJob.RUNNING, username, UpdateJob.QUEUED,
+                        UpdateJob.RUNNING])
+        row = cursor.fetchone()
+
+    if row is None:
+        # The pending job finished between the insert and the lookup.
+        return submit(username)
+
+    return UpdateJob.objects.get(id=row[0])
+
+
+def submit_many(acc_ids):
+    """
+    Queue updates of a set of accounts with a single statement. Accounts
+    which already have a pending job are skipped. Returns the number of jobs
+    queued.
+    """
+
+    if not acc_ids:
+        return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_updatejob (username, status, \
+                        result, created, attempts) \
+                        SELECT a.username, %s, \'\', now(), 0 \
+                        FROM tracker_rsaccount a WHERE a.id = ANY(%s) \
+                        ON CONFLICT ((LOWER(username::text))) \
+                        WHERE status IN (%s, %s) DO NOTHING',
+                       [UpdateJob.QUEUED, list(acc_ids), UpdateJob.QUEUED,
+                        UpdateJob.RUNNING])
+        return cursor.rowcount
+
+
+def pending():
+    """
+    Return the number of queued jobs.
+    """
+
+    return UpdateJob.objects.filter(status=UpdateJob.QUEUED).count()
+
+
+def claim(limit, **kwargs):
+    """
+    Mark up to `limit` queued jobs as running and return them, oldest first.
+    Jobs are claimed by one worker at a time, and no more are claimed than
+    the global budget of hiscores lookups allows.
+
+    Arguments:
+        limit (int) - maximum number of jobs to claim
+        rate (int) - lookups allowed per minute across all workers (default
+        TRACKER_HISCORES_RATE, or 300)
+    """
+
+    rate = kwargs.get('rate') or getattr(settings, 'TRACKER_HISCORES_RATE',
+                                         300)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', [QUEUE_LOCK])
+
+        # Jobs started within the last minute count against the budget.
+        cursor.execute('SELECT count(*) FROM tracker_updatejob \
+                        WHERE started > now() - interval \'1 minute\'')
+        limit = min(limit, rate - cursor.fetchone()[0])
+        if limit <= 0:
+            return []
+
+        cursor.execute('UPDATE tracker_updatejob j \
+                        SET status = %s, started = now(), \
+                        attempts = j.attempts + 1 \
+                        FROM (SELECT id FROM tracker_updatejob \
+                              WHERE status = %s ORDER BY id LIMIT %s \
+                              FOR UPDATE SKIP LOCKED) AS q \
+                        WHERE j.id = q.id \
+                        RETURNING j.id',
+                       [UpdateJob.RUNNING, UpdateJob.QUEUED, limit])
+        ids = [r[0] for r in cursor.fetchall()]
+
+    return list(UpdateJob.objects.filter(id__in=ids).order_by('id'))
+
+
+def run(jobs, **kwargs):
+    """
+    Update the accounts of a list of claimed jobs through the bulk tracking
+    path and record the outcome of each job.
+
+    Arguments:
+        jobs (list of UpdateJob) - running jobs to process
+        workers (int) - number of concurrent hiscores requests (default 8)
+    """
+
+    if not jobs:
+        return
+
+    results = accounttracker.track_many([j.username for j in jobs],
+                                        workers=kwargs.get('workers', 8))
+
+    for job in jobs:
+        result = results.get(job.username, accounttracker.TrackError())
+        if isinstance(result, Exception):
+            finish(job, result_code(result))
+        else:
+            finish(job, OK)
+
+    values = ', '.join(['(%s, %s, %s, %s)'] * len(jobs))
+    params = []
+    for job in jobs:
+        params.extend([job.id, job.status, job.result, job.finished])
+
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE tracker_updatejob j SET status = v.status, \
+                        result = v.result, finished = v.finished \
+                        FROM (VALUES %s) AS v (id, status, result, finished) \
+                        WHERE j.id = v.id' % values, params)
+
+
+def finish(job, result):
+    """
+    Mark a job as done or failed with a response code.
+    """
+
+    job.status = UpdateJob.DONE if result == OK else UpdateJob.FAILED
+    job.result = result
+    job.finished = timezone.now()
+
+
+def result_code(error):
+    """
+    Return the response code of an exception raised while updating an
+    account.
+    """
+
+    for cls, code in RESULT_CODES:
+        if isinstance(error, cls):
+            return code
+
+    return '-5'
+
+
+def requeue_stale(timeout, **kwargs):
+    """
+    Return running jobs which were started more than `timeout` ago, and whose
+    worker has presumably died, to the queue. Jobs which have already been
+    attempted `max_attempts` times (default 3) fail instead. Returns the
+    number of jobs requeued.
+    """
+
+    max_attempts = kwargs.get('max_attempts', 3)
+    stale = UpdateJob.objects.filter(status=UpdateJob.RUNNING,
+                                     started__lt=timezone.now() - timeout)
+
+    stale.filter(attempts__gte=max_attempts) \
+         .update(status=UpdateJob.FAILED, result='-5',
+                 finished=timezone.now())
+    return stale.update(status=UpdateJob.QUEUED)
+
+
+def purge(age):
+    """
+    Delete finished jobs older than `age`. Returns the number deleted.
+    """
+
+    jobs = UpdateJob.objects.filter(status__in=[UpdateJob.DONE,
+                                                UpdateJob.FAILED],
+                                    finished__lt=timezone.now() - age)
+    return jobs.delete()[0]
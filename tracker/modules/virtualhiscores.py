@@ -16,7 +16,10 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from tracker.models import RSAccount
+from django.db import connection, transaction
+
+from tracker.models import *
+from tracker.modules import levelstorage, pagecache, pagination
 
 vs_type_names = {
     'exp': 'Total Experience',
@@ -25,6 +28,20 @@ vs_type_names = {
     'low': 'Lowest Skill',
 }
 
+# VirtualStats column ranked by each virtual hiscores type.
+vs_type_columns = {
+    'exp': 'total_exp',
+    '99s': 'num_99s',
+    '200': 'num_200m',
+    'low': 'lowest_exp',
+}
+
+# Experience required for level 99, and the maximum experience in a skill.
+EXP_99 = 13034431
+EXP_MAX = 200000000
+
+VS_PAGE_SIZE = 25
+
 
 def type_name(vs_type):
     """
@@ -41,43 +58,168 @@ def vs_types():
     return vs_type_names.items()
 
 
-def vs_top_exp(start, limit):
+def stats(skills):
     """
+    Compute the virtual hiscores statistics of an account from its parsed
+    hiscores data (see `accounttracker.parse_skills`). Returns a tuple of
+    (total experience, number of 99s, number of 200m skills, lowest skill
+    experience).
     """
 
-    top = RSAccount.objects.order_by('-total_exp')
-    if len(top) < start:
-        return None
+    exps = [exp for _, exp in skills[1:]]
+    return (skills[0][1], sum(1 for e in exps if e >= EXP_99),
+            sum(1 for e in exps if e >= EXP_MAX), min(exps))
 
-    result = {
-        'vs_table': [],
-        'vs_table_rows': 2,
-    }
 
-    for t in top[start:start + limit]:
-        result['vs_table'].append({
-            'username': t.username,
-            'data': '{:,}'.format(t.total_exp)
-        })
+def update_stats(accounts, skills):
+    """
+    Store the virtual hiscores statistics of a list of accounts with a single
+    statement.
 
-    return result
+    Arguments:
+        accounts (list of RSAccount) - accounts to update
+        skills (list) - parsed hiscores data of each account
+    """
 
+    if not accounts:
+        return
 
-vs_type_fn = {
-    'exp': vs_top_exp,
-}
+    params = []
+    for acc, s in zip(accounts, skills):
+        params.extend((acc.id, acc.username) + stats(s))
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(accounts))
 
-VS_PAGE_SIZE = 25
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_virtualstats (rsaccount_id, \
+                        username, total_exp, num_99s, num_200m, lowest_exp) \
+                        VALUES %s \
+                        ON CONFLICT (rsaccount_id) DO UPDATE \
+                        SET username = EXCLUDED.username, \
+                        total_exp = EXCLUDED.total_exp, \
+                        num_99s = EXCLUDED.num_99s, \
+                        num_200m = EXCLUDED.num_200m, \
+                        lowest_exp = EXCLUDED.lowest_exp' % values, params)
+
+
+def rebuild_stats():
+    """
+    Recompute the virtual hiscores statistics of every account from its
+    latest datapoint and store the page anchors of each type. Returns the
+    number of accounts updated.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO tracker_virtualstats (rsaccount_id, \
+                        username, total_exp, num_99s, num_200m, lowest_exp) \
+                        SELECT a.id, a.username, a.total_exp, \
+                        count(*) FILTER (WHERE s.experience >= %%s), \
+                        count(*) FILTER (WHERE s.experience >= %%s), \
+                        min(s.experience) \
+                        FROM tracker_rsaccount a \
+                        JOIN LATERAL ( \
+                            SELECT id FROM tracker_datapoint \
+                            WHERE rsaccount_id = a.id \
+                            ORDER BY time DESC LIMIT 1 \
+                        ) AS d ON true \
+                        JOIN %s s ON s.datapoint_id = d.id \
+                        WHERE s.skill_id > 0 AND s.skill_id < %%s \
+                        GROUP BY a.id \
+                        ON CONFLICT (rsaccount_id) DO UPDATE \
+                        SET username = EXCLUDED.username, \
+                        total_exp = EXCLUDED.total_exp, \
+                        num_99s = EXCLUDED.num_99s, \
+                        num_200m = EXCLUDED.num_200m, \
+                        lowest_exp = EXCLUDED.lowest_exp'
+                       % levelstorage.table(),
+                       [EXP_99, EXP_MAX, Skill.QHA_ID])
+        n = cursor.rowcount
+
+    refresh_anchors()
+    return n
+
+
+def refresh_anchors():
+    """
+    Store the anchors by which numbered pages of each virtual hiscores type
+    are found. Pages past the anchors are not found until they are refreshed.
+    """
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for vs_type, column in vs_type_columns.items():
+            pagination.store_anchors(cursor, 'virtual:%s' % vs_type,
+                                     'SELECT %s AS value, \
+                                      rsaccount_id AS id \
+                                      FROM tracker_virtualstats' % column,
+                                     [])
 
+    pagecache.bump([pagecache.VIRTUAL_KEY])
 
-def vs_data(vs_type, page):
+
+def vs_page(vs_type, limit, after=None):
+    """
+    Return a page of a virtual hiscores table as a list of (username, value,
+    account ID) tuples. Entries are ordered by value and then by account ID,
+    both descending, and are read through the (value, account) index.
+
+    Arguments:
+        vs_type (str) - virtual hiscores type
+        limit (int) - number of entries to return
+        after (tuple) - (value, account ID) of the entry preceding the page,
+        or None for the first page
+    """
+
+    column = vs_type_columns[vs_type]
+    params = []
+    where = ''
+    if after is not None:
+        where = 'WHERE (%s, rsaccount_id) < (%%s, %%s)' % column
+        params.extend(after)
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT username, %s, rsaccount_id \
+                        FROM tracker_virtualstats %s \
+                        ORDER BY %s DESC, rsaccount_id DESC LIMIT %%s'
+                       % (column, where, column), params + [limit])
+        return cursor.fetchall()
+
+
+def vs_data(vs_type, page=1, after=None):
     """
     Return virtual hiscores data for given virtual hiscores type.
 
     Arguments:
         vs_type (str) - virtual hiscores type
-        page - page number (pages consist of 25 entries)
+        page - page number (pages consist of 25 entries), used to number the
+        entries
+        after (tuple) - (value, account ID) of the last entry of the previous
+        page; if not given, the page is found by its number from the page
+        anchors stored by `rebuild_stats`
     """
 
     start = (page - 1) * VS_PAGE_SIZE
-    return vs_type_fn[vs_type](start, VS_PAGE_SIZE)
+
+    skip = 0
+    if after is None:
+        found = pagination.find_page('virtual:%s' % vs_type, start)
+        if found is None:
+            return None
+        after, skip = found
+
+    rows = vs_page(vs_type, skip + VS_PAGE_SIZE, after)[skip:]
+    if not rows and start > 0:
+        return None
+
+    result = {
+        'vs_table': [],
+        'vs_table_rows': 2,
+        'start': start,
+        'next': rows[-1][1:] if len(rows) == VS_PAGE_SIZE else None,
+    }
+
+    for username, value, _ in rows:
+        result['vs_table'].append({
+            'username': username,
+            'data': '{:,}'.format(value),
+        })
+
+    return result
@@ -1,3 +1,1339 @@
-from django.test import TestCase
+#
+# tracker/tests.py
+# Copyright (C) 2016-2017 Alexei Frolov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
 
-# Create your tests here.
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from tracker.models import *
+from tracker.modules import accounttracker, history, leaderboard, \
+    levelstorage, osrsapi, pagecache, pagination, ranks, recalculate, \
+    retention, scheduler, skillrates, skillregistry, summary, sweeper, \
+    template, updatequeue, virtualhiscores
+
+HISCORES_RESPONSE = '\n'.join(['1234,99,13034431'] * 24 + ['-1,-1'] * 3)
+
+
+class StubHiscoresHandler(BaseHTTPRequestHandler):
+    """
+    Serves hiscores responses for the stub server. Player `missing` does not
+    exist, `broken` always fails, `flaky` fails on its first request and
+    `garbled` gets a malformed response.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        player = parse_qs(urlparse(self.path).query)['player'][0]
+        self.server.requests.append(player)
+
+        if player == 'missing':
+            status = 404
+        elif player == 'broken':
+            status = 500
+        elif player == 'flaky' and self.server.requests.count(player) < 2:
+            status = 503
+        else:
+            status = 200
+
+        if status != 200:
+            body = b''
+        elif player == 'garbled':
+            body = b'<html>Service unavailable</html>'
+        else:
+            body = HISCORES_RESPONSE.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHiscoresServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server imitating the OSRS hiscores API.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHiscoresHandler)
+        self.requests = []
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/m=hiscore_oldschool' % self.server_port
+
+
+class HiscoresClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = StubHiscoresServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = osrsapi.HiscoresClient(base_url=self.server.base_url,
+                                             timeout=5, retries=2, backoff=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_lookup(self):
+        record = self.client.lookup('zezima')
+        self.assertEqual(len(record), 72)
+        self.assertEqual(list(record[:3]), [1234, 99, 13034431])
+
+    def test_lookup_not_found(self):
+        with self.assertRaises(osrsapi.PlayerNotFoundError):
+            self.client.lookup('missing')
+        self.assertEqual(self.server.requests, ['missing'])
+
+    def test_lookup_retries(self):
+        self.assertEqual(len(self.client.lookup('flaky')), 72)
+        self.assertEqual(self.server.requests, ['flaky', 'flaky'])
+
+    def test_lookup_gives_up(self):
+        with self.assertRaises(osrsapi.OsrsRequestError):
+            self.client.lookup('broken')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_lookup_malformed(self):
+        # Malformed responses are not retried.
+        with self.assertRaises(osrsapi.HiscoresFormatError):
+            self.client.lookup('garbled')
+        self.assertEqual(self.server.requests, ['garbled'])
+
+    def test_lookup_many(self):
+        names = ['player%d' % i for i in range(20)] + ['missing', 'broken',
+                                                       'garbled']
+        results = self.client.lookup_many(names, workers=4)
+
+        self.assertEqual(set(results), set(names))
+        self.assertIsInstance(results['missing'], osrsapi.PlayerNotFoundError)
+        self.assertIsInstance(results['broken'], osrsapi.OsrsRequestError)
+        self.assertIsInstance(results['garbled'],
+                              osrsapi.HiscoresFormatError)
+        for i in range(20):
+            self.assertEqual(len(results['player%d' % i]), 72)
+
+
+class HiscoresParserTests(SimpleTestCase):
+
+    def test_fixtures(self):
+        paths = glob.glob(os.path.join(os.path.dirname(__file__), 'testdata',
+                                       'hiscores', '*.txt'))
+        self.assertTrue(paths)
+        for path in paths:
+            with open(path, 'rb') as f:
+                body = f.read()
+            record = osrsapi.parse_hiscores(body)
+            lines = body.decode().split('\n')[:24]
+            self.assertEqual(list(record),
+                             [int(x) for l in lines for x in l.split(',')])
+
+    def test_unranked_skills(self):
+        record = osrsapi.parse_hiscores('5,30,400\n' + '-1,1,-1\n' * 23
+                                        + '-1,-1\n' * 3)
+        skills = accounttracker.parse_skills(record)
+        self.assertEqual(skills, [(5, 400)] + [(-1, 0)] * 23)
+
+    def test_crlf_lines(self):
+        record = osrsapi.parse_hiscores(b'5,30,400\r\n' * 24 + b'-1,-1\r\n')
+        self.assertEqual(list(record), [5, 30, 400] * 24)
+
+    def test_malformed(self):
+        for body in [b'', b'1,2,3\n' * 23, b'1,2\n' * 24, b'1,2,x\n' * 24,
+                     b'1,2,3\n' * 23 + b'1,2,3,4\n',
+                     b'1,2,99999999999999999999\n' * 24]:
+            with self.assertRaises(osrsapi.HiscoresFormatError):
+                osrsapi.parse_hiscores(body)
+
+
+class RateTableTests(SimpleTestCase):
+
+    def setUp(self):
+        self.table = skillrates.RateTable([(1000, 50), (0, 100), (3000, 0),
+                                           (5000, 200)])
+
+    def test_hours(self):
+        self.assertEqual(self.table.hours(0), 0)
+        self.assertAlmostEqual(self.table.hours(500), 5)
+        self.assertAlmostEqual(self.table.hours(1000), 10)
+        self.assertAlmostEqual(self.table.hours(2000), 30)
+        # No hours are gained while the rate is 0.
+        self.assertAlmostEqual(self.table.hours(4000), 50)
+        self.assertAlmostEqual(self.table.hours(7000), 60)
+
+    def test_hours_many(self):
+        exps = [0, 500, 1000, 2000, 4000, 7000]
+        for h, e in zip(self.table.hours_many(exps), exps):
+            self.assertAlmostEqual(h, self.table.hours(e))
+
+    def test_empty(self):
+        self.assertEqual(skillrates.EMPTY_TABLE.hours(1000), 0)
+        self.assertEqual(list(skillrates.EMPTY_TABLE.hours_many([1, 2])),
+                         [0, 0])
+
+
+class WindowGainsTests(SimpleTestCase):
+
+    def test_window_gains(self):
+        t = datetime(2017, 1, 1)
+        times = [t + timedelta(minutes=m) for m in [0, 2, 4, 10, 60, 1470]]
+        values = [0, 100, 150, 160, 500, 900]
+        lengths = [timedelta(minutes=5), timedelta(days=1),
+                   timedelta(days=7)]
+
+        self.assertEqual(history.window_gains(times, values, lengths),
+                         [(150, 0, 2), (500, 0, 4), (900, 0, 5)])
+
+    def test_window_gains_min_gain(self):
+        t = datetime(2017, 1, 1)
+        times = [t, t + timedelta(minutes=1)]
+
+        self.assertEqual(history.window_gains(times, [1.0, 1.005],
+                                              [timedelta(minutes=5)],
+                                              min_gain=0.01),
+                         [(0, None, None)])
+
+
+class RankIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = ranks.RankIndex([5.0, 10.0, 10.0, 1.0, 20.0])
+
+    def test_rank(self):
+        self.assertEqual(self.index.rank(20.0), 1)
+        self.assertEqual(self.index.rank(30.0), 1)
+        # Ties share the best rank, including values which differ by
+        # floating point error.
+        self.assertEqual(self.index.rank(10.0), 2)
+        self.assertEqual(self.index.rank(10.0 + 1e-9), 2)
+        self.assertEqual(self.index.rank(5.0), 4)
+        self.assertEqual(self.index.rank(0.0), 6)
+
+    def test_value_at(self):
+        self.assertEqual(self.index.value_at(1), 20.0)
+        self.assertEqual(self.index.value_at(5), 1.0)
+        with self.assertRaises(IndexError):
+            self.index.value_at(6)
+
+    def test_changes(self):
+        changes = [(5.0, 15.0), (None, 12.0)]
+        self.assertEqual(self.index.ranks_after(changes), [2, 3])
+
+        self.index.apply(changes)
+        self.assertEqual(self.index.values, [1.0, 10.0, 10.0, 12.0, 15.0,
+                                             20.0])
+        self.assertEqual([self.index.rank(v) for _, v in changes], [2, 3])
+
+    def test_stale_changes(self):
+        # Old values changed by another process since the index was loaded
+        # are not in it, and are not counted out of it.
+        changes = [(50.0, 60.0), (40.0, 45.0), (5.0, 4.0)]
+        self.assertEqual(self.index.ranks_after(changes), [1, 2, 6])
+        changes = [(100.0, 30.0), (90.0, 25.0)]
+        self.assertEqual(self.index.ranks_after(changes), [1, 2])
+
+        # An old value matches one tied value in the index only.
+        changes = [(10.0, 0.5), (10.0, 0.5), (10.0, 0.5)]
+        self.assertEqual(self.index.ranks_after(changes), [4, 4, 4])
+
+
+class FragmentCacheTests(SimpleTestCase):
+
+    def test_eviction(self):
+        cache = pagecache.FragmentCache(10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        self.assertEqual(cache.get('a'), b'aaaa')
+
+        # The least recently used page is evicted.
+        cache.put('c', b'cccc')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((len(cache), cache.size), (2, 8))
+
+        cache.put('d', b'd' * 11)
+        self.assertIsNone(cache.get('d'))
+
+
+class PaginationTests(SimpleTestCase):
+
+    def test_cursors(self):
+        for cursor in [(5000, 3), (0.5, 2), (1234.5678, 99)]:
+            param = pagination.encode_cursor(cursor)
+            self.assertEqual(pagination.decode_cursor(param), cursor)
+
+        self.assertEqual(pagination.encode_cursor((5000, 3)), '5000:3')
+        for param in [None, '', 'abc:1', '5:', '5']:
+            self.assertIsNone(pagination.decode_cursor(param))
+
+
+class SchedulerSimulationTests(SimpleTestCase):
+
+    def test_idle_accounts(self):
+        daily = scheduler.simulate([0] * 10, interval=86400)
+        adaptive = scheduler.simulate([0] * 10)
+        self.assertEqual(adaptive['requests'], adaptive['unchanged'])
+        self.assertLess(adaptive['requests'], daily['requests'] / 3)
+
+    def test_active_accounts(self):
+        daily = scheduler.simulate([0.5] * 10, interval=86400)
+        adaptive = scheduler.simulate([0.5] * 10)
+        self.assertLess(adaptive['staleness'], daily['staleness'] / 4)
+
+
+def seq_scans(plan):
+    """
+    Return the names of the tables scanned sequentially by a query plan, as
+    returned by EXPLAIN (FORMAT JSON).
+    """
+
+    tables = []
+    if plan['Node Type'] == 'Seq Scan':
+        tables.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        tables.extend(seq_scans(child))
+
+    return tables
+
+
+def hiscores_record(exp):
+    """
+    Build a parsed hiscores response with `exp` experience in every skill.
+    """
+
+    return osrsapi.parse_hiscores('\n'.join(['1,1,%d' % (exp * 23)]
+                                            + ['1000,50,%d' % exp] * 23))
+
+
+def stub_lookups(lookups):
+    """
+    Patch the hiscores client used for bulk updates to answer lookups from
+    `lookups`, a dictionary mapping usernames to parsed responses or the
+    exceptions raised looking them up.
+    """
+
+    def lookup_many(usernames, **kwargs):
+        return dict((u, lookups[u]) for u in usernames)
+
+    return mock.patch('tracker.modules.accounttracker.hiscores_client',
+                      **{'return_value.lookup_many.side_effect': lookup_many})
+
+
+def fetch_levels(dp_ids):
+    """
+    Load the skill levels of a set of datapoints in the configured storage
+    mode. Returns a dictionary mapping each datapoint ID to a list of its
+    SkillLevel entries, ordered by skill ID.
+    """
+
+    result = dict((dp_id, []) for dp_id in dp_ids)
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT s.datapoint_id, s.skill_id, s.experience, \
+                        s.rank, s.current_hours, s.original_hours \
+                        FROM %s s WHERE s.datapoint_id = ANY(%%s) \
+                        ORDER BY s.datapoint_id, s.skill_id'
+                       % levelstorage.table(), [list(result)])
+        for dp_id, skill_id, exp, rank, ch, oh in cursor.fetchall():
+            result[dp_id].append(SkillLevel(skill_id=skill_id,
+                                            datapoint_id=dp_id,
+                                            experience=exp, rank=rank,
+                                            current_hours=ch,
+                                            original_hours=oh))
+
+    return result
+
+
+def create_skills():
+    """
+    Create every skill, with a rate of 10000 experience per hour in skill 1.
+    """
+
+    Skill.objects.create(skill_id=0, skillname='Overall')
+    for i in range(1, 24):
+        Skill.objects.create(skill_id=i, skillname='Skill %d' % i)
+    Skill.objects.create(skill_id=Skill.QHA_ID, skillname='QHA')
+    Skill.objects.create(skill_id=Skill.ORIG_QHA_ID,
+                         skillname='Original QHA')
+    SkillRate.objects.create(skill_id=1, start_exp=0, rate=10000)
+
+
+def clear_caches():
+    """
+    Discard the process-wide caches, which may hold another test's data.
+    """
+
+    skillrates.invalidate()
+    skillregistry.invalidate()
+    ranks.invalidate()
+    pagecache.version_cache().clear()
+    pagecache.fragments().clear()
+
+
+class TrackTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_skills()
+
+    def setUp(self):
+        clear_caches()
+
+    def track(self, username, exp):
+        with mock.patch('tracker.modules.accounttracker.hiscore_lookup',
+                        return_value=hiscores_record(exp)):
+            return accounttracker.track(username)
+
+    def track_many(self, lookups):
+        with stub_lookups(lookups):
+            return accounttracker.track_many(list(lookups))
+
+    def age(self, **kwargs):
+        DataPoint.objects.update(
+            time=F('time') - timedelta(**kwargs),
+            last_checked=F('last_checked') - timedelta(**kwargs))
+        RSAccount.objects.update(
+            last_checked=F('last_checked') - timedelta(**kwargs))
+        AccountSummary.objects.update(
+            first_update=F('first_update') - timedelta(**kwargs),
+            last_update=F('last_update') - timedelta(**kwargs))
+
+    def assertIndexScans(self, queries):
+        """
+        Assert that the plans of all captured statements reach every table
+        through an index. Sequential scans are disabled while planning, so
+        the planner only chooses one if no index can serve the query.
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            try:
+                for query in queries:
+                    sql = query['sql']
+                    if not re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b',
+                                    sql, re.IGNORECASE):
+                        continue
+                    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    self.assertEqual(seq_scans(plan[0]['Plan']), [], sql)
+            finally:
+                cursor.execute('SET LOCAL enable_seqscan = on')
+
+    def test_track_new_account(self):
+        dp = self.track('zezima', 1000)
+        acc = RSAccount.objects.get(username='zezima')
+
+        self.assertEqual(acc.total_exp, 23000)
+        self.assertEqual(len(fetch_levels([dp.id])[dp.id]), 24)
+        self.assertEqual(Current.objects.filter(rsaccount=acc).count(), 100)
+        self.assertEqual(Record.objects.filter(rsaccount=acc).count(), 130)
+        self.assertAlmostEqual(TimePlayed.objects.get(rsaccount=acc).hours,
+                               0.1)
+        self.assertEqual(TimePlayedRank.objects.get(datapoint=dp).rank, 1)
+
+    def test_skill_registry(self):
+        skillregistry.registry()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(accounttracker.skills()), 24)
+            self.assertEqual(len(accounttracker.skills(include_qha=True)), 26)
+            self.assertEqual(accounttracker.skill_name(2), 'Skill 2')
+            self.assertEqual(accounttracker.skill_name(50), '')
+
+        skill = Skill.objects.get(skill_id=2)
+        skill.skillname = 'Strength'
+        skill.save()
+        self.assertEqual(accounttracker.skill_name(2), 'Strength')
+
+    def test_track_recent_update(self):
+        self.track('zezima', 1000)
+        with self.assertRaises(accounttracker.RecentUpdateError):
+            self.track('zezima', 2000)
+
+    def test_track_current_and_records(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=1)
+        last = self.track('zezima', 5000)
+
+        c = Current.objects.get(skill_id=2, period=Current.DAY)
+        self.assertEqual((c.start_id, c.end_id, c.experience),
+                         (first.id, last.id, 4000))
+        r = Record.objects.get(skill_id=2, period=Record.WEEK)
+        self.assertEqual((r.start_id, r.end_id, r.experience),
+                         (first.id, last.id, 4000))
+        c = Current.objects.get(skill_id=Skill.QHA_ID, period=Current.YEAR)
+        self.assertAlmostEqual(c.hours, 0.4)
+        for skill_id in [Skill.QHA_ID, Skill.ORIG_QHA_ID]:
+            r = Record.objects.get(skill_id=skill_id, period=Record.MONTH)
+            self.assertAlmostEqual(r.hours, 0.4)
+
+        # The previous datapoint is outside of the five minute window.
+        r = Record.objects.get(skill_id=2, period=Record.FIVE_MIN)
+        self.assertEqual(r.experience, 0)
+
+    def test_track_five_minute_records(self):
+        first = self.track('zezima', 1000)
+        self.age(minutes=2)
+        last = self.track('zezima', 3000)
+
+        r = Record.objects.get(skill_id=5, period=Record.FIVE_MIN)
+        self.assertEqual((r.start_id, r.end_id, r.experience),
+                         (first.id, last.id, 2000))
+        r = Record.objects.get(skill_id=Skill.QHA_ID, period=Record.FIVE_MIN)
+        self.assertAlmostEqual(r.hours, 0.2)
+
+    def test_rebuild_records(self):
+        self.track('zezima', 1000)
+        self.age(minutes=3)
+        self.track('zezima', 3000)
+        self.age(days=2)
+        self.track('zezima', 4000)
+
+        acc = RSAccount.objects.get(username='zezima')
+        skill_ids = list(Skill.objects.values_list('skill_id', flat=True))
+
+        # Records maintained by track() match those rebuilt from history.
+        self.assertEqual(history.rebuild_records(acc.id, skill_ids), [])
+
+        Record.objects.filter(skill_id=3).update(experience=0)
+        changed = history.rebuild_records(acc.id, skill_ids)
+        self.assertEqual(len(changed), 5)
+        r = Record.objects.get(skill_id=3, period=Record.WEEK)
+        self.assertEqual(r.experience, 3000)
+
+    def test_rebuild_accounts(self):
+        first = self.track('zezima', 1000)
+        self.age(minutes=3)
+        self.track('zezima', 3000)
+        self.age(days=2)
+        last = self.track('zezima', 4000)
+        acc = RSAccount.objects.get(username='zezima')
+
+        # Entries maintained by track() match those rebuilt from history.
+        self.assertEqual(history.rebuild_accounts([acc.id]), (3, []))
+
+        Record.objects.filter(skill_id=3, period=Record.WEEK) \
+                      .update(experience=0)
+        Current.objects.filter(skill_id=3, period=Current.WEEK) \
+                       .update(experience=0, start_id=last.id)
+        Current.objects.filter(skill_id=Skill.QHA_ID, period=Current.WEEK) \
+                       .update(hours=0)
+
+        # A dry run reports the changes without making them.
+        _, changes = history.rebuild_accounts([acc.id], dry_run=True)
+        self.assertEqual(sorted(c[:4] for c in changes), [
+            ('Current', acc.id, 3, Current.WEEK),
+            ('Current', acc.id, Skill.QHA_ID, Current.WEEK),
+            ('Record', acc.id, 3, Record.WEEK),
+        ])
+        c = Current.objects.get(skill_id=3, period=Current.WEEK)
+        self.assertEqual((c.start_id, c.experience), (last.id, 0))
+
+        history.rebuild_accounts([acc.id])
+        c = Current.objects.get(skill_id=3, period=Current.WEEK)
+        self.assertEqual((c.start_id, c.end_id, c.experience),
+                         (first.id, last.id, 3000))
+        c = Current.objects.get(skill_id=Skill.QHA_ID, period=Current.WEEK)
+        self.assertAlmostEqual(c.hours, 0.3)
+        r = Record.objects.get(skill_id=3, period=Record.WEEK)
+        self.assertEqual(r.experience, 3000)
+
+        # Current entries of periods without datapoints are reset to the
+        # latest datapoint; records are kept.
+        self.age(days=8)
+        history.rebuild_accounts([acc.id])
+        c = Current.objects.get(skill_id=3, period=Current.WEEK)
+        self.assertEqual((c.start_id, c.end_id, c.experience),
+                         (last.id, last.id, 0))
+        c = Current.objects.get(skill_id=3, period=Current.MONTH)
+        self.assertEqual((c.start_id, c.experience), (first.id, 3000))
+        r = Record.objects.get(skill_id=3, period=Record.WEEK)
+        self.assertEqual(r.experience, 3000)
+
+    def test_rebuildrecords_command(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=1)
+        last = self.track('zezima', 3000)
+        self.track('lynx', 1000)
+
+        Record.objects.filter(skill_id=3, period=Record.WEEK) \
+                      .update(experience=0)
+        Current.objects.filter(rsaccount_id=last.rsaccount_id, skill_id=3,
+                               period=Current.WEEK) \
+                       .update(experience=0, start_id=last.id)
+        leaderboard.refresh_all()
+
+        out = StringIO()
+        call_command('rebuildrecords', 'ZEZIMA', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'Record zezima skill 3 period W: 0 (%d-%d) -> 2000 (%d-%d)'
+            % (first.id, last.id, first.id, last.id),
+            'Current zezima skill 3 period W: 0 (%d-%d) -> 2000 (%d-%d)'
+            % (last.id, last.id, first.id, last.id),
+            '2 entries differ.',
+        ])
+        self.assertEqual(leaderboard.top(Leaderboard.RECORDS, 3,
+                                         Record.WEEK), [])
+
+        out = StringIO()
+        call_command('rebuildrecords', stdout=out)
+        self.assertEqual(out.getvalue(), '2 entries updated.\n')
+        c = Current.objects.get(rsaccount_id=last.rsaccount_id, skill_id=3,
+                                period=Current.WEEK)
+        self.assertEqual((c.start_id, c.experience), (first.id, 2000))
+
+        # Leaderboards are refreshed with the rebuilt entries.
+        top = leaderboard.top(Leaderboard.RECORDS, 3, Record.WEEK)
+        self.assertEqual([(t[0], t[1]) for t in top], [('zezima', 2000)])
+
+    def assertRecalculated(self, points, **kwargs):
+        """
+        Assert that the hours of each (datapoint, experience) pair in
+        `points` and the QHA records and current QHA gains of their account
+        match the current rate tables. Original hours and records are checked
+        if `orig` is set.
+        """
+
+        orig = kwargs.get('orig', False)
+        skillrates.invalidate()
+        totals = []
+
+        for dp, exp in points:
+            levels = fetch_levels([dp.id])[dp.id]
+            expected = [skillrates.hours(l.skill_id, exp) for l in levels[1:]]
+            totals.append(sum(expected))
+            for l, h in zip(levels[1:], expected):
+                self.assertAlmostEqual(l.current_hours, h)
+                if orig:
+                    self.assertAlmostEqual(l.original_hours, h)
+            self.assertAlmostEqual(levels[0].current_hours, totals[-1])
+
+        acc_id = points[0][0].rsaccount_id
+        skill_ids = [Skill.QHA_ID, Skill.ORIG_QHA_ID] if orig \
+            else [Skill.QHA_ID]
+        for skill_id in skill_ids:
+            records = dict(Record.objects.filter(rsaccount_id=acc_id,
+                                                 skill_id=skill_id)
+                                         .values_list('period', 'hours'))
+            self.assertEqual(records[Record.FIVE_MIN], 0)
+            self.assertAlmostEqual(records[Record.DAY],
+                                   totals[-1] - totals[-2])
+            self.assertAlmostEqual(records[Record.WEEK],
+                                   totals[-1] - totals[0])
+
+        currents = dict(Current.objects.filter(rsaccount_id=acc_id,
+                                               skill_id=Skill.QHA_ID)
+                                       .values_list('period', 'hours'))
+        self.assertAlmostEqual(currents[Current.DAY], totals[-1] - totals[-2])
+        self.assertAlmostEqual(currents[Current.WEEK], totals[-1] - totals[0])
+
+    def test_recalculate_hours(self):
+        first = self.track('zezima', 1000)
+        self.age(days=2)
+        middle = self.track('zezima', 2000)
+        self.age(hours=1)
+        last = self.track('zezima', 5000)
+        points = [(first, 1000), (middle, 2000), (last, 5000)]
+
+        SkillRate.objects.filter(skill_id=1).update(rate=5000)
+        SkillRate.objects.create(skill_id=2, start_exp=0, rate=1000)
+        SkillRate.objects.create(skill_id=2, start_exp=1500, rate=2000)
+        with mock.patch('tracker.modules.accounttracker.lock_accounts',
+                        wraps=accounttracker.lock_accounts) as lock:
+            recalculate.recalculate_hours([1, 2])
+        lock.assert_called_once_with([first.rsaccount_id])
+        self.assertRecalculated(points)
+
+        # Original hours and records keep the rates they were tracked with.
+        levels = fetch_levels([last.id])[last.id]
+        self.assertEqual([l.original_hours for l in levels[1:3]], [0.5, 0])
+        r = Record.objects.get(skill_id=Skill.ORIG_QHA_ID,
+                               period=Record.WEEK)
+        self.assertAlmostEqual(r.hours, 0.4)
+
+        recalculate.recalculate_hours([1, 2], recalc_orig=True)
+        self.assertRecalculated(points, orig=True)
+
+    def test_recalculate_resume(self):
+        self.track('zezima', 1000)
+        self.track('lynx', 1000)
+        lynx = RSAccount.objects.get(username='lynx')
+        SkillRate.objects.filter(skill_id=1).update(rate=5000)
+
+        recalculate_single = recalculate.recalculate_single
+        def interrupted(job):
+            if job[0] == lynx.id:
+                raise KeyboardInterrupt
+            return recalculate_single(job)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'checkpoint')
+            with mock.patch('tracker.modules.recalculate.recalculate_single',
+                            side_effect=interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    recalculate.recalculate_hours([1], checkpoint=path)
+
+            # A checkpoint for different skills cannot be resumed.
+            with self.assertRaises(recalculate.RecalculationError):
+                recalculate.recalculate_hours([2], checkpoint=path)
+
+            # Only the account which was not done is recalculated.
+            with mock.patch('tracker.modules.recalculate.recalculate_single',
+                            side_effect=recalculate_single) as single:
+                recalculate.recalculate_hours([1], checkpoint=path)
+            self.assertEqual([c[0][0][0] for c in single.call_args_list],
+                             [lynx.id])
+            self.assertFalse(os.path.exists(path))
+
+        # The account done before the interruption kept its new hours.
+        for username in ['zezima', 'lynx']:
+            acc = RSAccount.objects.get(username=username)
+            dp = accounttracker.latest_datapoint(acc)
+            self.assertAlmostEqual(
+                fetch_levels([dp.id])[dp.id][1].current_hours, 0.2)
+
+    def test_track_query_count(self):
+        self.track('zezima', 1000)
+        self.age(hours=1)
+
+        # Account lookup, savepoint, account lock, datapoint, skill levels,
+        # account and time played updates, period boundaries, five
+        # Current/Record statements, virtual hiscores statistics, stale
+        # leaderboards, account summary, schedule, savepoint release. The
+        # time played rank index is already loaded.
+        with self.assertNumQueries(19):
+            self.track('zezima', 2000)
+
+    def test_track_many(self):
+        self.track('zezima', 1000)
+
+        # A batch is written with the same statements whatever its size.
+        counts = []
+        for names in [['a1', 'a2'], ['b1', 'b2', 'b3', 'b4']]:
+            with CaptureQueriesContext(connection) as queries:
+                results = self.track_many(dict((n, hiscores_record(1000))
+                                               for n in names))
+            counts.append(len(queries))
+            for name in names:
+                self.assertEqual(results[name].rsaccount.username, name)
+                self.assertEqual(Current.objects.filter(
+                    rsaccount__username=name).count(), 100)
+        self.assertEqual(counts[0], counts[1])
+
+        self.age(hours=1)
+        results = self.track_many({'zezima': hiscores_record(2000),
+                                   'a1': hiscores_record(1000)})
+        self.assertIsNone(results['a1'])
+        c = Current.objects.get(rsaccount__username='zezima', skill_id=2,
+                                period=Current.DAY)
+        self.assertEqual((c.end_id, c.experience), (results['zezima'].id,
+                                                    1000))
+
+    def test_trackaccounts_report(self):
+        self.track('zezima', 1000)
+        self.track('lynx', 1000)
+        self.age(hours=1)
+        self.track('recent', 1000)
+
+        out = StringIO()
+        err = StringIO()
+        lookups = {
+            'zezima': hiscores_record(2000),
+            'lynx': hiscores_record(1000),
+            'missing': osrsapi.PlayerNotFoundError(),
+            'broken': osrsapi.OsrsRequestError(),
+            'short': hiscores_record(1000)[:3],
+            'garbled': osrsapi.HiscoresFormatError(),
+        }
+        with stub_lookups(lookups):
+            call_command('trackaccounts', 'recent', 'not_valid!',
+                         *lookups, stdout=out, stderr=err)
+
+        # Each failed account is reported with the reason it failed.
+        self.assertEqual(out.getvalue().splitlines(), [
+            '1 of 8 accounts updated, 1 unchanged.',
+            '  could not reach hiscores: 1',
+            '  invalid hiscores data: 2',
+            '  invalid username: 1',
+            '  not found on hiscores: 1',
+            '  updated less than 30s ago: 1',
+        ])
+        self.assertEqual(sorted(err.getvalue().splitlines()), [
+            'broken: could not reach hiscores',
+            'garbled: invalid hiscores data',
+            'missing: not found on hiscores',
+            'not_valid!: invalid username',
+            'recent: updated less than 30s ago',
+            'short: invalid hiscores data',
+        ])
+
+    def test_leaderboard_snapshots(self):
+        self.track('zezima', 1000)
+        self.age(hours=1)
+        self.track('zezima', 3000)
+        leaderboard.refresh_all()
+
+        self.track('lynx', 1000)
+        self.age(hours=1)
+        self.track('lynx', 6000)
+
+        # The snapshots are updated as lynx enters them and are read
+        # without touching the Record and Current tables.
+        for board, period in [(Leaderboard.RECORDS, Record.DAY),
+                              (Leaderboard.CURRENT, Current.DAY)]:
+            with self.assertNumQueries(2):
+                top = leaderboard.top(board, 2, period)
+            self.assertEqual([(t[0], t[1]) for t in top],
+                             [('lynx', 5000), ('zezima', 2000)])
+
+        top = leaderboard.top(Leaderboard.RECORDS, Skill.QHA_ID, Record.DAY)
+        self.assertEqual([t[0] for t in top], ['lynx', 'zezima'])
+        self.assertAlmostEqual(top[0][2], 0.5)
+
+        # Pages following a cursor start after its entry.
+        top = leaderboard.top(Leaderboard.RECORDS, 2, Record.DAY, 0, 1)
+        after = leaderboard.entry_cursor(2, top[0])
+        self.assertEqual(after[0], 5000)
+        top = leaderboard.top(Leaderboard.RECORDS, 2, Record.DAY, after=after)
+        self.assertEqual([t[0] for t in top], ['zezima'])
+
+        # Ranks beyond the snapshot are ranked from the live entries.
+        with self.settings(TRACKER_LEADERBOARD_SIZE=1):
+            top = leaderboard.top(Leaderboard.RECORDS, 2, Record.DAY, 1, 10)
+            self.assertEqual([t[0] for t in top], ['zezima'])
+            top = leaderboard.top(Leaderboard.RECORDS, 2, Record.DAY,
+                                  after=after)
+            self.assertEqual([t[0] for t in top], ['zezima'])
+
+        # Deep ranks are found from the page anchor preceding them.
+        with self.settings(TRACKER_LEADERBOARD_SIZE=1), \
+                mock.patch('tracker.modules.pagination.ANCHOR_INTERVAL', 1):
+            leaderboard.refresh_all(skill_ids=[2])
+            with self.assertNumQueries(3):
+                top = leaderboard.top(Leaderboard.RECORDS, 2, Record.DAY,
+                                      1, 10)
+            self.assertEqual([t[0] for t in top], ['zezima'])
+            self.assertEqual(leaderboard.top(Leaderboard.RECORDS, 2,
+                                             Record.DAY, 2, 10), [])
+
+    @override_settings(TRACKER_LEADERBOARD_SIZE=2)
+    def test_leaderboard_merge(self):
+        def snapshot():
+            return list(LeaderboardEntry.objects
+                        .filter(board=Leaderboard.CURRENT, skill_id=2,
+                                period=Current.DAY)
+                        .order_by('rank').values_list('id', 'username',
+                                                      'experience'))
+
+        self.track('bandos', 1000)
+        self.age(hours=20)
+        self.track('bandos', 3000)
+        self.track('zezima', 1000)
+        self.track('lynx', 1000)
+        self.age(hours=1)
+        self.track('zezima', 4000)
+        self.track('lynx', 2500)
+        leaderboard.refresh_all()
+
+        first = snapshot()
+        self.assertEqual([s[1:] for s in first],
+                         [('zezima', 3000), ('bandos', 2000)])
+
+        # Once bandos' gain leaves the day, lynx moves up into the snapshot
+        # and the row of zezima, whose rank is unchanged, is kept.
+        self.age(hours=4)
+        sweeper.sweep_current()
+        merged = snapshot()
+        self.assertEqual(merged[0], first[0])
+        self.assertEqual([s[1:] for s in merged],
+                         [('zezima', 3000), ('lynx', 1500)])
+        l = Leaderboard.objects.get(board=Leaderboard.CURRENT, skill_id=2,
+                                    period=Current.DAY)
+        self.assertEqual((l.size, l.min_value), (2, 1500))
+
+        # An entry entering a full snapshot pushes its last entry out.
+        self.track('bandos', 8000)
+        self.assertEqual([s[1:] for s in snapshot()],
+                         [('bandos', 5000), ('zezima', 3000)])
+
+        # The merged snapshots match fully rebuilt ones.
+        merged = [s[1:] for s in snapshot()]
+        leaderboard.refresh_all()
+        self.assertEqual([s[1:] for s in snapshot()], merged)
+
+    def test_sweep_current(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=20)
+        middle = self.track('zezima', 2000)
+        self.age(hours=1)
+        last = self.track('zezima', 4000)
+        leaderboard.refresh_all()
+
+        # The first datapoint left the day two hours ago. Every skill's and
+        # QHA's day entry is expired.
+        self.age(hours=5)
+        status = sweeper.sweep_status()
+        self.assertEqual(status[Current.DAY][0], 25)
+        self.assertAlmostEqual(status[Current.DAY][1], 7200, delta=60)
+        self.assertEqual(status[Current.WEEK], (0, 0))
+
+        self.assertEqual(sweeper.sweep_current(), 25)
+        c = Current.objects.get(skill_id=2, period=Current.DAY)
+        self.assertEqual((c.start_id, c.end_id, c.experience),
+                         (middle.id, last.id, 2000))
+        c = Current.objects.get(skill_id=Skill.QHA_ID, period=Current.DAY)
+        self.assertAlmostEqual(c.hours, 0.2)
+        c = Current.objects.get(skill_id=2, period=Current.WEEK)
+        self.assertEqual((c.start_id, c.experience), (first.id, 3000))
+        self.assertEqual(sweeper.sweep_status()[Current.DAY], (0, 0))
+
+        # The snapshots ranking the account are refreshed.
+        top = leaderboard.top(Leaderboard.CURRENT, 2, Current.DAY)
+        self.assertEqual([(t[0], t[1]) for t in top], [('zezima', 2000)])
+
+        # Entries of periods without datapoints are reset.
+        self.age(days=1)
+        self.assertEqual(sweeper.sweep_current(), 25)
+        c = Current.objects.get(skill_id=2, period=Current.DAY)
+        self.assertEqual((c.start_id, c.end_id, c.experience),
+                         (last.id, last.id, 0))
+        self.assertEqual(sweeper.sweep_current(), 0)
+        self.assertEqual(leaderboard.top(Leaderboard.CURRENT, 2,
+                                         Current.DAY), [])
+
+    def test_data_range(self):
+        self.track('zezima', 1000)
+        self.age(hours=2)
+        self.track('zezima', 2000)
+        self.age(hours=1)
+        self.track('zezima', 4000)
+        acc = RSAccount.objects.get(username='zezima')
+
+        with self.assertNumQueries(1):
+            data = accounttracker.get_data_range(acc, 'day')
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data.skill_ids(), list(range(24)))
+        self.assertEqual(data.experience[4], [1000, 2000, 4000])
+
+        with self.assertRaises(accounttracker.InvalidPeriodError):
+            accounttracker.get_data_range(acc, 'decade')
+
+    def test_delta(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=2)
+        middle = self.track('zezima', 2000)
+        self.age(hours=1)
+        last = self.track('zezima', 4000)
+        acc = RSAccount.objects.get(username='zezima')
+
+        with self.assertNumQueries(1):
+            delta = accounttracker.get_delta(acc, 'day')
+        self.assertEqual((delta.start_id, delta.end_id), (first.id, last.id))
+        self.assertEqual(delta.levels(1)[:2], (4000, 1000))
+        change = delta.change(1)
+        self.assertEqual(change[:2], (3000, 0))
+        self.assertAlmostEqual(change[2], 0.3)
+
+        delta = accounttracker.specific_delta(acc, middle.id, last.id)
+        self.assertEqual(delta.change(4)[0], 2000)
+
+        # A single datapoint is compared with itself.
+        delta = accounttracker.specific_delta(acc, last.id, last.id)
+        self.assertEqual(delta.change(4), (0, 0, 0))
+
+        self.assertFalse(accounttracker.specific_delta(acc, 0, 0))
+
+    def test_account_summary(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=2)
+        self.track('zezima', 2000)
+        self.age(hours=1)
+        last = self.track('zezima', 4000)
+        acc = RSAccount.objects.get(username='zezima')
+
+        acc_summary = AccountSummary.objects.get(rsaccount=acc)
+        self.assertEqual(acc_summary.last_id, last.id)
+        self.assertEqual(acc_summary.first_update,
+                         DataPoint.objects.get(id=first.id).time)
+        self.assertEqual(acc_summary.experience[3], 4000)
+        self.assertAlmostEqual(acc_summary.hours[0], 0.4)
+        self.assertEqual(acc_summary.overall_records()[0],
+                         (69000, first.id, last.id))
+
+        # The summary gives the same delta as the datapoints.
+        with self.assertNumQueries(1):
+            delta = accounttracker.get_summary_delta(acc_summary, 'day')
+        expected = accounttracker.get_delta(acc, 'day')
+        self.assertEqual((delta.start_id, delta.end_id),
+                         (expected.start_id, expected.end_id))
+        for skill_id in range(24):
+            self.assertEqual(delta.change(skill_id),
+                             expected.change(skill_id))
+
+        AccountSummary.objects.all().delete()
+        self.assertEqual(summary.rebuild_summaries(), 1)
+        rebuilt = AccountSummary.objects.get(rsaccount=acc)
+        self.assertEqual((rebuilt.first_update, rebuilt.last_id,
+                          rebuilt.experience, rebuilt.records),
+                         (acc_summary.first_update, acc_summary.last_id,
+                          acc_summary.experience, acc_summary.records))
+
+    def test_virtual_hiscores(self):
+        with mock.patch('tracker.modules.accounttracker.hiscore_lookup',
+                        return_value=osrsapi.parse_hiscores(
+                            HISCORES_RESPONSE)):
+            accounttracker.track('maxed')
+        self.track('zezima', 1000)
+        self.track('lynx', 2000)
+
+        stats = VirtualStats.objects.get(username='maxed')
+        self.assertEqual((stats.num_99s, stats.num_200m, stats.lowest_exp),
+                         (23, 0, 13034431))
+
+        # Ties are ordered by account, newest first.
+        page = virtualhiscores.vs_page('99s', 2)
+        self.assertEqual([p[0] for p in page], ['maxed', 'lynx'])
+
+        page = virtualhiscores.vs_page('low', 1)
+        self.assertEqual([p[0] for p in page], ['maxed'])
+        page = virtualhiscores.vs_page('low', 2, after=page[-1][1:])
+        self.assertEqual([p[0] for p in page], ['lynx', 'zezima'])
+
+        with mock.patch('tracker.modules.virtualhiscores.VS_PAGE_SIZE', 2):
+            data = virtualhiscores.vs_data('exp', 2)
+        self.assertEqual([v['username'] for v in data['vs_table']],
+                         ['zezima'])
+        self.assertIsNone(data['next'])
+        self.assertIsNone(virtualhiscores.vs_data('exp', 5))
+
+        # Numbered pages are read from the anchor preceding them.
+        with mock.patch('tracker.modules.pagination.ANCHOR_INTERVAL', 1), \
+                mock.patch('tracker.modules.virtualhiscores.VS_PAGE_SIZE', 1):
+            virtualhiscores.refresh_anchors()
+            self.assertEqual(PageAnchor.objects.filter(
+                ranking='virtual:exp').count(), 3)
+            with self.assertNumQueries(2):
+                data = virtualhiscores.vs_data('exp', 3)
+            self.assertEqual([v['username'] for v in data['vs_table']],
+                             ['zezima'])
+            self.assertIsNone(virtualhiscores.vs_data('exp', 4))
+
+    def test_convert_levels(self):
+        dp = self.track('zezima', 1000)
+        stored = fetch_levels([dp.id])[dp.id]
+
+        other = levelstorage.ROWS \
+            if levelstorage.mode() == levelstorage.COLUMNS \
+            else levelstorage.COLUMNS
+        self.assertEqual(levelstorage.convert(other, dp.id, dp.id + 1,
+                                              delete=True), 1)
+        self.assertEqual(fetch_levels([dp.id])[dp.id], [])
+
+        with self.settings(TRACKER_LEVEL_STORAGE=other):
+            converted = fetch_levels([dp.id])[dp.id]
+        self.assertEqual([(l.skill_id, l.experience, l.rank, l.current_hours)
+                          for l in converted],
+                         [(l.skill_id, l.experience, l.rank, l.current_hours)
+                          for l in stored])
+
+    def test_downsample(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=2)
+        middle = self.track('zezima', 2000)
+        self.age(hours=1)
+        last = self.track('zezima', 4000)
+
+        # Recent datapoints are kept.
+        self.assertEqual(retention.downsample(), 0)
+
+        # Move the datapoints to a single day over a year ago.
+        for dp, hour in [(first, 10), (middle, 12), (last, 13)]:
+            DataPoint.objects.filter(id=dp.id).update(
+                time=datetime(2000, 1, 1, hour, tzinfo=timezone.utc))
+        self.assertEqual(retention.downsample(dry_run=True), 1)
+        self.assertEqual(retention.downsample(), 1)
+
+        # The first datapoint of the day and the ends of the records remain.
+        self.assertEqual(list(DataPoint.objects.order_by('id')
+                                               .values_list('id', flat=True)),
+                         [first.id, last.id])
+        self.assertEqual(fetch_levels([middle.id])[middle.id], [])
+        self.assertFalse(TimePlayedRank.objects.filter(datapoint_id=middle.id)
+                                               .exists())
+        r = Record.objects.get(skill_id=2, period=Record.DAY)
+        self.assertEqual((r.start_id, r.end_id), (first.id, last.id))
+
+    def test_hot_queries_use_indexes(self):
+        self.track('zezima', 1000)
+        self.age(hours=1)
+        acc = RSAccount.objects.get(username='zezima')
+        acc_summary = AccountSummary.objects.get(rsaccount=acc)
+
+        # The rank index and rate tables were loaded by the first update.
+        with CaptureQueriesContext(connection) as queries:
+            self.track('zezima', 2000)
+            accounttracker.get_data_range(acc, 'day')
+            accounttracker.get_delta(acc, 'day')
+            accounttracker.get_summary_delta(acc_summary, 'day')
+            for board in [Leaderboard.RECORDS, Leaderboard.CURRENT]:
+                for skill_id in [2, Skill.QHA_ID]:
+                    leaderboard.top(board, skill_id, Record.DAY)
+                    leaderboard.top(board, skill_id, Record.DAY,
+                                    after=(1000, 1))
+            virtualhiscores.vs_page('exp', 10)
+
+        self.assertIndexScans(queries)
+
+    def test_rank_index_changes(self):
+        self.track('zezima', 1000)
+        ranks.invalidate()
+        index = ranks.time_played()
+        self.assertEqual(len(index), 1)
+        ranks.time_played_changed([(None, 5.0)])
+        self.assertEqual(len(index), 2)
+        self.assertEqual(ranks.rank(5.0), 1)
+
+        # Changes committed before the index was loaded are already in it.
+        ranks.invalidate()
+        index = ranks.time_played()
+        with mock.patch('tracker.modules.ranks.time') as clock:
+            clock.time.return_value = 0
+            ranks.time_played_changed([(None, 5.0)])
+        self.assertEqual(len(index), 1)
+
+    def test_track_malformed(self):
+        with mock.patch('tracker.modules.accounttracker.hiscore_lookup',
+                        side_effect=osrsapi.HiscoresFormatError):
+            with self.assertRaises(accounttracker.TrackError):
+                accounttracker.track('zezima')
+        self.assertFalse(RSAccount.objects.exists())
+
+    def test_update_queue(self):
+        job = updatequeue.submit('zezima')
+        self.assertEqual(job.status, UpdateJob.QUEUED)
+
+        # Requests for an account with a pending job join it.
+        self.assertEqual(updatequeue.submit('ZEZIMA').id, job.id)
+        updatequeue.submit('lynx')
+        with self.assertRaises(accounttracker.InvalidUsernameError):
+            updatequeue.submit('not valid!')
+
+        # Workers stay within the lookup budget.
+        jobs = updatequeue.claim(10, rate=1)
+        self.assertEqual([j.id for j in jobs], [job.id])
+        self.assertEqual(updatequeue.claim(10, rate=1), [])
+        self.assertEqual(updatequeue.submit('zezima').id, job.id)
+
+        with mock.patch('tracker.modules.accounttracker.hiscores_client') \
+                as client:
+            client.return_value.lookup_many.return_value = {
+                'zezima': hiscores_record(1000),
+            }
+            updatequeue.run(jobs)
+
+        job = UpdateJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.result), (UpdateJob.DONE, 'OK'))
+        self.assertTrue(RSAccount.objects.filter(username='zezima').exists())
+        self.assertNotEqual(updatequeue.submit('zezima').id, job.id)
+
+    def test_track_schedule(self):
+        self.track('zezima', 1000)
+        schedule = TrackSchedule.objects.get(rsaccount__username='zezima')
+        self.assertEqual((schedule.update_interval, schedule.last_gain),
+                         (TrackSchedule.DEFAULT_INTERVAL, None))
+
+        self.age(hours=1)
+        self.track('zezima', 2000)
+        schedule.refresh_from_db()
+        self.assertEqual((schedule.update_interval, schedule.last_gain),
+                         (TrackSchedule.DEFAULT_INTERVAL // 2, 23000))
+
+        # Due updates are queued once.
+        self.assertEqual(scheduler.schedule(10), 0)
+        TrackSchedule.objects.update(next_update=F('next_update')
+                                     - timedelta(days=1))
+        self.assertEqual(scheduler.schedule(10), 1)
+        self.assertEqual(UpdateJob.objects.get().username, 'zezima')
+        self.assertEqual(scheduler.schedule(10), 0)
+
+    # Pages are not revalidated for time passing during the test.
+    @override_settings(TRACKER_PAGE_CACHE_TTL=10 ** 9)
+    def test_page_cache(self):
+        self.track('zezima', 1000)
+
+        response = self.client.get('/player/zezima/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'csrfmiddlewaretoken', response.content)
+        etag = response['ETag']
+
+        # Unchanged pages are revalidated or served from the fragment cache.
+        response = self.client.get('/player/zezima/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        with mock.patch('tracker.modules.template.player_page') as page:
+            response = self.client.get('/player/zezima/')
+        self.assertFalse(page.called)
+        self.assertEqual(response['ETag'], etag)
+
+        # Versions are bumped when the transaction commits.
+        with mock.patch('django.db.transaction.on_commit',
+                        side_effect=lambda f: f()):
+            self.age(hours=1)
+            self.track('zezima', 2000)
+            records = self.client.get('/records/2/')['ETag']
+            leaderboard.refresh_all()
+
+        response = self.client.get('/player/zezima/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertNotEqual(self.client.get('/records/2/')['ETag'], records)
+
+    def test_track_unchanged(self):
+        first = self.track('zezima', 1000)
+        self.age(hours=1)
+
+        # Account lookup, savepoint, lookup times, schedule, savepoint
+        # release.
+        with self.assertNumQueries(5):
+            self.assertIsNone(self.track('zezima', 1000))
+
+        acc = RSAccount.objects.get(username='zezima')
+        self.assertEqual(list(DataPoint.objects.values_list('id', flat=True)),
+                         [first.id])
+        self.assertGreater(acc.last_checked, first.time)
+        self.assertEqual(accounttracker.last_checked(acc), acc.last_checked)
+        self.assertEqual(DataPoint.objects.get(id=first.id).last_checked,
+                         acc.last_checked)
+        schedule = TrackSchedule.objects.get(rsaccount=acc)
+        self.assertEqual(schedule.update_interval,
+                         TrackSchedule.DEFAULT_INTERVAL * 2)
+        with self.assertRaises(accounttracker.RecentUpdateError):
+            self.track('zezima', 2000)
+
+        self.age(hours=1)
+        last = self.track('zezima', 2000)
+        c = Current.objects.get(skill_id=2, period=Current.DAY)
+        self.assertEqual((c.start_id, c.end_id, c.experience),
+                         (first.id, last.id, 1000))
+
+        # The player page shows the latest lookup, after the delta's end.
+        self.age(hours=1)
+        self.assertIsNone(self.track('zezima', 2000))
+        acc.refresh_from_db()
+        delta = accounttracker.get_delta(acc, 'day')
+        self.assertEqual(delta.end_id, last.id)
+        with mock.patch('tracker.modules.template.loader') as loader:
+            template.player_page(acc, delta, 'day', 'day')
+        context = loader.get_template.return_value.render.call_args[0][0]
+        self.assertEqual(context['lastupdate'], acc.last_checked)
+        self.assertGreater(context['lastupdate'], delta.end_time)
+
+    def test_track_unchanged_past_period(self):
+        first = self.track('zezima', 1000)
+        for _ in range(37):
+            self.age(hours=1)
+            self.assertIsNone(self.track('zezima', 1000))
+        acc = RSAccount.objects.get(username='zezima')
+
+        # Before the levels change, the day holds no gains rather than no
+        # data.
+        acc_summary = AccountSummary.objects.get(rsaccount=acc)
+        for delta in [accounttracker.get_delta(acc, 'day'),
+                      accounttracker.get_summary_delta(acc_summary, 'day')]:
+            self.assertEqual((delta.start_id, delta.end_id,
+                              delta.change(2)[0]), (first.id, first.id, 0))
+        self.assertEqual(len(accounttracker.get_data_range(acc, 'day')), 1)
+
+        self.age(hours=1)
+        last = self.track('zezima', 2000)
+
+        # The first datapoint is older than a day, but lookups found its
+        # levels within the day, so it opens the day.
+        for model in [Current, Record]:
+            e = model.objects.get(skill_id=2, period=model.DAY)
+            self.assertEqual((e.start_id, e.end_id, e.experience),
+                             (first.id, last.id, 1000))
+        acc_summary = AccountSummary.objects.get(rsaccount=acc)
+        for delta in [accounttracker.get_delta(acc, 'day'),
+                      accounttracker.get_summary_delta(acc_summary, 'day')]:
+            self.assertEqual((delta.start_id, delta.change(2)[0]),
+                             (first.id, 1000))
+        self.assertEqual(len(accounttracker.get_data_range(acc, 'day')), 2)
+        self.assertEqual(history.rebuild_accounts([acc.id]), (2, []))
+
+        # It leaves the day a day after its last lookup.
+        self.age(hours=22)
+        self.assertEqual(sweeper.sweep_current(), 0)
+        self.age(hours=2)
+        self.assertEqual(sweeper.sweep_current(), 25)
+        c = Current.objects.get(skill_id=2, period=Current.DAY)
+        self.assertEqual((c.start_id, c.experience), (last.id, 0))
+        self.assertEqual(history.rebuild_accounts([acc.id]), (2, []))
+
+
+class RecalculatePoolTests(TransactionTestCase):
+    """
+    Recalculation in worker processes, which only see committed data.
+    """
+
+    def setUp(self):
+        create_skills()
+        clear_caches()
+
+    def test_worker_pool(self):
+        for username in ['zezima', 'lynx', 'woox']:
+            with mock.patch('tracker.modules.accounttracker.hiscore_lookup',
+                            return_value=hiscores_record(1000)):
+                accounttracker.track(username)
+
+        SkillRate.objects.filter(skill_id=1).update(rate=5000)
+        recalculate.recalculate_hours([1], processes=2)
+
+        points = list(DataPoint.objects.values_list('id', flat=True))
+        self.assertEqual(len(points), 3)
+        for dp_id, levels in fetch_levels(points).items():
+            self.assertAlmostEqual(levels[1].current_hours, 0.2)
+            self.assertAlmostEqual(levels[0].current_hours, 0.2)
+
+
+# Every tracking test again, with skill levels stored as packed arrays.
+@override_settings(TRACKER_LEVEL_STORAGE=levelstorage.COLUMNS)
+class PackedTrackTests(TrackTests):
+    pass
@@ -44,9 +44,13 @@ urlpatterns = [
         views.recordsfull),
 
     # Virtual Hiscores
-    url(r'^virtual/', views.virtual),
+    url(r'^virtual/$', views.virtual),
+    url(r'^virtual/(?P<vs_type>exp|99s|200|low)/$', views.virtual),
+    url(r'^virtual/(?P<vs_type>exp|99s|200|low)/(?P<page>\d+)$',
+        views.virtual),
 
     url(r'^tracker/updateplayer$', views.updateplayer),
+    url(r'^tracker/updatestatus$', views.updatestatus),
     url(r'^tracker/recordstable$', views.recordstable),
     url(r'^tracker/skillstable$', views.skillstable),
     url(r'^tracker/lastupdate$', views.lastupdate),
@@ -17,11 +17,15 @@
 #
 
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.views.decorators.csrf import ensure_csrf_cookie
 
-from tracker.models import RSAccount, Skill, Record, Current
-from tracker.modules import accounttracker, osrsapi, template, virtualhiscores
+from tracker.models import RSAccount, Skill, Record, Current, \
+    Leaderboard, UpdateJob
+from tracker.modules import accounttracker, leaderboard, pagecache, \
+    pagination, template, updatequeue, virtualhiscores
 
+@ensure_csrf_cookie
 def index(request):
     """
     Tracker main page view.
@@ -32,25 +36,55 @@ def index(request):
     })
 
 
+def cached_page(keys):
+    """
+    Serve a page through the page cache (see `pagecache.cached`). Pages also
+    depend on the visitor's search period. Cached pages hold no CSRF token,
+    which scripts read from the cookie set with each response instead.
+    """
+
+    cached = pagecache.cached(keys,
+                              vary=lambda request: get_searchperiod(request))
+    return lambda view: ensure_csrf_cookie(cached(view))
+
+
+def board_keys(board, skill, period=None):
+    """
+    Return the page version keys of a skill's leaderboards in a period, or in
+    every period.
+    """
+
+    periods = [period] if period else leaderboard.BOARD_PERIODS[board]
+    return [pagecache.board_key(board, int(skill), p) for p in periods]
+
+
+@cached_page(lambda user, period='week': [pagecache.account_key(user)])
 def player(request, user, period='week'):
     """
     Tracker view for a single account for the given period.
     """
 
     try:
-        acc = RSAccount.objects.get(username__iexact=user)
+        acc = RSAccount.objects.select_related('summary') \
+                              .get(username__iexact=user)
     except RSAccount.DoesNotExist:
         return render(request, 'tracker/nottracked.html', {
             'username': user,
             'searchperiod': get_searchperiod(request),
         })
 
-    accounttracker.update_player_current_top(acc)
-    datapoints = accounttracker.get_data_range(acc, period)
-    return HttpResponse(template.player_page(acc, datapoints, period,
-                                             get_searchperiod(request)))
+    acc_summary = getattr(acc, 'summary', None)
+    if acc_summary is not None:
+        delta = accounttracker.get_summary_delta(acc_summary, period)
+    else:
+        delta = accounttracker.get_delta(acc, period)
+
+    return HttpResponse(template.player_page(acc, delta, period,
+                                             get_searchperiod(request),
+                                             acc_summary))
 
 
+@ensure_csrf_cookie
 def playerperiod(request, user, start, end):
     """
     Player view for experience in between the datapoints with IDs start and end.
@@ -67,11 +101,12 @@ def playerperiod(request, user, start, end):
     if start_id >= end_id:
         return HttpResponseBadRequest()
 
-    datapoints = accounttracker.specific_data_range(acc, start, end)
-    return HttpResponse(template.player_page(acc, datapoints, '',
+    delta = accounttracker.specific_delta(acc, start_id, end_id)
+    return HttpResponse(template.player_page(acc, delta, '',
                                              get_searchperiod(request)))
 
 
+@cached_page(lambda skill: board_keys(Leaderboard.RECORDS, skill))
 def records(request, skill):
     """
     Records overview for a given skill.
@@ -93,6 +128,8 @@ def records(request, skill):
     return render(request, 'tracker/records/records.html', context)
 
 
+@cached_page(lambda skill, period, page=1: board_keys(
+    Leaderboard.RECORDS, skill, Record.str_to_period(period)))
 def recordsfull(request, skill, period, page=1):
     """
     Full table of records for a specific skill.
@@ -101,6 +138,8 @@ def recordsfull(request, skill, period, page=1):
     skill_id = int(skill)
     p = Record.str_to_period(period)
     start = (int(page) - 1) * 25
+    records = template.record_table(skill_id, p, start, 25,
+                                    pagination.page_cursor(request))
 
     if period == 'fivemin':
         period = ''
@@ -110,7 +149,8 @@ def recordsfull(request, skill, period, page=1):
         'period': period,
         'start': start,
         'page': page,
-        'records': template.record_table(skill_id, p, start, 25),
+        'records': records,
+        'next': records[-1][5] if len(records) == 25 else None,
         'searchperiod': get_searchperiod(request),
         'use_hours': skill_id >= Skill.QHA_ID,
     }
@@ -118,6 +158,7 @@ def recordsfull(request, skill, period, page=1):
     return render(request, 'tracker/records/full.html', context)
 
 
+@cached_page(lambda skill: board_keys(Leaderboard.CURRENT, skill))
 def current(request, skill):
     """
     Current top overview for a given skill.
@@ -131,6 +172,8 @@ def current(request, skill):
     return render(request, 'tracker/current/current.html', context)
 
 
+@cached_page(lambda skill, period, page=1: board_keys(
+    Leaderboard.CURRENT, skill, Current.str_to_period(period)))
 def currentfull(request, skill, period, page=1):
     """
     Full table of records for a specific skill.
@@ -139,13 +182,16 @@ def currentfull(request, skill, period, page=1):
     skill_id = int(skill)
     p = Current.str_to_period(period)
     start = (int(page) - 1) * 25
+    current = template.current_table(skill_id, p, start, 25,
+                                     pagination.page_cursor(request))
 
     context = {
         'skillname': accounttracker.skill_name(skill_id),
         'period': period,
         'start': start,
         'page': page,
-        'current': template.current_table(skill_id, p, start, 25),
+        'current': current,
+        'next': current[-1][5] if len(current) == 25 else None,
         'searchperiod': get_searchperiod(request),
         'use_hours': skill_id >= Skill.QHA_ID,
     }
@@ -153,42 +199,73 @@ def currentfull(request, skill, period, page=1):
     return render(request, 'tracker/current/full.html', context)
 
 
-def virtual(request, vs_type='exp'):
+@cached_page(lambda vs_type='exp', page=1: [pagecache.VIRTUAL_KEY])
+def virtual(request, vs_type='exp', page=1):
     """
     Virtual hiscores page.
     """
 
+    page = int(page)
+    data = virtualhiscores.vs_data(vs_type, page,
+                                   pagination.page_cursor(request))
     context = {
         'searchperiod': get_searchperiod(request),
         'vs_type': virtualhiscores.type_name(vs_type),
+        'vs_short': vs_type,
         'vs_types': virtualhiscores.vs_types(),
+        'vs_data': data,
+        'page': page,
     }
+    if data and data['next']:
+        context['next'] = pagination.encode_cursor(data['next'])
 
     return render(request, 'tracker/virtual/virtual.html', context)
 
 
 def updateplayer(request):
     """
-    Player update request.
+    Player update request. Queues an update of the player and responds with
+    the status of its job, which can be followed through `updatestatus`.
     """
 
     if (request.method != 'GET'):
         return HttpResponseBadRequest()
 
     try:
-        dp = accounttracker.track(request.GET['player'])
-    except accounttracker.RecentUpdateError:
-        return HttpResponse('-1')
-    except osrsapi.PlayerNotFoundError:
-        return HttpResponse('-2')
-    except osrsapi.OsrsRequestError:
-        return HttpResponse('-3')
+        job = updatequeue.submit(request.GET['player'])
     except accounttracker.InvalidUsernameError:
-        return HttpResponse('-4')
-    except accounttracker.TrackError:
-        return HttpResponse('-5')
+        return JsonResponse({'job': None, 'status': UpdateJob.FAILED,
+                             'result': '-4'})
 
-    return HttpResponse('OK')
+    return JsonResponse(job_status(job))
+
+
+def updatestatus(request):
+    """
+    Status of a player update job.
+    """
+
+    if (request.method != 'GET'):
+        return HttpResponseBadRequest()
+
+    try:
+        job = UpdateJob.objects.get(id=int(request.GET['job']))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    except UpdateJob.DoesNotExist:
+        # Finished jobs are purged after a day.
+        return JsonResponse({'job': None, 'status': UpdateJob.FAILED,
+                             'result': '-5'})
+
+    return JsonResponse(job_status(job))
+
+
+def job_status(job):
+    return {
+        'job': job.id,
+        'status': job.status,
+        'result': job.result,
+    }
 
 
 def recordstable(request):
@@ -228,10 +305,10 @@ def skillstable(request):
     except RSAccount.DoesNotExist:
         return HttpResponse('-2')
 
-    datapoints = accounttracker.get_data_range(acc, request.GET['period'])
-    table_data = template.player_skill_table(acc, datapoints)
+    delta = accounttracker.get_delta(acc, request.GET['period'])
+    table_data = template.player_skill_table(acc, delta)
 
-    if len(datapoints) == 0:
+    if not delta:
         skills = accounttracker.skills()
     else:
         skills = None
@@ -254,7 +331,7 @@ def lastupdate(request):
         return HttpResponse('-2')
 
     context = {
-        'lastupdate': accounttracker.latest_datapoint(acc).time,
+        'lastupdate': accounttracker.last_checked(acc),
     }
 
     return render(request, 'tracker/player/last-update.html', context)